@@ -0,0 +1,87 @@
+# Compares the throughput of concatenate_and_group_texts against the original list-based implementation.
+#
+# Usage: python benchmarks/group_texts_bench.py [--seq_len 2048] [--num_docs 1000] [--stride 1024]
+import argparse
+import copy
+import random
+import timeit
+from itertools import chain
+
+import numpy as np
+
+from transformers import BatchEncoding
+
+from sprucfluo.text import concatenate_and_group_texts
+
+
+def list_concatenate_and_group_texts(encoding, seq_len, stride=None, drop_remainder=True, mask_stride_overlap=True):
+    """The original implementation, which works on python lists"""
+    concatenated = {k: list(chain(*v)) for k, v in encoding.items()}
+    total_length = len(concatenated["input_ids"])
+    stride = stride or seq_len
+
+    if total_length % stride != 0 and drop_remainder:
+        total_length = ((total_length - seq_len + stride) // stride) * stride
+
+    for begin in range(0, total_length - seq_len + stride, stride):
+        data = {k: v[begin:begin+seq_len] for k, v in concatenated.items()}
+
+        if mask_stride_overlap and stride != seq_len:
+            labels = data.get("labels", data["input_ids"])
+            if begin != 0:
+                labels = copy.deepcopy(labels)
+                for i in range(seq_len - stride):
+                    if i < len(labels):
+                        labels[i] = -100
+            data["labels"] = labels
+
+        yield BatchEncoding(data=data)
+
+
+def synthetic_batch(num_docs, mean_doc_len, vocab_size, seed=0):
+    """A batch that looks like tokenizer output: lists of python ints, with roughly exponential doc lengths"""
+    rng = random.Random(seed)
+    docs = [[rng.randrange(vocab_size) for _ in range(max(1, int(rng.expovariate(1 / mean_doc_len))))]
+            for _ in range(num_docs)]
+    return {"input_ids": docs, "attention_mask": [[1] * len(d) for d in docs]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark concatenate_and_group_texts")
+    parser.add_argument("--seq_len", type=int, default=2048)
+    parser.add_argument("--stride", type=int, default=None)
+    parser.add_argument("--num_docs", type=int, default=1000)
+    parser.add_argument("--mean_doc_len", type=int, default=1000)
+    parser.add_argument("--vocab_size", type=int, default=50257)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    batch = synthetic_batch(args.num_docs, args.mean_doc_len, args.vocab_size)
+    num_tokens = sum(len(d) for d in batch["input_ids"])
+    print(f"{args.num_docs} docs, {num_tokens} tokens, seq_len={args.seq_len}, stride={args.stride}")
+
+    # what the token cache produces
+    array_batch = {k: [np.asarray(d, dtype=np.uint16) for d in v] for k, v in batch.items()}
+
+    def run(encoding, **kwargs):
+        return lambda: list(concatenate_and_group_texts(encoding, args.seq_len, args.stride, **kwargs))
+
+    impls = {
+        "original": lambda: list(list_concatenate_and_group_texts(batch, args.seq_len, args.stride)),
+        "current": run(batch),
+        "return_tensors=np": run(batch, return_tensors="np"),
+        "return_tensors=pt": run(batch, return_tensors="pt"),
+        "array inputs": run(array_batch),
+        "array inputs, return_tensors=np": run(array_batch, return_tensors="np"),
+    }
+
+    baseline = None
+    for name, fn in impls.items():
+        secs = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        baseline = baseline or secs
+        print(f"{name:>32}: {secs * 1000:8.2f} ms/batch  {num_tokens / secs / 1e6:8.2f} Mtok/s  "
+              f"({baseline / secs:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
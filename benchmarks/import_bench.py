@@ -0,0 +1,64 @@
+# Measures how long `import sprucfluo` takes in a fresh interpreter (which every DataLoader worker spawn and every
+# script pays), which of the heavy optional imports it pulls in, and the slowest modules in it (from -X importtime).
+# transformers, magic and torchdata should only be imported when they're used.
+#
+# Usage: python benchmarks/import_bench.py [--repeat 5] [--max_secs 2.0]
+import argparse
+import statistics
+import subprocess
+import sys
+
+_DEFERRED = ["transformers", "magic", "torchdata"]
+
+_SCRIPT = f"""
+import sys, time
+start = time.perf_counter()
+import sprucfluo
+secs = time.perf_counter() - start
+print(secs, ",".join(m for m in {_DEFERRED!r} if m in sys.modules))
+"""
+
+
+def time_import():
+    out = subprocess.run([sys.executable, "-c", _SCRIPT], capture_output=True, text=True, check=True).stdout.split()
+    return float(out[0]), out[1].split(",") if len(out) > 1 else []
+
+
+def slowest_packages(n):
+    """The n packages that take longest to import (with everything they import), in microseconds"""
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", "import sprucfluo"],
+                         capture_output=True, text=True, check=True).stderr
+    times = {}
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        if package != "sprucfluo":
+            times[package] = max(times.get(package, 0), int(cumulative))
+    return sorted(((micros, package) for package, micros in times.items()), reverse=True)[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the time to import sprucfluo")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--max_secs", type=float, help="Fail if the median import time is longer than this")
+    args = parser.parse_args()
+
+    results = [time_import() for _ in range(args.repeat)]
+    secs = [s for s, _ in results]
+    imported = results[-1][1]
+    median = statistics.median(secs)
+    print(f"import sprucfluo: {median:.3f}s median, {min(secs):.3f}s best of {args.repeat}")
+    print(f"deferred modules imported anyway: {', '.join(imported) or 'none'}")
+    print("slowest packages:")
+    for micros, name in slowest_packages(args.top):
+        print(f"  {micros / 1e6:7.3f}s  {name}")
+
+    if imported or (args.max_secs is not None and median > args.max_secs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
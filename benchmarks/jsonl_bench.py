@@ -0,0 +1,84 @@
+# Measures docs/sec of read_jsonl for each json backend on a synthetic Pile-like jsonl file.
+#
+# Usage: python benchmarks/jsonl_bench.py [--num_docs 20000] [--mean_doc_chars 4000]
+import argparse
+import json
+import os
+import random
+import string
+import tempfile
+import time
+
+from sprucfluo.text import read_jsonl, JSON_BACKENDS
+
+_PILE_SETS = ["Pile-CC", "Github", "OpenWebText2", "StackExchange", "Wikipedia (en)", "PubMed Abstracts", "ArXiv"]
+
+
+def synthetic_pile_doc(rng: random.Random, mean_chars: int) -> dict:
+    """A document with the shape of the Pile: mostly ascii words, with newlines, quotes, and the odd non-ascii char"""
+    words = []
+    length = 0
+    target = max(1, int(rng.expovariate(1 / mean_chars)))
+    while length < target:
+        r = rng.random()
+        if r < 0.02:
+            word = "\n"
+        elif r < 0.03:
+            word = '"' + "".join(rng.choices(string.ascii_lowercase, k=5)) + '"'
+        elif r < 0.035:
+            word = rng.choice(["é", "ü", "中文", "—", "😀"])
+        else:
+            word = "".join(rng.choices(string.ascii_lowercase, k=rng.randint(1, 10)))
+        words.append(word)
+        length += len(word) + 1
+    return {"text": " ".join(words), "meta": {"pile_set_name": rng.choice(_PILE_SETS)}}
+
+
+def write_synthetic_jsonl(path: str, num_docs: int, mean_chars: int, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        for _ in range(num_docs):
+            f.write(json.dumps(synthetic_pile_doc(rng, mean_chars)) + "\n")
+
+
+def original_read_jsonl(stream, json_text_key="text"):
+    """The original implementation: text-mode line iteration and a full json.loads per line"""
+    for line in stream:
+        yield json.loads(line)[json_text_key]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark read_jsonl backends")
+    parser.add_argument("--num_docs", type=int, default=20000)
+    parser.add_argument("--mean_doc_chars", type=int, default=4000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "synthetic.jsonl")
+        write_synthetic_jsonl(path, args.num_docs, args.mean_doc_chars)
+        size_mb = os.path.getsize(path) / 1e6
+        print(f"{args.num_docs} docs, {size_mb:.1f} MB")
+
+        def run(name, mode, read_fn):
+            best = float("inf")
+            for _ in range(args.repeat):
+                with open(path, mode) as stream:
+                    start = time.perf_counter()
+                    count = sum(1 for _ in read_fn(stream))
+                    best = min(best, time.perf_counter() - start)
+            assert count == args.num_docs
+            print(f"{name:>24}: {count / best:10.0f} docs/s  {size_mb / best:8.1f} MB/s")
+
+        run("original (text mode)", "r", original_read_jsonl)
+        for backend in JSON_BACKENDS:
+            try:
+                JSON_BACKENDS[backend]("text")
+            except ImportError:
+                print(f"{backend:>24}: not installed")
+                continue
+            run(backend, "rb", lambda s: read_jsonl(s, backend=backend))
+
+
+if __name__ == "__main__":
+    main()
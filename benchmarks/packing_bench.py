@@ -0,0 +1,64 @@
+# Compares packing whole documents into sequences (tokenize_and_group_texts(..., pack=True)) with concatenating them
+# and cutting every seq_len tokens (the default): how many documents end up split between sequences, how much of each
+# sequence is padding, and how fast each is.
+#
+# Usage: python benchmarks/packing_bench.py [--seq_len 2048] [--num_docs 20000] [--pack_window 1000]
+import argparse
+import random
+import time
+
+from torchdata.datapipes.iter import IterableWrapper
+
+import sprucfluo as sf
+
+
+def synthetic_docs(num_docs, mean_doc_len, vocab_size, seed=0):
+    """Token ids with roughly exponential doc lengths"""
+    rng = random.Random(seed)
+    return [[rng.randrange(vocab_size) for _ in range(max(1, int(rng.expovariate(1 / mean_doc_len))))]
+            for _ in range(num_docs)]
+
+
+def identity_tokenizer(texts):
+    return {"input_ids": texts, "attention_mask": [[1] * len(t) for t in texts]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark document packing against concatenation")
+    parser.add_argument("--seq_len", type=int, default=2048)
+    parser.add_argument("--num_docs", type=int, default=20000)
+    parser.add_argument("--mean_doc_len", type=int, default=600)
+    parser.add_argument("--vocab_size", type=int, default=50257)
+    parser.add_argument("--pack_window", type=int, default=1000)
+    args = parser.parse_args()
+
+    docs = synthetic_docs(args.num_docs, args.mean_doc_len, args.vocab_size)
+    num_tokens = sum(len(d) for d in docs)
+    print(f"{args.num_docs} docs, {num_tokens} tokens, seq_len={args.seq_len}")
+
+    # concatenation: no padding (but the last sequence), and a document is split wherever a boundary falls in it
+    start = time.perf_counter()
+    num_sequences = sum(1 for _ in sf.tokenize_and_group_texts(IterableWrapper(docs), identity_tokenizer,
+                                                               seq_len=args.seq_len, drop_remainder=False))
+    secs = time.perf_counter() - start
+    split = 0
+    offset = 0
+    for doc in docs:
+        split += offset // args.seq_len != (offset + len(doc) - 1) // args.seq_len
+        offset += len(doc)
+    padding = 1 - num_tokens / (num_sequences * args.seq_len)
+    print(f"{'concatenate':>12}: {num_sequences:7d} sequences, {padding:6.2%} padding, {split / len(docs):6.2%} of "
+          f"docs split, {num_tokens / secs / 1e6:6.2f} Mtok/s")
+
+    start = time.perf_counter()
+    packed = sf.tokenize_and_group_texts(IterableWrapper(docs), identity_tokenizer, seq_len=args.seq_len, pack=True,
+                                         pack_window=args.pack_window)
+    num_sequences = sum(1 for _ in packed)
+    secs = time.perf_counter() - start
+    stats = packed.stats()
+    print(f"{'pack':>12}: {num_sequences:7d} sequences, {stats['padding_fraction']:6.2%} padding, "
+          f"{stats['split_documents'] / stats['documents']:6.2%} of docs split, {num_tokens / secs / 1e6:6.2f} Mtok/s")
+
+
+if __name__ == "__main__":
+    main()
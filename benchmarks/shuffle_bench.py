@@ -0,0 +1,53 @@
+# Compares the throughput of seeded_shuffle with its random index generators: a random.Random call per item
+# (rng="python", the default) and blocks of indices from a numpy Generator (rng="numpy").
+#
+# The datapipe machinery in torch (profiler hooks around every next()) costs more than either, so the replacement loop
+# is also timed by itself.
+#
+# Usage: python benchmarks/shuffle_bench.py [--num_items 2000000] [--buffer_size 10000]
+import argparse
+import timeit
+
+from torchdata.datapipes.iter import IterableWrapper
+
+from sprucfluo.shuffle import SeededShufflerIterDataPipe, _ObjectBuffer, _RNGS
+
+
+def replacement_loop(items, buffer_size, seed, rng):
+    """The inner loop of SeededShufflerIterDataPipe, without the datapipe around it"""
+    generator = _RNGS[rng](seed)
+    buffer = _ObjectBuffer()
+    for x in items[:buffer_size]:
+        buffer.append(x)
+    for x in items[buffer_size:]:
+        SeededShufflerIterDataPipe.buffer_replace(generator, buffer, x)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark seeded_shuffle")
+    parser.add_argument("--num_items", type=int, default=2_000_000)
+    parser.add_argument("--buffer_size", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    items = list(range(args.num_items))
+    print(f"{args.num_items} items, buffer_size={args.buffer_size}")
+
+    def run_pipe(rng):
+        pipe = IterableWrapper(items, deepcopy=False).seeded_shuffle(args.seed, buffer_size=args.buffer_size, rng=rng)
+        return lambda: sum(1 for _ in pipe)
+
+    def run_loop(rng):
+        return lambda: replacement_loop(items, args.buffer_size, args.seed, rng)
+
+    for name, run in [("replacement loop", run_loop), ("seeded_shuffle", run_pipe)]:
+        baseline = None
+        for rng in ["python", "numpy"]:
+            secs = min(timeit.repeat(run(rng), number=1, repeat=args.repeat))
+            baseline = baseline or secs
+            print(f"{name:>16}, rng={rng:<6}: {args.num_items / secs / 1e6:8.2f} M items/s  ({baseline / secs:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# Measures the throughput of each part of the pipeline on a synthetic Pile-like corpus (see synthetic_corpus.py), and
+# writes the results as JSON so that they can be compared across commits. Runs offline: the tokenizer is trained on
+# the synthetic corpus rather than downloaded.
+#
+# * read_lm_text_file/FORMAT: docs/s reading every shard of each format (jsonl, jsonl.zst, jsonl.gz, txt, owt)
+# * concatenate_and_group_texts/{lists,np}: tokens/s grouping pre-tokenized batches into seq_len sequences
+# * seeded_shuffle: items/s through a SeededShufflerIterDataPipe
+# * flat_shard_by_rank/world_size=N: docs/s of load_corpus for each rank in turn, with RANK and WORLD_SIZE set
+# * load_corpus+tokenize_and_group_texts/FORMAT: tokens/s end to end
+#
+# Usage: python benchmarks/suite.py [--output results.json] [--compare baseline.json] [--only REGEX]
+#            [--corpus_dir DIR] [--num_shards 4] [--docs_per_shard 1000] [--mean_doc_chars 2000]
+import argparse
+import contextlib
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import torch
+from torchdata.datapipes.iter import IterableWrapper
+
+import sprucfluo as sf
+from sprucfluo.text import concatenate_and_group_texts, read_lm_text_file
+
+from synthetic_corpus import FORMATS, local_tokenizer, write_corpus
+
+# the counts that get a rate
+_COUNTS = ("tokens", "docs", "items", "chars", "sequences")
+# the metric that --compare compares, for each kind of result
+_RATE_KEYS = ("tokens_per_sec", "docs_per_sec", "items_per_sec")
+# shown too, but not compared: a txt shard is a single document, so chars/s means more there
+_SHOWN_KEYS = _RATE_KEYS + ("chars_per_sec",)
+
+
+@contextlib.contextmanager
+def env(**values):
+    orig = {k: os.environ.get(k) for k in values}
+    os.environ.update({k: str(v) for k, v in values.items()})
+    try:
+        yield
+    finally:
+        for k, v in orig.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+
+
+def best_of(repeat: int, run: Callable[[], Dict[str, int]]) -> Tuple[float, Dict[str, int]]:
+    """Runs run repeat times, and returns the fastest time and the counts it returned"""
+    best, counts = float("inf"), {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        counts = run()
+        best = min(best, time.perf_counter() - start)
+    return best, counts
+
+
+def rates(secs: float, counts: Dict[str, int]) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"secs": secs, **counts}
+    for name, count in counts.items():
+        if name in _COUNTS:
+            result[f"{name}_per_sec"] = count / secs
+    return result
+
+
+def read_shards(paths: List[str]) -> Dict[str, int]:
+    docs = chars = 0
+    for path, stream in IterableWrapper(paths).open_file_by_fsspec_fancy(mode="rb", compression="infer"):
+        for text in read_lm_text_file(path, stream):
+            docs += 1
+            chars += len(text)
+        stream.close()
+    return {"docs": docs, "chars": chars}
+
+
+def tokenized_batches(paths: List[str], tokenizer, batch_size: int) -> List[Any]:
+    texts = list(sf.load_corpus(paths, shard_by_rank=False))
+    return [tokenizer(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)]
+
+
+def count_tokens(pipe: Iterator) -> Dict[str, int]:
+    sequences = tokens = 0
+    for item in pipe:
+        sequences += 1
+        tokens += sf.mixing.num_tokens(item)
+    return {"sequences": sequences, "tokens": tokens}
+
+
+def run_suite(args, paths: Dict[str, List[str]], formats: List[str], tokenizer) -> Dict[str, Dict[str, Any]]:
+    benchmarks: List[Tuple[str, Callable[[], Dict[str, int]]]] = []
+
+    for fmt in formats:
+        benchmarks.append((f"read_lm_text_file/{fmt}", lambda fmt_paths=paths[fmt]: read_shards(fmt_paths)))
+
+    if any(re.search(args.only, f"concatenate_and_group_texts/{kind}") for kind in ("lists", "np")):
+        batches = tokenized_batches(paths["jsonl"], tokenizer, args.batch_size)
+        for kind, return_tensors in [("lists", None), ("np", "np")]:
+            def group(return_tensors=return_tensors):
+                sequences = 0
+                for batch in batches:
+                    for seq in concatenate_and_group_texts(batch, args.seq_len, return_tensors=return_tensors):
+                        sequences += len(seq["input_ids"]) if return_tensors else 1
+                return {"sequences": sequences, "tokens": sum(sf.mixing.num_tokens(b) for b in batches)}
+            benchmarks.append((f"concatenate_and_group_texts/{kind}", group))
+
+    items = list(range(args.shuffle_items))
+    benchmarks.append(("seeded_shuffle", lambda: {
+        "items": sum(1 for _ in IterableWrapper(items, deepcopy=False).seeded_shuffle(0, buffer_size=args.buffer_size))
+    }))
+
+    for world_size in args.world_sizes:
+        def all_ranks(world_size=world_size):
+            docs = []
+            for rank in range(world_size):
+                with env(RANK=rank, WORLD_SIZE=world_size):
+                    docs.append(sum(1 for _ in sf.load_corpus(paths["jsonl"])))
+            return {"docs": sum(docs), "min_rank_docs": min(docs), "max_rank_docs": max(docs)}
+        benchmarks.append((f"flat_shard_by_rank/world_size={world_size}", all_ranks))
+
+    for fmt in formats:
+        def end_to_end(fmt_paths=paths[fmt]):
+            pipe = sf.load_corpus(fmt_paths, shard_by_rank=False).then(
+                sf.tokenize_and_group_texts, tokenizer, seq_len=args.seq_len, batch_size=args.batch_size)
+            return count_tokens(pipe)
+        benchmarks.append((f"load_corpus+tokenize_and_group_texts/{fmt}", end_to_end))
+
+    results = {}
+    for name, run in benchmarks:
+        if not re.search(args.only, name):
+            continue
+        secs, counts = best_of(args.repeat, run)
+        results[name] = rates(secs, counts)
+        print(f"{name:>50}: {summary(results[name])}", flush=True)
+    return results
+
+
+def summary(result: Dict[str, Any]) -> str:
+    parts = [f"{result[k]:12.0f} {k.replace('_per_sec', '/s')}" for k in _SHOWN_KEYS if k in result]
+    return "  ".join(parts) + f"  ({result['secs']:.2f}s)"
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]]) -> None:
+    print("\nCompared to the baseline:")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        key = next(k for k in _RATE_KEYS if k in result)
+        if key in baseline[name]:
+            print(f"{name:>50}: {result[key] / baseline[name][key]:6.2f}x {key}")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on a synthetic corpus")
+    parser.add_argument("--output", help="Where to write the results as JSON")
+    parser.add_argument("--compare", help="Results from an earlier run to compare against")
+    parser.add_argument("--only", default="", help="Only run the benchmarks whose names match this regex")
+    parser.add_argument("--corpus_dir", help="Where to write (or reuse) the corpus. Defaults to a temporary directory")
+    parser.add_argument("--formats", default=",".join(FORMATS))
+    parser.add_argument("--num_shards", type=int, default=4)
+    parser.add_argument("--docs_per_shard", type=int, default=1000)
+    parser.add_argument("--mean_doc_chars", type=int, default=2000)
+    parser.add_argument("--vocab_size", type=int, default=8000)
+    parser.add_argument("--seq_len", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--shuffle_items", type=int, default=200_000)
+    parser.add_argument("--buffer_size", type=int, default=10000)
+    parser.add_argument("--world_sizes", type=lambda s: [int(x) for x in s.split(",")], default=[2, 3])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # before the tokenizer starts its threads, since these fork
+    meta = {"commit": git_commit(), "python": sys.version.split()[0], "torch": torch.__version__,
+            "platform": platform.platform()}
+    formats = args.formats.split(",")
+    # grouping and sharding read the plain jsonl shards
+    written = formats if "jsonl" in formats else ["jsonl"] + formats
+
+    with contextlib.ExitStack() as stack:
+        corpus_dir = args.corpus_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        paths = write_corpus(corpus_dir, written, args.num_shards, args.docs_per_shard, args.mean_doc_chars)
+        tokenizer = local_tokenizer(args.vocab_size, mean_doc_chars=args.mean_doc_chars, save_dir=corpus_dir)
+        for fmt, fmt_paths in paths.items():
+            size_mb = sum(os.path.getsize(p) for p in fmt_paths) / 1e6
+            print(f"{fmt:>10}: {len(fmt_paths)} shards, {size_mb:.1f} MB")
+        results = run_suite(args, paths, formats, tokenizer)
+
+    output = {
+        **meta,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "args": vars(args),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == "__main__":
+    main()
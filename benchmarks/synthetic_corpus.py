@@ -0,0 +1,146 @@
+# Writes a synthetic Pile-like corpus, in every format sprucfluo reads, and builds a tokenizer for it without
+# downloading anything. Used by benchmarks/suite.py, and can also be run by itself to keep a corpus around.
+#
+# Usage: python benchmarks/synthetic_corpus.py OUT_DIR [--formats jsonl,jsonl.zst] [--num_shards 4]
+#            [--docs_per_shard 1000] [--mean_doc_chars 2000]
+import argparse
+import gzip
+import io
+import json
+import lzma
+import os
+import random
+import tarfile
+from typing import Dict, List, Optional
+
+from jsonl_bench import synthetic_pile_doc
+
+FORMATS = ["jsonl", "jsonl.zst", "jsonl.gz", "txt", "owt"]
+
+
+def synthetic_docs(num_docs: int, mean_chars: int, seed: int = 0) -> List[dict]:
+    rng = random.Random(seed)
+    return [synthetic_pile_doc(rng, mean_chars) for _ in range(num_docs)]
+
+
+def _jsonl_bytes(docs: List[dict]) -> bytes:
+    return "".join(json.dumps(doc) + "\n" for doc in docs).encode("utf-8")
+
+
+def _owt_bytes(docs: List[dict]) -> bytes:
+    """An OpenWebText subset: an xz'd tar of one text file per document"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for i, doc in enumerate(docs):
+            data = doc["text"].encode("utf-8")
+            info = tarfile.TarInfo(f"{i:07d}.txt")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return lzma.compress(buffer.getvalue())
+
+
+def write_shard(path: str, fmt: str, docs: List[dict]) -> None:
+    if fmt == "jsonl":
+        data = _jsonl_bytes(docs)
+    elif fmt == "jsonl.gz":
+        data = gzip.compress(_jsonl_bytes(docs), compresslevel=6)
+    elif fmt == "jsonl.zst":
+        import zstandard
+        data = zstandard.ZstdCompressor(level=3).compress(_jsonl_bytes(docs))
+    elif fmt == "txt":
+        # a txt shard is a single document
+        data = "\n\n".join(doc["text"] for doc in docs).encode("utf-8")
+    elif fmt == "owt":
+        data = _owt_bytes(docs)
+    else:
+        raise ValueError(f"Unknown format {fmt}, should be one of {FORMATS}")
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def shard_path(out_dir: str, fmt: str, i: int) -> str:
+    if fmt == "owt":
+        # read_lm_text_file recognizes OpenWebText subsets by name
+        return os.path.join(out_dir, "owt", f"urlsf_subset{i:02d}-1_data.xz")
+    return os.path.join(out_dir, fmt.replace(".", "_"), f"shard_{i:03d}.{fmt}")
+
+
+def write_corpus(out_dir: str,
+                 formats: List[str] = FORMATS,
+                 num_shards: int = 4,
+                 docs_per_shard: int = 1000,
+                 mean_doc_chars: int = 2000,
+                 seed: int = 0) -> Dict[str, List[str]]:
+    """Writes num_shards shards of each format, with the same documents in each format. Returns the paths by format.
+    Shards written before with the same settings are left alone, so that a corpus can be reused."""
+    os.makedirs(out_dir, exist_ok=True)
+    settings = {"docs_per_shard": docs_per_shard, "mean_doc_chars": mean_doc_chars, "seed": seed}
+    settings_path = os.path.join(out_dir, "corpus.json")
+    reuse = False
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            reuse = json.load(f) == settings
+
+    paths: Dict[str, List[str]] = {fmt: [] for fmt in formats}
+    for i in range(num_shards):
+        docs = None
+        for fmt in formats:
+            path = shard_path(out_dir, fmt, i)
+            paths[fmt].append(path)
+            if reuse and os.path.exists(path):
+                continue
+            if docs is None:
+                docs = synthetic_docs(docs_per_shard, mean_doc_chars, seed=seed * 1000003 + i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_shard(path, fmt, docs)
+    with open(settings_path, "w") as f:
+        json.dump(settings, f)
+    return paths
+
+
+def local_tokenizer(vocab_size: int = 8000, num_docs: int = 200, mean_doc_chars: int = 2000, seed: int = 0,
+                    save_dir: Optional[str] = None):
+    """
+    A byte-level BPE tokenizer (like gpt2's), trained on synthetic documents, so nothing needs to be downloaded. If
+    save_dir is given, it's saved there, and loaded from there next time.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import AutoTokenizer, PreTrainedTokenizerFast
+
+    if save_dir is not None:
+        save_dir = os.path.join(save_dir, f"tokenizer-{vocab_size}-{num_docs}-{mean_doc_chars}-{seed}")
+        if os.path.exists(save_dir):
+            return AutoTokenizer.from_pretrained(save_dir)
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=["<|endoftext|>"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), show_progress=False)
+    tokenizer.train_from_iterator((doc["text"] for doc in synthetic_docs(num_docs, mean_doc_chars, seed)), trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>",
+                                        model_max_length=int(1e30))
+    if save_dir is not None:
+        tokenizer.save_pretrained(save_dir)
+    return tokenizer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic Pile-like corpus")
+    parser.add_argument("out_dir")
+    parser.add_argument("--formats", default=",".join(FORMATS))
+    parser.add_argument("--num_shards", type=int, default=4)
+    parser.add_argument("--docs_per_shard", type=int, default=1000)
+    parser.add_argument("--mean_doc_chars", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths = write_corpus(args.out_dir, args.formats.split(","), args.num_shards, args.docs_per_shard,
+                         args.mean_doc_chars, args.seed)
+    for fmt, fmt_paths in paths.items():
+        size_mb = sum(os.path.getsize(p) for p in fmt_paths) / 1e6
+        print(f"{fmt:>10}: {len(fmt_paths)} shards, {size_mb:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
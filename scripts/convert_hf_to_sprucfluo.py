@@ -3,12 +3,11 @@
 # how to use.
 
 # we also create a huggingface-compatible dataset for the sprucfluo dataset so we can re-upload it to huggingface...
-import copy
 import json
 import os
 import re
-import shutil
-from typing import Dict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional
 import tqdm
 
 import jinja2
@@ -22,52 +21,67 @@ import zstandard as zstd
 _my_dir = os.path.dirname(os.path.realpath(__file__))
 
 
+# (pattern, replacement) in the order they're applied: strings are replaced as is, and regexes are precompiled.
+# Taken from https://github.com/NVIDIA/Megatron-LM/blob/main/tasks/zeroshot_gpt2/detokenizer.py
+_WIKITEXT_STEPS = [
+    # Contractions
+    ("s '", "s'"),
+    (re.compile(r"/' [0-9]/"), r"/'[0-9]/"),
+    # Number Separators
+    (" @-@ ", "-"),
+    (" @,@ ", ","),
+    (" @.@ ", "."),
+    # Punctuation
+    (" : ", ": "),
+    (" ; ", "; "),
+    (" . ", ". "),
+    (" ! ", "! "),
+    (" ? ", "? "),
+    (" , ", ", "),
+    # Double Brackets
+    (re.compile(r"\(\s*([^\)]*?)\s*\)"), r"(\1)"),
+    (re.compile(r"\[\s*([^\]]*?)\s*\]"), r"[\1]"),
+    (re.compile(r"{\s*([^}]*?)\s*}"), r"{\1}"),
+    (re.compile(r"\"\s*([^\"]*?)\s*\""), r'"\1"'),
+    (re.compile(r"'\s*([^']*?)\s*'"), r"'\1'"),
+    # Miscellaneous
+    ("= = = =", "===="),
+    ("= = =", "==="),
+    ("= =", "=="),
+    (" " + chr(176) + " ", chr(176)),
+    (" \n", "\n"),
+    ("\n ", "\n"),
+    (" N ", " 1 "),
+    (" 's", "'s"),
+]
+
+
+def _wikitext_detokenize_text(text: str) -> str:
+    for pattern, replacement in _WIKITEXT_STEPS:
+        if isinstance(pattern, str):
+            text = text.replace(pattern, replacement)
+        else:
+            text = pattern.sub(replacement, text)
+    return text
+
+
 def wikitext_detokenize(example: Dict[str, str]) -> Dict[str, str]:
     """
     Wikitext is whitespace tokenized and we remove these whitespaces.
 
     Taken from https://github.com/NVIDIA/Megatron-LM/blob/main/tasks/zeroshot_gpt2/detokenizer.py
     """
-    # Contractions
-    text = example["text"]
-    text = text.replace("s '", "s'")
-    text = re.sub(r"/' [0-9]/", r"/'[0-9]/", text)
-
-    # Number Separators
-    text = text.replace(" @-@ ", "-")
-    text = text.replace(" @,@ ", ",")
-    text = text.replace(" @.@ ", ".")
-
-    # Punctuation
-    text = text.replace(" : ", ": ")
-    text = text.replace(" ; ", "; ")
-    text = text.replace(" . ", ". ")
-    text = text.replace(" ! ", "! ")
-    text = text.replace(" ? ", "? ")
-    text = text.replace(" , ", ", ")
+    return {"text": _wikitext_detokenize_text(example["text"])}
 
-    # Double Brackets
-    text = re.sub(r"\(\s*([^\)]*?)\s*\)", r"(\1)", text)
-    text = re.sub(r"\[\s*([^\]]*?)\s*\]", r"[\1]", text)
-    text = re.sub(r"{\s*([^}]*?)\s*}", r"{\1}", text)
-    text = re.sub(r"\"\s*([^\"]*?)\s*\"", r'"\1"', text)
-    text = re.sub(r"'\s*([^']*?)\s*'", r"'\1'", text)
-
-    # Miscellaneous
-    text = text.replace("= = = =", "====")
-    text = text.replace("= = =", "===")
-    text = text.replace("= =", "==")
-    text = text.replace(" " + chr(176) + " ", chr(176))
-    text = text.replace(" \n", "\n")
-    text = text.replace("\n ", "\n")
-    text = text.replace(" N ", " 1 ")
-    text = text.replace(" 's", "'s")
 
-    return {"text": text}
+def wikitext_detokenize_batch(texts: List[str]) -> List[str]:
+    """wikitext_detokenize for a batch of texts"""
+    return [_wikitext_detokenize_text(text) for text in texts]
 
 
-DATASET_TOKENIZATION_REGISTRY = {
-    "wikitext": wikitext_detokenize,
+# detokenizers for batches of texts
+DATASET_TOKENIZATION_REGISTRY: Dict[str, Callable[[List[str]], List[str]]] = {
+    "wikitext": wikitext_detokenize_batch,
 }
 
 
@@ -79,6 +93,14 @@ def main():
     parser.add_argument("--output", type=str, required=True, help="output directory")
     parser.add_argument("--num_shards", type=int, default=1, help="number of shards to split the (train) dataset into")
     parser.add_argument("--level", type=int, default=9, help="compression level")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(),
+                        help="number of processes writing shards at once")
+    parser.add_argument("--zstd_threads", type=int, default=None,
+                        help="compression threads per shard. Defaults to splitting the cores between the workers")
+    parser.add_argument("--frame_mb", type=float, default=None,
+                        help="write each shard as zstd frames of about this many (uncompressed) MB, ending at line "
+                             "boundaries, with a sprucfluo index, so that it can be read from any frame")
+    parser.add_argument("--batch_size", type=int, default=1000, help="number of examples to read at once")
     parser.add_argument("--upload", action="store_true", help="upload the dataset to huggingface", default=False)
 
     args = parser.parse_args()
@@ -105,15 +127,38 @@ def main():
         },
     }
 
-    # Step 1: generate data
+    # Step 1: generate data, a shard per worker at a time
+    jobs = []
     for split, data in dataset.items():
         num_shards = args.num_shards if split == Split.TRAIN else 1
-        out_dir = os.path.join(args.output, f"data/{split}")
-        os.makedirs(out_dir, exist_ok=True)
-
-        split_metadata = write_split(split, data, args.output, f"data/{split}", detokenizer, num_shards, args.level)
-
-        metadata["splits"][split] = split_metadata
+        os.makedirs(os.path.join(args.output, f"data/{split}"), exist_ok=True)
+        for index, path in enumerate(shard_paths(split, f"data/{split}", num_shards)):
+            jobs.append(ShardJob(split, data, num_shards, index, path))
+
+    num_workers = max(1, min(args.num_workers, len(jobs)))
+    zstd_threads = args.zstd_threads
+    if zstd_threads is None:
+        zstd_threads = max((os.cpu_count() or 1) // num_workers, 1)
+    frame_bytes = None if args.frame_mb is None else int(args.frame_mb * (1 << 20))
+
+    results = {}
+    with ProcessPoolExecutor(num_workers) as executor:
+        futures = [executor.submit(write_shard, job, args.output, args.dataset, args.level, zstd_threads, frame_bytes,
+                                   args.batch_size)
+                   for job in jobs]
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures), desc="Writing shards"):
+            result = future.result()
+            results[result["file"]] = result
+
+    for split in dataset:
+        files = [job.path for job in jobs if job.split == split]
+        metadata["splits"][split] = {
+            "files": files,
+            "num_docs": [results[f]["num_docs"] for f in files],
+            "total_docs": sum(results[f]["num_docs"] for f in files),
+        }
+        if frame_bytes is not None:
+            metadata["splits"][split]["frame_bytes"] = frame_bytes
 
     # Step 2: format and write template
     template = open(os.path.join(_my_dir, "dataset.py.template"), "r").read()
@@ -163,29 +208,119 @@ def main():
                 json.dump(final_urls, f, indent=2)
 
 
-def write_split(split, dataset: Dataset, base_dir, out_dir, detokenizer, num_shards, compression_level):
-    split_metadata = {}
+def shard_paths(split, out_dir, num_shards) -> List[str]:
     if num_shards == 1:
-        all_files = [f"{out_dir}/{split}.jsonl.zst"]
+        return [f"{out_dir}/{split}.jsonl.zst"]
     else:
-        all_files = [f"{out_dir}/{split}_{i}_of_{num_shards}.jsonl.zst" for i in range(num_shards)]
+        return [f"{out_dir}/{split}_{i}_of_{num_shards}.jsonl.zst" for i in range(num_shards)]
+
 
-    opened = [zstd.open(os.path.join(base_dir, f), mode='w', cctx=zstd.ZstdCompressor(level=compression_level)) for f in
-              all_files]
+class ShardJob:
+    """Shard index of num_shards of a split: the examples i with i % num_shards == index, written to path"""
+
+    def __init__(self, split: str, dataset: Dataset, num_shards: int, index: int, path: str):
+        self.split = split
+        self.dataset = dataset
+        self.num_shards = num_shards
+        self.index = index
+        self.path = path
+
+
+class _ShardWriter:
+    """
+    Writes lines of jsonl to a zstd file: as one frame (streamed), or if frame_bytes is given, as frames of about
+    frame_bytes of whole lines each, keeping track of where they start for the index.
+
+    As a context manager, it closes the file on the way out, and deletes it (and its index) if there was an error, so
+    a failed job doesn't leave a truncated shard behind.
+    """
 
-    try:
-        for i, item in enumerate(tqdm.tqdm(dataset, desc=f"Writing {split}")):
+    def __init__(self, path: str, level: int, threads: int, frame_bytes: Optional[int]):
+        self.path = path
+        # threads=0 compresses on this thread; 1 or more compresses on that many others
+        self.cctx = zstd.ZstdCompressor(level=level, threads=threads if threads > 1 else 0)
+        self.frame_bytes = frame_bytes
+        self.num_docs = 0
+        if frame_bytes is None:
+            self.file = zstd.open(path, mode="wb", cctx=self.cctx)
+        else:
+            self.file = open(path, "wb")
+            self.pending: List[bytes] = []
+            self.pending_bytes = 0
+            self.pending_docs = 0
+            # (compressed offset, decompressed bytes to skip, document) of each frame, as in sprucfluo.index
+            self.checkpoints = []
+
+    def write_lines(self, lines: List[str]) -> None:
+        if self.frame_bytes is None:
+            self.file.write("".join(lines).encode("utf-8"))
+            self.num_docs += len(lines)
+            return
+        for line in lines:
+            data = line.encode("utf-8")
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+            self.pending_docs += 1
+            if self.pending_bytes >= self.frame_bytes:
+                self._write_frame()
+
+    def _write_frame(self) -> None:
+        self.checkpoints.append((self.file.tell(), 0, self.num_docs))
+        self.file.write(self.cctx.compress(b"".join(self.pending)))
+        self.num_docs += self.pending_docs
+        self.pending, self.pending_bytes, self.pending_docs = [], 0, 0
+
+    def close(self) -> None:
+        if self.frame_bytes is not None:
+            if self.pending:
+                self._write_frame()
+            from sprucfluo.index import ShardIndex, write_index
+            write_index(self.path, ShardIndex(self.num_docs, "zstd", self.checkpoints or [(0, 0, 0)]))
+        self.file.close()
+
+    def __enter__(self) -> "_ShardWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None:
+            self._delete()
+            return
+        try:
+            self.close()
+        except BaseException:
+            self._delete()
+            raise
+
+    def _delete(self) -> None:
+        from sprucfluo.index import INDEX_SUFFIX
+        try:
+            self.file.close()
+        except Exception:
+            pass  # it's being deleted anyway
+        for path in [self.path, self.path + INDEX_SUFFIX]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def write_shard(job: ShardJob, base_dir: str, dataset_name: str, compression_level: int, zstd_threads: int,
+                frame_bytes: Optional[int], batch_size: int) -> Dict[str, Any]:
+    """Writes a shard of a split (in a worker process). Returns its file and number of documents."""
+    detokenizer = DATASET_TOKENIZATION_REGISTRY.get(dataset_name, None)
+    data = job.dataset
+    if job.num_shards > 1:
+        # the same examples as round-robin over the whole split
+        data = data.shard(job.num_shards, job.index, contiguous=False)
+
+    path = os.path.join(base_dir, job.path)
+    with _ShardWriter(path, compression_level, zstd_threads, frame_bytes) as writer:
+        for start in range(0, len(data), batch_size):
+            batch = data[start:start + batch_size]
             if detokenizer:
-                item = detokenizer(item)
-            if len(item['text']) == 0:
-                continue
-            shard = i % num_shards
-            opened[shard].write(json.dumps(item) + '\n')
-    finally:
-        for f in opened:
-            f.close()
-    split_metadata["files"] = all_files
-    return split_metadata
+                items = [{"text": text} for text in detokenizer(batch["text"])]
+            else:
+                items = [dict(zip(batch.keys(), values)) for values in zip(*batch.values())]
+            writer.write_lines([json.dumps(item) + '\n' for item in items if len(item['text']) > 0])
+    return {"file": job.path, "num_docs": writer.num_docs}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+# Builds the sidecar indexes (see sprucfluo/index.py) for a set of jsonl shards, so that they can be opened at any
+# document, split across ranks, and counted without reading them.
+#
+# zstd and gzip shards can only be entered at the start of a frame/member, and most tools write a single one. With
+# --frame_mb, shards are first rewritten into frames/members of about that size, ending at line boundaries, e.g.
+#
+#   python scripts/index_shards.py 'data/pile_cc/train-{00..29}.jsonl.zst' --frame_mb 16 --out_dir data/pile_cc_framed
+import argparse
+import gzip
+import os
+
+import fsspec
+import fsspec.core
+import fsspec.utils
+from braceexpand import braceexpand
+
+from sprucfluo.index import build_index, write_index, DEFAULT_CHECKPOINT_BYTES
+
+
+def _compress_frame(data: bytes, compression: str) -> bytes:
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    elif compression == "gzip":
+        return gzip.compress(data)
+    raise ValueError(f"Can't write frames with compression {compression}")
+
+
+def rewrite_framed(in_url: str, out_url: str, frame_bytes: int) -> None:
+    """Copies in_url to out_url, compressing every frame_bytes or so of whole lines as its own frame/member"""
+    compression = fsspec.utils.infer_compression(out_url)
+    with fsspec.open(in_url, mode="rb", compression="infer") as f_in, fsspec.open(out_url, mode="wb") as f_out:
+        pending = b""
+        while True:
+            block = f_in.read(frame_bytes)
+            if not block:
+                break
+            pending += block
+            end = pending.rfind(b"\n") + 1
+            if end >= frame_bytes:
+                f_out.write(_compress_frame(pending[:end], compression))
+                pending = pending[end:]
+        if pending:
+            f_out.write(_compress_frame(pending, compression))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build sidecar document indexes for jsonl shards")
+    parser.add_argument("paths", nargs="+", help="shards to index; braceexpanded")
+    parser.add_argument("--checkpoint_mb", type=float, default=DEFAULT_CHECKPOINT_BYTES / (1 << 20),
+                        help="minimum (uncompressed) distance between seek points")
+    parser.add_argument("--frame_mb", type=float, default=None,
+                        help="rewrite compressed shards into frames of about this many (uncompressed) MB first")
+    parser.add_argument("--out_dir", default=None, help="where to write rewritten shards. Required with --frame_mb")
+    args = parser.parse_args()
+
+    if args.frame_mb is not None and args.out_dir is None:
+        parser.error("--frame_mb needs --out_dir")
+
+    if args.out_dir is not None:
+        fs, out_dir = fsspec.core.url_to_fs(args.out_dir)
+        fs.makedirs(out_dir, exist_ok=True)
+
+    checkpoint_bytes = int(args.checkpoint_mb * (1 << 20))
+    for path in (p for arg in args.paths for p in braceexpand(arg)):
+        if args.frame_mb is not None and fsspec.utils.infer_compression(path) is not None:
+            out_path = os.path.join(args.out_dir, os.path.basename(path))
+            print(f"Rewriting {path} to {out_path}")
+            rewrite_framed(path, out_path, int(args.frame_mb * (1 << 20)))
+            path = out_path
+        index = build_index(path, checkpoint_bytes=checkpoint_bytes)
+        write_index(path, index)
+        print(f"{path}: {index.num_docs} documents, {len(index.checkpoints)} seek points")
+
+
+if __name__ == "__main__":
+    main()
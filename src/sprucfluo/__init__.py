@@ -15,12 +15,21 @@ from typing import TypeVar, List, Union
 
 from torch.utils.data import IterDataPipe
 
-from .files import FancyFSSpecFileOpenerIterDataPipe, expand_paths
-from .sharding import ShardByRankDataPipe
-from .text import concatenate_and_group_texts, tokenize_and_group_texts, read_lm_text_file
-from .corpus import load_corpus
-from .shuffle import SeededShufflerIterDataPipe
+from .files import FancyFSSpecFileOpenerIterDataPipe, GlobExpanderIterDataPipe, expand_paths, iter_glob, shard_sizes
+from .sharding import ShardByRankDataPipe, FlatShardByRankDataPipe, EqualLengthIterDataPipe, lpt_partition
+from .text import concatenate_and_group_texts, tokenize_and_group_texts, read_lm_text_file, GroupTextsIterDataPipe, \
+    LMTextFileReaderIterDataPipe
+from .batching import TensorBatcherIterDataPipe, collate_tensor_batches
+from .packing import PackTextsIterDataPipe, best_fit_decreasing
+from .corpus import load_corpus, load_tokenized_corpus
+from .mixing import TokenMixtureIterDataPipe, mix_corpora
+from .shuffle import SeededShufflerIterDataPipe, ShardShufflerIterDataPipe, ShardInterleaverIterDataPipe, set_epoch
 from .slicing import SliceIterDataPipe
+from .parallel import ParallelMapperIterDataPipe
+from .token_cache import TokenCacheIterDataPipe, tokenizer_fingerprint
+from .checkpoint import pipeline_state_dict, load_pipeline_state_dict
+from .instrument import instrument, InstrumentedIterDataPipe, PipelineStats, log_hook, tensorboard_hook
+from .index import DocumentRange, ByteRange, build_index, load_index, write_index
 
 
 _T = TypeVar("_T", contravariant=True)
@@ -46,12 +55,45 @@ def init():
 __all__ = [
     'FancyFSSpecFileOpenerIterDataPipe',
     'concatenate_and_group_texts',
+    'GroupTextsIterDataPipe',
     'read_lm_text_file',
+    'LMTextFileReaderIterDataPipe',
     'tokenize_and_group_texts',
+    'TensorBatcherIterDataPipe',
+    'collate_tensor_batches',
+    'PackTextsIterDataPipe',
+    'best_fit_decreasing',
     'ShardByRankDataPipe',
+    'FlatShardByRankDataPipe',
+    'lpt_partition',
+    'EqualLengthIterDataPipe',
     'expand_paths',
+    'iter_glob',
+    'shard_sizes',
+    'GlobExpanderIterDataPipe',
     'SeededShufflerIterDataPipe',
+    'ShardShufflerIterDataPipe',
+    'ShardInterleaverIterDataPipe',
+    'set_epoch',
     'SliceIterDataPipe',
+    'ParallelMapperIterDataPipe',
+    'load_tokenized_corpus',
+    'TokenMixtureIterDataPipe',
+    'mix_corpora',
+    'TokenCacheIterDataPipe',
+    'tokenizer_fingerprint',
+    'pipeline_state_dict',
+    'load_pipeline_state_dict',
+    'instrument',
+    'InstrumentedIterDataPipe',
+    'PipelineStats',
+    'log_hook',
+    'tensorboard_hook',
+    'DocumentRange',
+    'ByteRange',
+    'build_index',
+    'load_index',
+    'write_index',
 ]
 
 init()
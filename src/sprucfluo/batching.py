@@ -0,0 +1,187 @@
+# Copyright 2022 The Board of Trustees of the Leland Stanford Junior University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fixed-shape tensor batches of grouped sequences, ready for the model"""
+from __future__ import annotations
+
+from typing import Any, Dict, Iterator, List, Optional, TYPE_CHECKING
+
+import numpy as np
+import torch
+from torch.utils.data import functional_datapipe, IterDataPipe
+
+from .checkpoint import Checkpointable, iter_source, source_state_dict
+from .encoding import batch_encoding
+
+if TYPE_CHECKING:
+    from transformers import BatchEncoding
+
+# -100 is pytorch's label mask
+_IGNORE_INDEX = -100
+
+
+@functional_datapipe("tensor_batches")
+class TensorBatcherIterDataPipe(Checkpointable, IterDataPipe["BatchEncoding"]):
+    r"""
+    Batches grouped sequences (from group_texts or tokenize_and_group_texts) into BatchEncodings of [batch_size,
+    seq_len] tensors: input_ids, attention_mask and labels, and position_ids if the input has them (e.g. from
+    pack_texts). Labels are the input's labels if it has them (e.g. with stride masking) and input_ids otherwise, with
+    -100 wherever attention_mask is 0. Other keys are dropped.
+
+    The sequences can come one at a time, or stacked (return_tensors="np"), which is much faster: the rows are copied
+    straight from the concatenated tokens into the batch's tensors, with no Python lists in between. Sequences shorter
+    than seq_len (the end of the stream, with drop_remainder=False) are padded with pad_token_id.
+
+    Every batch is the same shape: if drop_last is False, the last batch is padded with empty rows, which are all
+    padding. Use collate_tensor_batches (or batch_size=None) in the DataLoader, since the batches are already
+    collated.
+
+    With pin_memory, the tensors are allocated in pinned memory, so that copying them to the GPU can be asynchronous.
+    That only helps in the process that does the copying: memory that DataLoader workers pin isn't pinned by the time
+    it gets to the main process, so with workers use DataLoader(pin_memory=True) instead.
+
+    It's checkpointable: its state is the sequences that have been read but not yet emitted, and the state of the
+    source.
+
+    Args:
+        source_datapipe: The pipe of grouped sequences, one at a time or stacked.
+        batch_size: The number of sequences in each batch.
+        seq_len: The length of the sequences.
+        dtype: The dtype of the tensors, e.g. torch.long or torch.int32.
+        pad_token_id: The input_id to pad with.
+        drop_last: Whether to drop the last batch if it isn't full, or pad it.
+        pin_memory: Whether to allocate the tensors in pinned memory.
+    """
+    _pending: Optional[List[Dict[str, np.ndarray]]] = None
+    _num_pulled: int = 0
+
+    def __init__(self,
+                 source_datapipe: IterDataPipe[BatchEncoding],
+                 batch_size: int,
+                 seq_len: int,
+                 dtype: torch.dtype = torch.long,
+                 pad_token_id: int = 0,
+                 drop_last: bool = True,
+                 pin_memory: bool = False) -> None:
+        assert batch_size > 0, "batch_size should be larger than 0"
+        self.source_datapipe = source_datapipe
+        self.batch_size = batch_size
+        self.seq_len = seq_len
+        self.dtype = dtype
+        self.pad_token_id = pad_token_id
+        self.drop_last = drop_last
+        self.pin_memory = pin_memory
+
+    def __iter__(self) -> Iterator[BatchEncoding]:
+        resume = self._pop_resume_state()
+        self._pending = pending = []
+        self._num_pulled = 0
+        source_state = None
+        if resume is not None:
+            pending.extend(resume["pending"])
+            self._num_pulled = resume["num_pulled"]
+            source_state = resume["source"]
+
+        num_pending = sum(len(rows["input_ids"]) for rows in pending)
+        # we might have resumed with more than a batch pending
+        while num_pending >= self.batch_size:
+            num_pending -= self.batch_size
+            yield self._take_batch(pending, self.batch_size)
+
+        for item in iter_source(self.source_datapipe, source_state):
+            self._num_pulled += 1
+            rows = self._rows(item)
+            pending.append(rows)
+            num_pending += len(rows["input_ids"])
+            while num_pending >= self.batch_size:
+                num_pending -= self.batch_size
+                yield self._take_batch(pending, self.batch_size)
+
+        if num_pending > 0 and not self.drop_last:
+            yield self._take_batch(pending, num_pending)
+
+    def _rows(self, item) -> Dict[str, np.ndarray]:
+        """The item as 2-d arrays of input_ids, attention_mask, labels (and position_ids), padded to seq_len"""
+        input_ids = _as_2d(item["input_ids"])
+        num_rows, length = input_ids.shape
+        if length > self.seq_len:
+            raise ValueError(f"Got sequences of length {length}, longer than seq_len ({self.seq_len})")
+        values = {
+            "input_ids": input_ids,
+            "attention_mask": _as_2d(item["attention_mask"]) if "attention_mask" in item else np.ones_like(input_ids),
+            "labels": _as_2d(item["labels"]) if "labels" in item else input_ids,
+        }
+        if "position_ids" in item:
+            values["position_ids"] = _as_2d(item["position_ids"])
+
+        if length == self.seq_len:
+            rows = values
+        else:
+            pad = self._padding()
+            rows = {k: np.full((num_rows, self.seq_len), pad[k], dtype=np.result_type(v.dtype, np.int8))
+                    for k, v in values.items()}
+            for k, v in values.items():
+                rows[k][:, :length] = v
+        if not rows["attention_mask"].all():
+            rows["labels"] = np.where(rows["attention_mask"] == 0, _IGNORE_INDEX, rows["labels"])
+        return rows
+
+    def _padding(self) -> Dict[str, int]:
+        return {"input_ids": self.pad_token_id, "attention_mask": 0, "labels": _IGNORE_INDEX, "position_ids": 0}
+
+    def _take_batch(self, pending: List[Dict[str, np.ndarray]], num_rows: int) -> BatchEncoding:
+        """Takes num_rows rows off the front of pending, into a new batch"""
+        keys = list(pending[0].keys())
+        batch = {k: torch.empty((self.batch_size, self.seq_len), dtype=self.dtype, pin_memory=self.pin_memory)
+                 for k in keys}
+        arrays = {k: v.numpy() for k, v in batch.items()}
+        filled = 0
+        while filled < num_rows:
+            rows = pending[0]
+            n = min(len(rows["input_ids"]), num_rows - filled)
+            for k in keys:
+                arrays[k][filled:filled + n] = rows[k][:n]
+            filled += n
+            if n == len(rows["input_ids"]):
+                pending.pop(0)
+            else:
+                pending[0] = {k: v[n:] for k, v in rows.items()}
+        if filled < self.batch_size:
+            pad = self._padding()
+            for k in keys:
+                arrays[k][filled:] = pad[k]
+        return batch_encoding(batch)
+
+    def _current_state(self) -> Dict[str, Any]:
+        return {
+            # copies, so that we don't keep (or pickle) the whole of the arrays they're views of
+            "pending": [{k: np.array(v) for k, v in rows.items()} for rows in self._pending or []],
+            "num_pulled": self._num_pulled,
+            "source": source_state_dict(self.source_datapipe, self._num_pulled),
+        }
+
+
+def _as_2d(values) -> np.ndarray:
+    if isinstance(values, torch.Tensor):
+        values = values.numpy()
+    array = np.asarray(values)
+    return array[None, :] if array.ndim == 1 else array
+
+
+def collate_tensor_batches(batch: BatchEncoding) -> BatchEncoding:
+    """A DataLoader collate_fn for batches that are already collated, like the ones from tensor_batches: it does
+    nothing. Use it with batch_size=None."""
+    return batch
+
+
+__all__ = ["TensorBatcherIterDataPipe", "collate_tensor_batches"]
@@ -0,0 +1,158 @@
+# Copyright 2022 The Board of Trustees of the Leland Stanford Junior University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Checkpointing for pipelines, so that a preempted job can resume where it was rather than from the beginning.
+
+A pipe is checkpointable if it has state_dict() and load_state_dict(state). state_dict() describes the position just
+after the last item the pipe yielded, so it should be called between items. load_state_dict(state) makes the next
+iteration of the pipe resume from that position. A checkpointable pipe includes the state of its source in its own,
+and it only needs to do so for the nearest checkpointable pipe upstream of it: pipes that don't buffer items, like
+map, filter and batch, are looked through. If there's no checkpointable pipe upstream, the source is resumed by
+skipping the number of items that had been pulled from it, which replays them unless the source can fast_forward.
+
+This module is an implementation detail of the pipes. Use pipeline_state_dict and load_pipeline_state_dict on the
+outermost pipe of a pipeline. With a DataLoader with workers, each worker has its own copy of the pipeline, so
+state has to be saved per worker.
+"""
+import copy
+from itertools import islice
+from typing import Any, Dict, Iterator, Optional, TypeVar, Sequence
+
+from torch.utils.data import IterDataPipe
+from torch.utils.data.datapipes.iter import Batcher, Filter, IterableWrapper, Mapper
+
+T_co = TypeVar('T_co', covariant=True)
+
+# pipes that have pulled exactly the items they've yielded, so the state of their source is theirs too. Other pipes
+# can say they're one of them with is_passthrough = True.
+_PASSTHROUGH_PIPES = (Mapper, Filter, Batcher)
+_SOURCE_ATTRS = ("source_datapipe", "datapipe", "iterable")
+
+
+def is_checkpointable(pipe) -> bool:
+    return callable(getattr(pipe, "state_dict", None)) and callable(getattr(pipe, "load_state_dict", None))
+
+
+def _upstream(pipe: IterDataPipe) -> Optional[IterDataPipe]:
+    for attr in _SOURCE_ATTRS:
+        source = getattr(pipe, attr, None)
+        if isinstance(source, IterDataPipe):
+            return source
+    return None
+
+
+def checkpointable_source(pipe: Optional[IterDataPipe]) -> Optional[IterDataPipe]:
+    """Finds pipe, or the nearest pipe upstream of it, that's checkpointable, looking through non-buffering pipes."""
+    while pipe is not None:
+        if is_checkpointable(pipe):
+            return pipe
+        if not (isinstance(pipe, _PASSTHROUGH_PIPES) or getattr(pipe, "is_passthrough", False)):
+            return None
+        pipe = _upstream(pipe)
+    return None
+
+
+def pipeline_state_dict(pipe: IterDataPipe) -> Dict[str, Any]:
+    """Returns the state of a pipeline, as of the last item it yielded."""
+    checkpointable = checkpointable_source(pipe)
+    if checkpointable is None:
+        raise ValueError(f"{type(pipe).__name__} isn't checkpointable, and neither is anything it reads from directly")
+    return checkpointable.state_dict()
+
+
+def load_pipeline_state_dict(pipe: IterDataPipe, state: Dict[str, Any]) -> None:
+    """Makes the next iteration over pipe resume from state, which should come from pipeline_state_dict."""
+    checkpointable = checkpointable_source(pipe)
+    if checkpointable is None:
+        raise ValueError(f"{type(pipe).__name__} isn't checkpointable, and neither is anything it reads from directly")
+    checkpointable.load_state_dict(state)
+
+
+def source_state_dict(source: IterDataPipe, num_pulled: int) -> Dict[str, Any]:
+    """The state of source, for a pipe that has pulled num_pulled items from it."""
+    checkpointable = checkpointable_source(source)
+    if checkpointable is not None:
+        return {"state": checkpointable.state_dict()}
+    return {"num_pulled": num_pulled}
+
+
+def iter_source(source: IterDataPipe[T_co], state: Optional[Dict[str, Any]]) -> Iterator[T_co]:
+    """Iterates over source, resuming from state (from source_state_dict) if it's not None."""
+    if state is None:
+        return iter(source)
+    if "state" in state:
+        checkpointable = checkpointable_source(source)
+        if checkpointable is None:
+            raise ValueError(f"Can't restore the state of {type(source).__name__}: it isn't checkpointable")
+        checkpointable.load_state_dict(state["state"])
+        return iter(source)
+    return fast_forward(source, state["num_pulled"]) or islice(iter(source), state["num_pulled"], None)
+
+
+def fast_forward(pipe: IterDataPipe[T_co], n: int) -> Optional[Iterator[T_co]]:
+    """
+    Returns an iterator over pipe that starts n items in, if pipe can get there without producing the first n items.
+    Otherwise, returns None.
+
+    Pipes opt in by defining skip(n), which returns such an iterator (or None, if they can't right now). Maps and
+    batches fast-forward if their source does, and so do IterableWrappers of sequences.
+    """
+    skip = getattr(pipe, "skip", None)
+    if callable(skip):
+        return skip(n)
+    if isinstance(pipe, Mapper):
+        it = fast_forward(pipe.datapipe, n)
+        return None if it is None else map(pipe._apply_fn, it)
+    if isinstance(pipe, Batcher):
+        it = fast_forward(pipe.datapipe, n * pipe.batch_size)
+        return None if it is None else _batched(it, pipe.batch_size, pipe.drop_last, pipe.wrapper_class)
+    if isinstance(pipe, IterableWrapper) and isinstance(pipe.iterable, Sequence):
+        rest = pipe.iterable[n:]
+        return iter(copy.deepcopy(rest) if pipe.deepcopy else rest)
+    return None
+
+
+def _batched(it: Iterator, batch_size: int, drop_last: bool, wrapper_class) -> Iterator:
+    while True:
+        batch = list(islice(it, batch_size))
+        if not batch or (drop_last and len(batch) < batch_size):
+            return
+        yield wrapper_class(batch)
+
+
+class Checkpointable:
+    """
+    Mixin for checkpointable pipes. Subclasses implement _current_state(), and take the state passed to
+    load_state_dict with _pop_resume_state() at the start of __iter__.
+    """
+    _resume_state: Optional[Dict[str, Any]] = None
+
+    def state_dict(self) -> Dict[str, Any]:
+        # if we haven't resumed yet, we're still where we were told to resume from
+        if self._resume_state is not None:
+            return self._resume_state
+        return self._current_state()
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume_state = state
+
+    def _current_state(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def _pop_resume_state(self) -> Optional[Dict[str, Any]]:
+        state, self._resume_state = self._resume_state, None
+        return state
+
+
+__all__ = ["Checkpointable", "pipeline_state_dict", "load_pipeline_state_dict", "fast_forward"]
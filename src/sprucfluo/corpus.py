@@ -11,63 +11,199 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from __future__ import annotations
+
 import functools
-from typing import Union, List, Optional, Dict, Any, Iterable
+from typing import Union, List, Optional, Dict, Any, Iterable, TYPE_CHECKING
 
+import numpy as np
 from torch.utils.data import IterDataPipe
-from torchdata.datapipes.iter import IterableWrapper
+from torch.utils.data.datapipes.iter import IterableWrapper
+
+from .files import expand_paths, shard_sizes
+from .index import split_shard_ranges
+from .text import LMTextFileReaderIterDataPipe
+from .token_cache import TokenCacheIterDataPipe, group_cached_tokens
 
-from .files import expand_paths
-from .text import read_lm_text_file
+if TYPE_CHECKING:
+    from transformers import BatchEncoding, PreTrainedTokenizerBase
 
 
 def load_corpus(paths: Union[str, List[str]],
                 shard_by_rank: bool = True,
                 json_text_key: str = "text",
                 extra_fsspec_args: Optional[Dict[str, Any]] = None,
-                expand_globs: bool = False) -> IterDataPipe[str]:
+                expand_globs: bool = False,
+                prefetch: int = 0,
+                glob_manifest_dir: Optional[str] = None,
+                cache_dir: Optional[str] = None,
+                cache_max_bytes: Optional[int] = None,
+                balance_shards: bool = False,
+                shard_by_worker: bool = False,
+                equalize_length: bool = False,
+                shuffle_seed: Optional[int] = None,
+                num_open_shards: int = 1) -> IterDataPipe[str]:
     """
     Loads a corpus from a list of paths. Each element of the iterator will be the text from a single "document".
 
     Args:
         paths: A list of paths to the corpus. Will be expanded via braceexpand.
-        shard_by_rank: If True, each shard will be assigned to a different rank, as per pytorch RANK
+        shard_by_rank: If True, each shard will be assigned to a different rank, as per pytorch RANK. The shards left
+            over after dividing them evenly are split into ranges, one per rank, if they're uncompressed or have
+            indexes (see sprucfluo.index); otherwise every rank reads them and keeps every WORLD_SIZE-th document.
         json_text_key: The key in the JSON file to use as the text. Defaults to "text".
         extra_fsspec_args: Extra arguments to pass to fsspec. This can be used for authentication, etc.
         expand_globs: If True, will expand globs in the paths. This happens after the paths are expanded via braceexpand.
+            Globs are expanded lazily, so reading starts before the listing is done.
+        prefetch: The number of shards to open (and start reading) in the background ahead of the current one (or,
+            with num_open_shards, ahead of the open ones).
+        cache_dir: A local directory to keep copies of remote shards in, so that later passes don't re-download them.
+            It's safe to share between ranks on the same node.
+        cache_max_bytes: The size to keep cache_dir under, by evicting the least recently used shards.
+        glob_manifest_dir: A local directory to save glob listings in, so later runs don't list the filesystem again.
+        balance_shards: If True, shards are assigned to ranks so that each rank gets about the same number of documents
+            (if all the shards have indexes) or bytes, rather than round-robin. See sprucfluo.files.shard_sizes.
+        shard_by_worker: If True (and shard_by_rank), shards are assigned to each DataLoader worker of each rank,
+            rather than to each rank, so that workers don't all read the rank's shards. Don't add .sharding_filter()!
+        equalize_length: If True (and shard_by_rank), every rank's stream is truncated to the length of the shortest,
+            so that ranks run out of data together. This needs all the shards to have indexes. See
+            EqualLengthIterDataPipe.
+        shuffle_seed: If not None, the shards are shuffled with this seed, differently each epoch (call
+            sprucfluo.set_epoch(pipe, epoch) at the start of each one), before they're divided between ranks. With
+            expand_globs, only the patterns are shuffled. See ShardShufflerIterDataPipe.
+        num_open_shards: The number of shards each rank reads at once, interleaving their documents at random (seeded
+            by shuffle_seed, or 0). Follow with .seeded_shuffle(...) for a better shuffle. See
+            ShardInterleaverIterDataPipe.
     """
     if extra_fsspec_args is None:
         extra_fsspec_args = {}
+    if balance_shards and expand_globs:
+        raise ValueError("balance_shards needs to know the shards up front, so it doesn't work with expand_globs")
 
     paths = expand_paths(paths)
+    if shuffle_seed is not None:
+        paths = paths.shuffle_shards(shuffle_seed)
 
     if shard_by_rank:
-        return paths.flat_shard_by_rank(
+        docs = paths.flat_shard_by_rank(
             functools.partial(
                 _open_and_read_text_files,
                 expand_globs=expand_globs,
                 json_text_key=json_text_key,
-                extra_fsspec_args=extra_fsspec_args))
+                extra_fsspec_args=extra_fsspec_args,
+                prefetch=prefetch,
+                glob_manifest_dir=glob_manifest_dir,
+                cache_dir=cache_dir,
+                cache_max_bytes=cache_max_bytes,
+                num_open_shards=num_open_shards,
+                seed=shuffle_seed or 0),
+            # globs are only expanded by fn, so we can't split them
+            split_remnant=None if expand_globs else functools.partial(split_shard_ranges, **extra_fsspec_args),
+            shard_weights=functools.partial(shard_sizes, **extra_fsspec_args) if balance_shards else None,
+            shard_by_worker=shard_by_worker)
+        return docs.equalize_length() if equalize_length else docs
     else:
-        return _open_and_read_text_files(paths, expand_globs, json_text_key, extra_fsspec_args)
+        return _open_and_read_text_files(paths, expand_globs, json_text_key, extra_fsspec_args, prefetch,
+                                         glob_manifest_dir, cache_dir, cache_max_bytes, num_open_shards,
+                                         shuffle_seed or 0)
+
+
+def load_tokenized_corpus(paths: Union[str, List[str]],
+                          tokenizer: PreTrainedTokenizerBase,
+                          seq_len: int,
+                          cache_dir: str,
+                          shard_by_rank: bool = True,
+                          json_text_key: str = "text",
+                          batch_size: int = 1000,
+                          stride: Optional[int] = None,
+                          drop_remainder: bool = True,
+                          mask_stride_overlap=True,
+                          fingerprint: Optional[str] = None,
+                          extra_fsspec_args: Optional[Dict[str, Any]] = None,
+                          return_tensors: Optional[str] = None) -> IterDataPipe[BatchEncoding]:
+    """
+    Equivalent to load_corpus(...).then(tokenize_and_group_texts, ...), except that the tokenized documents of each
+    shard are cached in cache_dir, so that subsequent passes over the corpus don't need to run the tokenizer.
+    See TokenCacheIterDataPipe for details.
+
+    Args:
+        paths: A list of paths to the corpus. Will be expanded via braceexpand.
+        tokenizer: The tokenizer to use.
+        seq_len: The length of sequences to emit.
+        cache_dir: The (local) directory to store tokenized shards in.
+        shard_by_rank: If True, each shard will be assigned to a different rank, as per pytorch RANK
+        json_text_key: The key in the JSON file to use as the text. Defaults to "text".
+        batch_size: The batch size to use for tokenizing and grouping
+        stride: The stride to use when grouping texts. If None, then the stride is set to seq_len.
+        drop_remainder: Whether to drop the last batch if it's not a multiple of the seq_len.
+        mask_stride_overlap: Whether to mask out overlapping tokens if we're using a stride.
+        fingerprint: Identifies the tokenizer in the cache key. If None, computed from the tokenizer.
+        extra_fsspec_args: Extra arguments to pass to fsspec. This can be used for authentication, etc.
+        return_tensors: If "np" or "pt", emit stacked arrays/tensors instead of one sequence at a time.
+            See concatenate_and_group_texts.
+    """
+    paths = expand_paths(paths)
+    # batch_size documents at a time, so that cached shards are cut into sequences without splitting them into documents
+    read_fn = functools.partial(
+        _tokenize_with_cache,
+        tokenizer=tokenizer,
+        cache_dir=cache_dir,
+        json_text_key=json_text_key,
+        batch_size=batch_size,
+        fingerprint=fingerprint,
+        extra_fsspec_args=extra_fsspec_args,
+        docs_per_item=batch_size)
+
+    if shard_by_rank:
+        docs = paths.flat_shard_by_rank(read_fn)
+    else:
+        docs = read_fn(paths)
+
+    return group_cached_tokens(docs, seq_len=seq_len, batch_size=1, stride=stride, drop_remainder=drop_remainder,
+                               mask_stride_overlap=mask_stride_overlap, return_tensors=return_tensors)
+
+
+def _tokenize_with_cache(paths: Union[Iterable[str], IterDataPipe[str]], **kwargs) -> IterDataPipe[np.ndarray]:
+    if not isinstance(paths, IterDataPipe):
+        paths = IterableWrapper(paths)
+    return TokenCacheIterDataPipe(paths, **kwargs)
 
 
 def _open_and_read_text_files(paths: Union[Iterable[str], IterDataPipe[str]],
                               expand_globs: bool,
                               json_text_key: str,
-                              extra_fsspec_args: Optional[Dict[str, Any]] = None) -> IterDataPipe[str]:
+                              extra_fsspec_args: Optional[Dict[str, Any]] = None,
+                              prefetch: int = 0,
+                              glob_manifest_dir: Optional[str] = None,
+                              cache_dir: Optional[str] = None,
+                              cache_max_bytes: Optional[int] = None,
+                              num_open_shards: int = 1,
+                              seed: int = 0) -> IterDataPipe[str]:
     if extra_fsspec_args is None:
         extra_fsspec_args = {}
 
     if not isinstance(paths, IterDataPipe):
         paths = IterableWrapper(paths)
 
+    if num_open_shards > 1:
+        # each shard's opener only has the one file, so the interleaver does the prefetching
+        read_shard = functools.partial(_open_and_read_text_file, expand_globs=expand_globs,
+                                       json_text_key=json_text_key, extra_fsspec_args=extra_fsspec_args,
+                                       glob_manifest_dir=glob_manifest_dir, cache_dir=cache_dir,
+                                       cache_max_bytes=cache_max_bytes)
+        return paths.interleave_shards(read_shard, num_open=num_open_shards, seed=seed, prefetch=prefetch)
+
     # TODO: may want to bring back cycle support, cycling through texts instead?
     # Cycle at path level is a bad idea with shard_by_rank if the number of paths
     # is < number of nodes
-    return paths \
-        .open_file_by_fsspec_fancy(expand_globs=expand_globs, mode="r", compression="infer", **extra_fsspec_args) \
-        .flatmap(lambda name_stream: read_lm_text_file(name_stream[0], name_stream[1], json_text_key))
+    files = paths.open_file_by_fsspec_fancy(expand_globs=expand_globs, glob_manifest_dir=glob_manifest_dir,
+                                            prefetch=prefetch, mode="rb", compression="infer", cache_dir=cache_dir,
+                                            cache_max_bytes=cache_max_bytes, **extra_fsspec_args)
+    return LMTextFileReaderIterDataPipe(files, json_text_key)
+
+
+def _open_and_read_text_file(path: str, **kwargs) -> IterDataPipe[str]:
+    return _open_and_read_text_files([path], **kwargs)
 
 
-__all__ = ["load_corpus"]
\ No newline at end of file
+__all__ = ["load_corpus", "load_tokenized_corpus"]
\ No newline at end of file
@@ -0,0 +1,38 @@
+# Copyright 2022 The Board of Trustees of the Leland Stanford Junior University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+BatchEncodings, without importing transformers until the first one is made.
+
+Importing transformers takes a while, and it's only needed by the pipes that emit BatchEncodings and by the
+tokenizers themselves, so sprucfluo only imports it for type checking, and the first time batch_encoding is called.
+"""
+from typing import Any, Dict, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from transformers import BatchEncoding
+
+_batch_encoding_class = None
+
+
+def batch_encoding(data: Dict[str, Any]) -> "BatchEncoding":
+    """BatchEncoding(data=data)"""
+    global _batch_encoding_class
+    if _batch_encoding_class is None:
+        from transformers import BatchEncoding
+        _batch_encoding_class = BatchEncoding
+    return _batch_encoding_class(data=data)
+
+
+__all__ = ["batch_encoding"]
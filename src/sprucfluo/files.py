@@ -11,31 +11,251 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import contextlib
+import fnmatch
+import hashlib
+import io
 import os
-from typing import Tuple, Iterator, Union, List
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Tuple, Iterator, Union, List, Optional, Callable, Set, Dict, Any
 
 from braceexpand import braceexpand
 from torch.utils.data import functional_datapipe, IterDataPipe
-from torchdata.datapipes.iter import IterableWrapper
+from torch.utils.data.datapipes.iter import IterableWrapper
 from torch.utils.data.datapipes.utils.common import StreamWrapper
 import fsspec
 import fsspec.compression
+import fsspec.core
 import fsspec.utils
 
+from .checkpoint import Checkpointable
+from .index import DocumentRange, ByteRange, open_at_document, open_at_byte, cached_index
 
-def expand_paths(paths: Union[str, List[str]]) -> IterDataPipe[str]:
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+
+_RANGE_TYPES = (DocumentRange, ByteRange)
+
+
+def expand_paths(paths: Union[str, List[str]],
+                 expand_globs: bool = False,
+                 glob_manifest_dir: Optional[str] = None,
+                 **storage_options) -> IterDataPipe[str]:
     """
-    Expand a list of URLs into a data pipe of URLs.
+    Expand a list of URLs into a data pipe of URLs. URLs are expanded via braceexpand, and then, if expand_globs is
+    True, lazily as globs (see GlobExpanderIterDataPipe).
     """
     if isinstance(paths, str):
         paths = [paths]
 
-    # TODO: we could be fancier and support globbing, but it makes things a bit more complicated, but only a bit
-    return IterableWrapper([p for path in paths for p in braceexpand(path)])
+    # ranges are already single shards
+    expanded = IterableWrapper([p for path in paths
+                                for p in ([path] if isinstance(path, _RANGE_TYPES) else braceexpand(path))])
+    if expand_globs:
+        return GlobExpanderIterDataPipe(expanded, manifest_dir=glob_manifest_dir, **storage_options)
+    return expanded
+
+
+# the kwargs of fsspec.open that aren't storage options
+_OPEN_KWARGS = {"mode", "compression", "encoding", "errors", "newline", "protocol", "num", "name_function", "expand"}
+
+
+def _has_magic(s: str) -> bool:
+    return any(c in s for c in "*?[")
+
+
+def iter_glob(pattern: str, **storage_options) -> Iterator[str]:
+    """
+    Lazily expands a glob, yielding matching files in sorted order as directories are listed. Unlike fsspec's glob,
+    which lists everything under the root of the pattern before matching anything, this only lists directories that
+    can contain matches, one at a time. `*` and `?` don't match `/`, `**` matches any number of directories.
+    Paths without glob characters are yielded as is.
+    """
+    if not _has_magic(pattern):
+        yield pattern
+        return
+
+    fs, path = fsspec.core.url_to_fs(pattern, **storage_options)
+    # keep the url in the form we were given it: chained protocols, and no protocol for local paths
+    chain, _, url = pattern.rpartition("::")
+    chain = chain + "::" if chain else ""
+    if "://" in url:
+        def format_path(p):
+            return chain + fs.unstrip_protocol(p)
+    else:
+        def format_path(p):
+            return chain + p
+
+    parts = path.split("/")
+    first_magic = next(i for i, part in enumerate(parts) if _has_magic(part))
+    root = "/".join(parts[:first_magic]) or "/"
+    for match in _walk_glob(fs, root, parts[first_magic:], {0}):
+        yield format_path(match)
+
+
+def _walk_glob(fs, directory: str, parts: List[str], states: Set[int]) -> Iterator[str]:
+    """
+    Matches the entries of directory against parts, recursing into directories that can still match. states is the
+    set of indices into parts that the path so far can have matched up to (plural because ** can match any number of
+    path components).
+    """
+    entries = fs.ls(directory, detail=True)
+    # directories sort as though they end in a "/", so that we yield in the same order as sorted(glob)
+    entries.sort(key=lambda e: e["name"].rstrip("/") + ("/" if e["type"] == "directory" else ""))
+    states = _close_states(parts, states)
+    for entry in entries:
+        name = entry["name"].rstrip("/")
+        if name == directory.rstrip("/"):
+            continue
+        base = name.rsplit("/", 1)[-1]
+        next_states = set()
+        for i in states:
+            if i == len(parts):
+                continue
+            if parts[i] == "**":
+                next_states.add(i)
+            elif fnmatch.fnmatchcase(base, parts[i]):
+                next_states.add(i + 1)
+        if not next_states:
+            continue
+        if entry["type"] == "directory":
+            yield from _walk_glob(fs, name, parts, next_states)
+        elif len(parts) in _close_states(parts, next_states):
+            yield name
+
+
+def _close_states(parts: List[str], states: Set[int]) -> Set[int]:
+    # ** can match nothing
+    closed = set(states)
+    for i in sorted(states):
+        while i < len(parts) and parts[i] == "**":
+            i += 1
+            closed.add(i)
+    return closed
+
+
+@functional_datapipe("expand_globs")
+class GlobExpanderIterDataPipe(IterDataPipe[str]):
+    r"""
+    Expands each path in the source as a glob, lazily (functional name: ``expand_globs``). Matches are yielded as soon
+    as the directory containing them is listed, so the first shard of a bucket with tens of thousands of them can be
+    opened without waiting for the full listing. See iter_glob.
+
+    If manifest_dir is given, the result of each expansion is saved there once it's complete, and later expansions of
+    the same glob read the saved listing instead of listing the filesystem. Delete the manifest to pick up new files.
+    When every glob has a manifest, len() works.
+
+    Args:
+        source_datapipe: The pipe of paths or globs.
+        manifest_dir: A local directory to store listings in. None disables manifests.
+        **storage_options: Options for the filesystem, e.g. for authentication. Arguments to fsspec.open that aren't
+            storage options (mode, compression, ...) are ignored, so it's fine to pass the same kwargs as to fsspec.open
+    """
+
+    def __init__(self, source_datapipe: IterDataPipe[str], manifest_dir: Optional[str] = None,
+                 **storage_options) -> None:
+        self.source_datapipe = source_datapipe
+        self.manifest_dir = manifest_dir
+        self.storage_options = {k: v for k, v in storage_options.items() if k not in _OPEN_KWARGS}
+
+    def __iter__(self) -> Iterator[str]:
+        for pattern in self.source_datapipe:
+            if self.manifest_dir is None or not _has_magic(pattern):
+                yield from iter_glob(pattern, **self.storage_options)
+            else:
+                yield from self._iter_with_manifest(pattern)
+
+    def manifest_path(self, pattern: str) -> str:
+        digest = hashlib.sha256(pattern.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.manifest_dir, f"{digest}.glob")
+
+    def _iter_with_manifest(self, pattern: str) -> Iterator[str]:
+        path = self.manifest_path(pattern)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    yield line.rstrip("\n")
+            return
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        complete = False
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for match in iter_glob(pattern, **self.storage_options):
+                    f.write(match + "\n")
+                    yield match
+            complete = True
+            os.replace(tmp_path, path)
+        finally:
+            if not complete:
+                os.remove(tmp_path)
+
+    def __len__(self) -> int:
+        if self.manifest_dir is not None:
+            total = 0
+            for pattern in self.source_datapipe:
+                if not _has_magic(pattern):
+                    total += 1
+                    continue
+                try:
+                    with open(self.manifest_path(pattern), "rb") as f:
+                        total += sum(1 for _ in f)
+                except FileNotFoundError:
+                    break
+            else:
+                return total
+        raise TypeError("{} instance doesn't have valid length until all globs have manifests"
+                        .format(type(self).__name__))
+
+
+# uri -> (its number of documents if it has an index, its size in bytes). Shards don't change during a run.
+_SHARD_INFO_CACHE: Dict[str, Tuple[Optional[int], int]] = {}
+
+
+def shard_sizes(shards: List[str], max_workers: int = 16, **storage_options) -> List[float]:
+    """
+    The sizes of shards, for balancing them between ranks (see ShardByRankDataPipe's shard_weights): their numbers
+    of documents if they all have indexes (see sprucfluo.index), and otherwise their sizes in bytes. Ranges count
+    the fraction of their shard they cover. Sizes are looked up in parallel, and cached for the life of the process.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        infos = list(pool.map(lambda shard: _shard_info(shard, **storage_options), shards))
+    by_docs = all(num_docs is not None for num_docs, _ in infos)
+    return [(num_docs if by_docs else size) * _range_fraction(shard, num_docs, size)
+            for shard, (num_docs, size) in zip(shards, infos)]
+
+
+def _shard_info(uri: str, **storage_options) -> Tuple[Optional[int], int]:
+    key = str(uri)
+    if key not in _SHARD_INFO_CACHE:
+        fs, path = fsspec.core.url_to_fs(key, **storage_options)
+        index = cached_index(fs, path)
+        _SHARD_INFO_CACHE[key] = (None if index is None else index.num_docs, fs.info(path)["size"])
+    return _SHARD_INFO_CACHE[key]
+
+
+def _range_fraction(uri: str, num_docs: Optional[int], size: int) -> float:
+    if isinstance(uri, DocumentRange) and num_docs:
+        extent = num_docs
+    elif isinstance(uri, ByteRange) and size:
+        extent = size
+    else:
+        return 1.0
+    stop = extent if uri.stop is None else min(uri.stop, extent)
+    return max(stop - uri.start, 0) / extent
 
 
 @functional_datapipe("open_file_by_fsspec_fancy")
-class FancyFSSpecFileOpenerIterDataPipe(IterDataPipe[Tuple[str, StreamWrapper]]):
+class FancyFSSpecFileOpenerIterDataPipe(Checkpointable, IterDataPipe[Tuple[str, StreamWrapper]]):
     r"""
     Similar to FSSpecFileOpenerIterDataPipe, but it just invokes fsspec.open, and can pass appropriate
     kwargs to it.
@@ -44,8 +264,30 @@ class FancyFSSpecFileOpenerIterDataPipe(IterDataPipe[Tuple[str, StreamWrapper]])
     The pathname is munged to be only the file name of the final path, without all of the uri fanciness. Any compression
     extensions are removed from the pathname if the file is being decompressed.
 
+    If prefetch > 0, the next prefetch files are opened in background threads while the current one is being consumed,
+    and the first prefetch_bytes / prefetch bytes of each are read ahead, so that the connection setup, first fetch
+    and decompressor warmup for the next file don't stall the pipe at shard boundaries.
+
+    If cache_dir is given, remote files are copied to it as they're read, and later passes read the local copy instead.
+    Once the cache holds more than cache_max_bytes, the least recently used files are evicted. The directory can be
+    shared by all ranks and workers on a node. Only files that are read to the end are cached.
+
+    Paths can be DocumentRanges, which are opened at their first document, using the shard's index if it has one
+    (see sprucfluo.index), or ByteRanges of uncompressed files, which are opened at their first line and end after
+    their last. They're yielded as ranges of the munged path. Ranges that aren't whole files aren't cached.
+
+    It's checkpointable: its state is the number of files it has yielded, and resuming skips that many paths without
+    opening them.
+
     Args:
         source_datapipe: Iterable DataPipe that provides the pathnames or URLs
+        expand_globs: If True, each path is lazily expanded as a glob. See GlobExpanderIterDataPipe.
+        glob_manifest_dir: If given, glob listings are saved in this directory and reused. This also makes len()
+            work with expand_globs once every glob has been listed.
+        prefetch: The number of files to open ahead of the current one. 0 disables prefetching.
+        prefetch_bytes: The total number of bytes to read ahead across all prefetched files.
+        cache_dir: A local directory to cache remote files in. None disables caching.
+        cache_max_bytes: The size the cache is evicted down to. None means unbounded.
         **kwargs: kwargs to pass to fsspec.open
 
     Example:
@@ -53,36 +295,391 @@ class FancyFSSpecFileOpenerIterDataPipe(IterDataPipe[Tuple[str, StreamWrapper]])
         >>> datapipe = FSSpecFileLister(root=dir_path)
         >>> file_dp = datapipe.open_file_by_fsspec_fancy(mode='rb', compression='infer')
     """
+    _num_yielded: int = 0
 
-    def __init__(self, source_datapipe: IterDataPipe[str], expand_globs: bool = False, **kwargs) -> None:
+    def __init__(self, source_datapipe: IterDataPipe[str], expand_globs: bool = False,
+                 glob_manifest_dir: Optional[str] = None, prefetch: int = 0, prefetch_bytes: int = 64 * 1024 * 1024,
+                 cache_dir: Optional[str] = None, cache_max_bytes: Optional[int] = None, **kwargs) -> None:
         self.source_datapipe: IterDataPipe[str] = source_datapipe
         self.kwargs = kwargs.copy()
         self.expand_globs = expand_globs
+        self.glob_manifest_dir = glob_manifest_dir
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        if prefetch > 0 and "r" not in self.kwargs.get("mode", "rb"):
+            raise ValueError("prefetch is only supported when opening files for reading")
+        if cache_dir is not None and "r" not in self.kwargs.get("mode", "rb"):
+            raise ValueError("cache_dir is only supported when opening files for reading")
 
     def __iter__(self) -> Iterator[Tuple[str, StreamWrapper]]:
-        for file_uri in self.source_datapipe:
-            if self.expand_globs:
-                # TODO: the globbing in fsspec is pretty bad, leading to I believe O(n^2) behavior for tar files
-                # Would be better if it were generator-based... and there's really no reason it couldn't be
-                files = fsspec.open_files(file_uri, **self.kwargs)
+        resume = self._pop_resume_state()
+        self._num_yielded = 0 if resume is None else resume["file_index"]
+        if self.prefetch > 0:
+            files = self._iter_prefetched(skip=self._num_yielded)
+        else:
+            files = self._iter_sequential(skip=self._num_yielded)
+        for path_and_stream in files:
+            self._num_yielded += 1
+            yield path_and_stream
+
+    def _iter_sequential(self, skip: int) -> Iterator[Tuple[str, StreamWrapper]]:
+        cache = self._make_cache()
+        for uri, file in self._iter_open_files(skip):
+            if _is_partial(uri):
+                stream = _open_range(file, uri)
+            elif cache is None:
+                stream = file.open()
+            else:
+                stream = _open_stream(file, cache)
+            yield self._munge_path(uri, file), StreamWrapper(stream)
+
+    def _current_state(self) -> Dict[str, Any]:
+        return {"file_index": self._num_yielded}
+
+    def _make_cache(self) -> Optional["_ShardCache"]:
+        if self.cache_dir is None:
+            return None
+        return _ShardCache(self.cache_dir, self.cache_max_bytes)
+
+    def _iter_open_files(self, skip: int = 0) -> Iterator[Tuple[str, fsspec.core.OpenFile]]:
+        for file_uri in islice(self._file_uris(), skip, None):
+            yield file_uri, fsspec.open(file_uri, **self.kwargs)
+
+    def _file_uris(self) -> IterDataPipe[str]:
+        if self.expand_globs:
+            return GlobExpanderIterDataPipe(self.source_datapipe, manifest_dir=self.glob_manifest_dir, **self.kwargs)
+        return self.source_datapipe
+
+    @staticmethod
+    def _munge_path(uri: str, file: fsspec.core.OpenFile) -> str:
+        # this is similar to the logic in compression=infer in fsspec.open, but we just
+        # want to remove the compression extension from the path if applicable
+        path = file.path
+        if file.compression is not None:
+            compr = fsspec.utils.infer_compression(path)
+            if compr == file.compression:
+                # strip the compression ext from the path
+                path = os.path.splitext(path)[0]
+        if isinstance(uri, _RANGE_TYPES):
+            path = type(uri)(path, uri.start, uri.stop)
+        return path
+
+    def num_documents(self) -> int:
+        """
+        The total number of documents in the files, from their indexes (which are cached, see cached_index). Raises
+        TypeError if a file doesn't have one.
+        """
+        total = 0
+        for uri in self._file_uris():
+            file = fsspec.open(uri, **self.kwargs)
+            index = cached_index(file.fs, file.path)
+            if index is None:
+                raise TypeError(f"Can't count the documents of {uri}: it doesn't have an index")
+            if isinstance(uri, DocumentRange):
+                total += index.count(uri.start, uri.stop)
+            elif isinstance(uri, ByteRange):
+                raise TypeError(f"Can't count the documents in a ByteRange of {uri}")
             else:
-                files = [fsspec.open(file_uri, **self.kwargs)]
-            for file in files:
-                # this is similar to the logic in compression=infer in fsspec.open, but we just
-                # want to remove the compression extension from the path if applicable
-                path = file.path
-                if file.compression is not None:
-                    compr = fsspec.utils.infer_compression(path)
-                    if compr == file.compression:
-                        # strip the compression ext from the path
-                        path = os.path.splitext(path)[0]
-
-                yield path, StreamWrapper(file.open())
+                total += index.count()
+        return total
+
+    def _iter_prefetched(self, skip: int) -> Iterator[Tuple[str, StreamWrapper]]:
+        read_ahead = self.prefetch_bytes // self.prefetch
+        cache = self._make_cache()
+        pool = ThreadPoolExecutor(max_workers=self.prefetch)
+        pending: deque = deque()
+        try:
+            for uri, file in self._iter_open_files(skip):
+                if _is_partial(uri):
+                    future = pool.submit(_open_range, file, uri, read_ahead)
+                else:
+                    future = pool.submit(_open_stream, file, cache, read_ahead)
+                pending.append((uri, file, future))
+                # one file is being consumed downstream while the next `prefetch` are opening
+                if len(pending) > self.prefetch:
+                    uri, file, future = pending.popleft()
+                    yield self._munge_path(uri, file), StreamWrapper(future.result())
+            while pending:
+                uri, file, future = pending.popleft()
+                yield self._munge_path(uri, file), StreamWrapper(future.result())
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+            for _, _, future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    future.result().close()
 
     def __len__(self) -> int:
         if self.expand_globs:
-            raise NotImplementedError("len() not implemented for FancyFSSpecFileOpenerIterDataPipe when expand_globs=True")
+            try:
+                return len(self._file_uris())
+            except TypeError:
+                raise NotImplementedError("len() not implemented for FancyFSSpecFileOpenerIterDataPipe when "
+                                          "expand_globs=True, unless all globs have manifests in glob_manifest_dir")
         return len(self.source_datapipe)
 
 
-__ALL__ = ["expand_paths", "FancyFSSpecFileOpenerIterDataPipe"]
\ No newline at end of file
+def _open_stream(file: fsspec.core.OpenFile, cache: Optional["_ShardCache"] = None, read_ahead: int = 0):
+    """
+    Opens file, through cache if given, and reads the first read_ahead bytes of it, returning a stream that behaves as
+    though they hadn't been read.
+    """
+    if cache is None:
+        binary = fsspec.core.OpenFile(file.fs, file.path, mode="rb", compression=file.compression)
+        stream = binary.open()
+        raw = None
+    else:
+        raw = cache.open(file)
+        try:
+            stream = fsspec.compression.compr[file.compression](raw, mode="r")
+        except BaseException:
+            raw.close()
+            raise
+
+    try:
+        head = stream.read(read_ahead) if read_ahead > 0 else b""
+    except BaseException:
+        stream.close()
+        if raw is not None:
+            raw.close()
+        raise
+
+    return _wrap_stream(file, _ReadAheadStream(head, stream, raw))
+
+
+def _is_partial(uri: str) -> bool:
+    # DocumentRanges are stopped by the reader, since it's counting documents anyway
+    return (isinstance(uri, DocumentRange) and uri.start > 0) or \
+        (isinstance(uri, ByteRange) and (uri.start > 0 or uri.stop is not None))
+
+
+def _open_range(file: fsspec.core.OpenFile, shard_range: Union[DocumentRange, ByteRange], read_ahead: int = 0):
+    """Opens file at the start of shard_range, and reads ahead like _open_stream."""
+    if isinstance(shard_range, ByteRange):
+        if file.compression is not None:
+            raise ValueError(f"ByteRanges of compressed files aren't supported: {shard_range!r}")
+        head, stream, raw = open_at_byte(file.fs, file.path, shard_range.start, shard_range.stop)
+    else:
+        index = cached_index(file.fs, file.path)
+        head, stream, raw = open_at_document(file.fs, file.path, file.compression, shard_range.start, index)
+    try:
+        if read_ahead > len(head):
+            head += stream.read(read_ahead - len(head))
+    except BaseException:
+        stream.close()
+        raw.close()
+        raise
+    # offsets in the stream aren't offsets in the file anymore
+    return _wrap_stream(file, _ReadAheadStream(head, stream, raw, seekable=False))
+
+
+def _wrap_stream(file: fsspec.core.OpenFile, raw: io.RawIOBase):
+    buffered = io.BufferedReader(raw)
+    if "b" in file.mode:
+        return buffered
+    return io.TextIOWrapper(buffered, encoding=file.encoding, errors=file.errors, newline=file.newline)
+
+
+class _ReadAheadStream(io.RawIOBase):
+    """
+    A raw stream that first serves some bytes that were already read from stream, then the rest of stream. If given,
+    underlying is closed along with stream (decompressors don't close the file object they were handed).
+    """
+
+    def __init__(self, head: bytes, stream, underlying=None, seekable: bool = True):
+        super().__init__()
+        self._head = head
+        self._pos = 0
+        self._stream = stream
+        self._underlying = underlying
+        self._seekable = seekable
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self._pos < len(self._head):
+            n = min(len(b), len(self._head) - self._pos)
+            b[:n] = self._head[self._pos:self._pos + n]
+            self._pos += n
+            return n
+        data = self._stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seekable(self) -> bool:
+        return self._seekable and self._stream.seekable()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.tell()
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("can only seek relative to the start or current position")
+
+        if offset < len(self._head):
+            self._pos = offset
+            self._stream.seek(len(self._head))
+        else:
+            self._pos = len(self._head)
+            self._stream.seek(offset)
+        return offset
+
+    def tell(self) -> int:
+        if self._pos < len(self._head):
+            return self._pos
+        return self._stream.tell()
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self._stream.close()
+            finally:
+                if self._underlying is not None:
+                    self._underlying.close()
+        super().close()
+
+
+class _ShardCache:
+    """
+    A directory of local copies of remote files, evicted least-recently-used first once they take up more than
+    max_bytes. Files are written as they're streamed (see _TeeStream) and only show up in the cache once they've been
+    read to the end, via an atomic rename, so several processes can share a directory. Eviction is serialized by a
+    lock file where fcntl is available.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def should_cache(self, file: fsspec.core.OpenFile) -> bool:
+        protocols = file.fs.protocol if isinstance(file.fs.protocol, (tuple, list)) else (file.fs.protocol,)
+        return "file" not in protocols
+
+    def path_for(self, file: fsspec.core.OpenFile) -> str:
+        uri = file.fs.unstrip_protocol(file.path)
+        digest = hashlib.sha256(uri.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{digest}-{os.path.basename(file.path)}")
+
+    def open(self, file: fsspec.core.OpenFile):
+        """Returns a raw binary stream of file's contents, from the cache if possible."""
+        if not self.should_cache(file):
+            return file.fs.open(file.path, mode="rb")
+
+        path = self.path_for(file)
+        try:
+            stream = open(path, "rb")
+        except FileNotFoundError:
+            pass
+        else:
+            # mtime is our recency. Another process can evict the file as soon as we've opened it, which is fine for
+            # reading it, so touch what we opened rather than the path, or not at all if the path's gone.
+            try:
+                os.utime(stream.fileno() if os.utime in os.supports_fd else path)
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                stream.close()
+                raise
+            return stream
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        remote = file.fs.open(file.path, mode="rb")
+        tmp_path = os.path.join(self.cache_dir, f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+        size = getattr(remote, "size", None)
+        return _TeeStream(remote, open(tmp_path, "wb"), tmp_path, size, lambda: self._commit(tmp_path, path))
+
+    def _commit(self, tmp_path: str, path: str) -> None:
+        os.replace(tmp_path, path)
+        if self.max_bytes is not None:
+            self.evict(keep=path)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Removes the least recently used files until the cache is within max_bytes. Never removes keep."""
+        with self._lock():
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if name.startswith("."):
+                    continue
+                entry = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(entry)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if entry == keep:
+                    continue
+                # readers that already have it open are fine on posix
+                try:
+                    os.remove(entry)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(os.path.join(self.cache_dir, ".lock"), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class _TeeStream(io.RawIOBase):
+    """
+    A raw stream that reads from stream and writes everything it reads to out. Once stream is exhausted, out is
+    closed and commit is called. If we're closed before that, out is deleted, unless it happens to be complete.
+    """
+
+    def __init__(self, stream, out, out_path: str, size: Optional[int], commit: Callable[[], None]):
+        super().__init__()
+        self._stream = stream
+        self._out = out
+        self._out_path = out_path
+        self._size = size
+        self._written = 0
+        self._commit = commit
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self._stream.read(len(b))
+        b[:len(data)] = data
+        if self._out is not None:
+            if data:
+                self._out.write(data)
+                self._written += len(data)
+            else:
+                self._finish(complete=True)
+        return len(data)
+
+    def _finish(self, complete: bool) -> None:
+        out, self._out = self._out, None
+        out.close()
+        if complete or (self._size is not None and self._written == self._size):
+            self._commit()
+        else:
+            os.remove(self._out_path)
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                if self._out is not None:
+                    self._finish(complete=False)
+            finally:
+                self._stream.close()
+        super().close()
+
+
+__ALL__ = ["expand_paths", "iter_glob", "shard_sizes", "GlobExpanderIterDataPipe", "FancyFSSpecFileOpenerIterDataPipe"]
\ No newline at end of file
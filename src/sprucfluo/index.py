@@ -0,0 +1,438 @@
+# Copyright 2022 The Board of Trustees of the Leland Stanford Junior University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Sidecar indexes for jsonl shards, so that we can start reading at document k without decompressing and scanning
+everything before it.
+
+The index of shard `foo.jsonl.zst` lives next to it in `foo.jsonl.zst.idx.json`, and records the number of documents
+in the shard and a list of checkpoints. A checkpoint is a (compressed offset, skip, document) triple: decompression
+can start at the compressed offset, and after skipping `skip` decompressed bytes we're at the start of document
+`document`. For uncompressed shards, checkpoints are every few MB. Compressed streams can only be entered at the
+start of a zstd frame or gzip member, so compressed shards get a checkpoint at (some of) those. A shard that's a
+single frame only gets the trivial checkpoint at the start. (See scripts/index_shards.py, which can rewrite shards
+into multiple frames.)
+
+Documents are the non-blank lines of the shard, as in read_jsonl.
+"""
+import bisect
+import io
+import json
+import zlib
+from typing import Optional, List, Tuple, Iterator, Dict, Any, Callable
+
+import fsspec
+import fsspec.compression
+import fsspec.core
+import fsspec.utils
+
+_INDEX_FORMAT_VERSION = 1
+INDEX_SUFFIX = ".idx.json"
+
+_BLOCK_SIZE = 1 << 20
+DEFAULT_CHECKPOINT_BYTES = 16 << 20
+
+
+class _ShardRange(str):
+    """A shard path that stands for part of the shard. It's a str, so it can go anywhere a path can."""
+    start: int
+    stop: Optional[int]
+
+    def __new__(cls, path: str, start: int = 0, stop: Optional[int] = None):
+        self = super().__new__(cls, path)
+        self.start = start
+        self.stop = stop
+        return self
+
+    def __reduce__(self):
+        return type(self), (str(self), self.start, self.stop)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({str(self)!r}, {self.start}, {self.stop})"
+
+
+class DocumentRange(_ShardRange):
+    """
+    Documents [start, stop) of a jsonl shard. stop=None means the end. open_file_by_fsspec_fancy opens it at document
+    start (using the shard's index if it has one), and read_lm_text_files stops at document stop.
+    """
+
+
+class ByteRange(_ShardRange):
+    """
+    The lines of an uncompressed shard that start in bytes [start, stop). stop=None means the end. Unlike
+    DocumentRange, it doesn't need an index: open_file_by_fsspec_fancy seeks to start and skips the partial line
+    there, and the stream ends with the line that stop falls in.
+    """
+
+
+class ShardIndex:
+    """The index of a single shard. See the module docstring."""
+
+    def __init__(self, num_docs: int, compression: Optional[str], checkpoints: List[Tuple[int, int, int]]):
+        self.num_docs = num_docs
+        self.compression = compression
+        self.checkpoints = checkpoints
+        self._docs = [doc for _, _, doc in checkpoints]
+
+    def count(self, start: int = 0, stop: Optional[int] = None) -> int:
+        """The number of documents in [start, stop) of the shard."""
+        stop = self.num_docs if stop is None else min(stop, self.num_docs)
+        return max(stop - start, 0)
+
+    def checkpoint_for(self, doc: int) -> Tuple[int, int, int]:
+        """The last checkpoint at or before document doc."""
+        i = bisect.bisect_right(self._docs, doc) - 1
+        return self.checkpoints[max(i, 0)]
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "version": _INDEX_FORMAT_VERSION,
+            "num_docs": self.num_docs,
+            "compression": self.compression,
+            "checkpoints": [list(c) for c in self.checkpoints],
+        }
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> "ShardIndex":
+        if data.get("version") != _INDEX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported index version: {data.get('version')}")
+        return ShardIndex(data["num_docs"], data["compression"], [tuple(c) for c in data["checkpoints"]])
+
+
+def load_index(uri: str, **storage_options) -> Optional[ShardIndex]:
+    """Loads the index of the shard at uri, or returns None if it doesn't have one."""
+    fs, path = fsspec.core.url_to_fs(str(uri), **storage_options)
+    return read_index(fs, path)
+
+
+def read_index(fs, path: str) -> Optional[ShardIndex]:
+    try:
+        with fs.open(path + INDEX_SUFFIX, "rb") as f:
+            return ShardIndex.from_json(json.load(f))
+    except FileNotFoundError:
+        return None
+
+
+# fs.unstrip_protocol(path) -> the index of the shard at path, or None if it doesn't have one. Shards don't change
+# during a run, and every rank reads every shard's index to work out the lengths of all the ranks' streams.
+_INDEX_CACHE: Dict[str, Optional[ShardIndex]] = {}
+
+
+def cached_index(fs, path: str) -> Optional[ShardIndex]:
+    """Like read_index, but each shard's index is only read once in the life of the process."""
+    key = fs.unstrip_protocol(path)
+    if key not in _INDEX_CACHE:
+        _INDEX_CACHE[key] = read_index(fs, path)
+    return _INDEX_CACHE[key]
+
+
+def write_index(uri: str, index: ShardIndex, **storage_options) -> None:
+    fs, path = fsspec.core.url_to_fs(str(uri), **storage_options)
+    with fs.open(path + INDEX_SUFFIX, "w") as f:
+        json.dump(index.to_json(), f)
+    _INDEX_CACHE.pop(fs.unstrip_protocol(path), None)
+
+
+def build_index(uri: str, compression: Optional[str] = "infer", checkpoint_bytes: int = DEFAULT_CHECKPOINT_BYTES,
+                **storage_options) -> ShardIndex:
+    """
+    Reads the shard at uri and builds its index. Checkpoints are at least checkpoint_bytes (of decompressed data)
+    apart, and for compressed shards, only at frame/member boundaries.
+    """
+    fs, path = fsspec.core.url_to_fs(str(uri), **storage_options)
+    if compression == "infer":
+        compression = fsspec.utils.infer_compression(path)
+    if compression not in _MEMBER_DECOMPRESSORS:
+        raise ValueError(f"Can't index shards with compression {compression}")
+
+    with fs.open(path, "rb") as raw:
+        return _index_stream(raw, compression, checkpoint_bytes)
+
+
+def _index_stream(raw, compression: Optional[str], checkpoint_bytes: int) -> ShardIndex:
+    checkpoints = [(0, 0, 0)]
+    num_docs = 0
+    pos = 0  # in the decompressed stream
+    last_checkpoint = 0
+    partial_nonblank = False  # whether the line we're in the middle of has anything in it
+    at_line_start = True
+    # a checkpoint that's waiting for the next line to start: (compressed offset, decompressed offset)
+    pending: Optional[Tuple[int, int]] = None
+
+    for member_offset, data in _iter_members(raw, compression):
+        if member_offset is not None and member_offset > 0 and pos - last_checkpoint >= checkpoint_bytes:
+            pending = (member_offset, pos)
+            if at_line_start:
+                checkpoints.append((member_offset, 0, num_docs))
+                last_checkpoint = pos
+                pending = None
+        if not data:
+            continue
+
+        lines = data.split(b"\n")
+        line_start = pos
+        for line in lines[:-1]:
+            if partial_nonblank or (line and not line.isspace()):
+                num_docs += 1
+            partial_nonblank = False
+            line_start += len(line) + 1
+            if pending is not None:
+                checkpoints.append((pending[0], line_start - pending[1], num_docs))
+                last_checkpoint = line_start
+                pending = None
+            elif compression is None and line_start - last_checkpoint >= checkpoint_bytes:
+                checkpoints.append((line_start, 0, num_docs))
+                last_checkpoint = line_start
+        last = lines[-1]
+        partial_nonblank = partial_nonblank or bool(last and not last.isspace())
+        at_line_start = not last
+        pos += len(data)
+
+    if partial_nonblank:
+        num_docs += 1
+    # drop checkpoints at the very end, which are useless
+    checkpoints = [c for c in checkpoints if c[2] < num_docs or c == (0, 0, 0)]
+    return ShardIndex(num_docs, compression, checkpoints)
+
+
+def split_shard_ranges(shards: List[str], part: int, num_parts: int, **storage_options) -> Optional[List[str]]:
+    """
+    Divides shards into num_parts contiguous, roughly equal parts, and returns part part of them as a list of
+    DocumentRanges and ByteRanges, so that each of num_parts readers reads only its own part. Shards with an index are
+    divided by documents, and uncompressed ones without one by bytes. If a shard is compressed and has no index, it
+    can't be divided, and this returns None.
+    """
+    sizes = []
+    for shard in shards:
+        fs, path = fsspec.core.url_to_fs(str(shard), **storage_options)
+        index = cached_index(fs, path)
+        if index is not None:
+            sizes.append((DocumentRange, index.num_docs))
+        elif fsspec.utils.infer_compression(path) is None:
+            sizes.append((ByteRange, fs.size(path)))
+        else:
+            return None
+
+    if len({range_type for range_type, _ in sizes}) == 1:
+        # documents or bytes throughout, so we can divide the shards as though they were one
+        pieces = _split_evenly([size for _, size in sizes], part, num_parts)
+    else:
+        pieces = []
+        for i, (_, size) in enumerate(sizes):
+            pieces.extend((i, start, stop) for _, start, stop in _split_evenly([size], part, num_parts))
+    return [sizes[i][0](shards[i], start, stop) for i, start, stop in pieces]
+
+
+def _split_evenly(sizes: List[int], part: int, num_parts: int) -> List[Tuple[int, int, int]]:
+    """The (shard, start, stop) pieces of part part of the concatenation of shards of the given sizes."""
+    total = sum(sizes)
+    begin, end = total * part // num_parts, total * (part + 1) // num_parts
+    pieces = []
+    offset = 0
+    for i, size in enumerate(sizes):
+        start, stop = max(begin - offset, 0), min(end - offset, size)
+        if start < stop:
+            pieces.append((i, start, stop))
+        offset += size
+    return pieces
+
+
+def _zstd_member_decompressor():
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _gzip_member_decompressor():
+    return zlib.decompressobj(wbits=31)
+
+
+_MEMBER_DECOMPRESSORS: Dict[Optional[str], Optional[Callable]] = {
+    None: None,
+    "zstd": _zstd_member_decompressor,
+    "gzip": _gzip_member_decompressor,
+}
+
+
+def _iter_members(raw, compression: Optional[str]) -> Iterator[Tuple[Optional[int], bytes]]:
+    """
+    Yields (member_offset, data) for the decompressed data of raw. member_offset is the compressed offset of the start
+    of a zstd frame or gzip member when one starts just before data, and None otherwise.
+    """
+    new_decompressor = _MEMBER_DECOMPRESSORS[compression]
+    if new_decompressor is None:
+        while True:
+            data = raw.read(_BLOCK_SIZE)
+            if not data:
+                return
+            yield None, data
+
+    pos = 0  # compressed offset of the start of pending
+    pending = b""
+    decompressor = new_decompressor()
+    member_offset: Optional[int] = 0
+    while True:
+        if not pending:
+            pending = raw.read(_BLOCK_SIZE)
+            if not pending:
+                return
+        data = decompressor.decompress(pending)
+        if decompressor.eof:
+            unused = decompressor.unused_data
+            pos += len(pending) - len(unused)
+            pending = unused
+            yield member_offset, data
+            decompressor = new_decompressor()
+            member_offset = pos
+        else:
+            pos += len(pending)
+            pending = b""
+            yield member_offset, data
+            member_offset = None
+
+
+def open_at_document(fs, path: str, compression: Optional[str], doc: int, index: Optional[ShardIndex] = None):
+    """
+    Opens the shard at path for reading (in binary), positioned at the start of document doc. If there's an index,
+    we start from the last checkpoint before doc, otherwise from the beginning. Either way, we then skip lines to get
+    to doc, without parsing them.
+    """
+    if index is not None and index.compression == compression:
+        offset, skip, start_doc = index.checkpoint_for(doc)
+    else:
+        offset, skip, start_doc = 0, 0, 0
+
+    raw = fs.open(path, mode="rb")
+    try:
+        raw.seek(offset)
+        stream = fsspec.compression.compr[compression](raw, mode="rb")
+        _skip_bytes(stream, skip)
+        head = _skip_documents(stream, doc - start_doc)
+    except BaseException:
+        raw.close()
+        raise
+    return head, stream, raw
+
+
+def open_at_byte(fs, path: str, start: int, stop: Optional[int] = None):
+    """
+    Opens the uncompressed shard at path for reading the lines that start in bytes [start, stop), like
+    open_at_document. The returned stream ends after the last of them.
+    """
+    raw = fs.open(path, mode="rb")
+    try:
+        raw.seek(max(start - 1, 0))
+    except BaseException:
+        raw.close()
+        raise
+    return b"", _LineRangeStream(raw, start, stop), raw
+
+
+class _LineRangeStream(io.RawIOBase):
+    """
+    Reads the lines of raw that start in [start, stop), given raw positioned at max(start - 1, 0). A line starts at 0
+    or after a newline, so we skip through the first newline at or after start - 1, and finish the line stop falls in.
+    Doesn't close raw.
+    """
+
+    def __init__(self, raw, start: int, stop: Optional[int]):
+        super().__init__()
+        self._raw = raw
+        self._pos = max(start - 1, 0)
+        self._stop = stop
+        self._skip_partial_line = start > 0
+        self._at_line_start = True
+        self._pending = b""
+        self._done = False
+
+    def readable(self) -> bool:
+        return True
+
+    def _read(self, n: int) -> bytes:
+        if self._pending:
+            data, self._pending = self._pending[:n], self._pending[n:]
+            return data
+        return self._raw.read(n)
+
+    def readinto(self, b) -> int:
+        while self._skip_partial_line and not self._done:
+            block = self._read(_BLOCK_SIZE)
+            newline = block.find(b"\n")
+            if not block:
+                self._done = True
+            elif newline < 0:
+                self._pos += len(block)
+            else:
+                self._pos += newline + 1
+                self._pending = block[newline + 1:]
+                self._skip_partial_line = False
+        if self._done:
+            return 0
+
+        if self._stop is None or self._pos < self._stop:
+            n = len(b) if self._stop is None else min(len(b), self._stop - self._pos)
+            data = self._read(n)
+            self._pos += len(data)
+            if data:
+                self._at_line_start = data.endswith(b"\n")
+        elif self._at_line_start:
+            data = b""
+        else:
+            # finish the line we're in
+            data = self._read(len(b))
+            newline = data.find(b"\n")
+            if newline >= 0:
+                data = data[:newline + 1]
+                self._at_line_start = True
+            self._pos += len(data)
+
+        if not data:
+            self._done = True
+        b[:len(data)] = data
+        return len(data)
+
+
+def _skip_bytes(stream, num_bytes: int) -> None:
+    while num_bytes > 0:
+        data = stream.read(min(num_bytes, _BLOCK_SIZE))
+        if not data:
+            break
+        num_bytes -= len(data)
+
+
+def _skip_documents(stream, num_docs: int) -> bytes:
+    """Reads past num_docs documents (non-blank lines) of stream, returning whatever was read past them."""
+    partial_nonblank = False
+    while num_docs > 0:
+        block = stream.read(_BLOCK_SIZE)
+        if not block:
+            return b""
+        start = 0
+        while num_docs > 0:
+            end = block.find(b"\n", start)
+            if end < 0:
+                rest = block[start:]
+                partial_nonblank = partial_nonblank or bool(rest and not rest.isspace())
+                break
+            line = block[start:end]
+            if partial_nonblank or (line and not line.isspace()):
+                num_docs -= 1
+            partial_nonblank = False
+            start = end + 1
+        else:
+            return block[start:]
+    return b""
+
+
+__all__ = ["DocumentRange", "ByteRange", "split_shard_ranges", "ShardIndex", "INDEX_SUFFIX", "load_index", "read_index",
+           "write_index", "build_index", "open_at_document", "open_at_byte"]
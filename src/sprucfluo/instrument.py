@@ -0,0 +1,342 @@
+# Copyright 2022 The Board of Trustees of the Leland Stanford Junior University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Opt-in instrumentation of the stages of a pipeline, to find the one that's holding it up.
+
+instrument(pipe) wraps every pipe in the pipeline (including the ones that FlatShardByRankDataPipe and
+ShardInterleaverIterDataPipe make for each shard) in an InstrumentedIterDataPipe, which counts the items, tokens and
+bytes that come out of it, and times how long each item takes, split into the time spent in the stage itself and the
+time spent waiting for the stage upstream of it. The time it takes the file opener to produce a file is the latency
+of opening it.
+
+Timing every item costs a couple of microseconds per stage per item. With sample_every=n, only every n-th item of the
+whole pipeline is timed (through every stage), and times are scaled up by n. Counts are always exact.
+
+Stages run in background threads (prefetching, parallel tokenization) are timed in their own threads, so their time
+doesn't show up as time spent waiting downstream. With a DataLoader with workers, each worker has its own copy of the
+pipeline and of the stats, so use a hook (which runs in the worker) to get at them.
+"""
+import json
+import logging
+import threading
+import time
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+
+from torch.utils.data import IterDataPipe
+from torch.utils.data.datapipes.iter import Mapper
+from torch.utils.data.datapipes.utils.common import StreamWrapper
+
+from .files import FancyFSSpecFileOpenerIterDataPipe
+from .mixing import num_tokens, TokenMixtureIterDataPipe
+from .sharding import FlatShardByRankDataPipe
+from .shuffle import ShardInterleaverIterDataPipe
+
+T_co = TypeVar('T_co', covariant=True)
+
+logger = logging.getLogger(__name__)
+
+# the pipes that make more pipes with their fn, which we instrument too
+_PIPE_MAKERS = (FlatShardByRankDataPipe, ShardInterleaverIterDataPipe)
+
+
+class StageStats:
+    """The counts and times of one stage (or of all the stages with the same name)"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.tokens = 0
+        self.bytes = 0
+        self.inside_secs = 0.0
+        self.waiting_secs = 0.0
+        self.max_item_secs = 0.0
+
+    def to_dict(self, wall_secs: float) -> Dict[str, Any]:
+        busy = self.inside_secs + self.waiting_secs
+        return {
+            "items": self.items,
+            "tokens": self.tokens,
+            "bytes": self.bytes,
+            "items_per_sec": self.items / wall_secs if wall_secs > 0 else 0.0,
+            "tokens_per_sec": self.tokens / wall_secs if wall_secs > 0 else 0.0,
+            "bytes_per_sec": self.bytes / wall_secs if wall_secs > 0 else 0.0,
+            "inside_secs": self.inside_secs,
+            "waiting_secs": self.waiting_secs,
+            "inside_fraction": self.inside_secs / busy if busy > 0 else 0.0,
+            "mean_item_secs": self.inside_secs / self.items if self.items else 0.0,
+            "max_item_secs": self.max_item_secs,
+        }
+
+
+class PipelineStats:
+    """The stats of every stage of an instrumented pipeline, from the most downstream on"""
+
+    def __init__(self, sample_every: int = 1, hook: Optional[Callable[["PipelineStats"], None]] = None,
+                 hook_every_secs: float = 60.0):
+        assert sample_every > 0, "sample_every should be larger than 0"
+        self.sample_every = sample_every
+        self.hook = hook
+        self.hook_every_secs = hook_every_secs
+        self.stages: Dict[str, StageStats] = {}
+        self._start: Optional[float] = None
+        self._last_hook: Optional[float] = None
+        self._num_outer = 0
+
+    def stage(self, name: str) -> StageStats:
+        if name not in self.stages:
+            self.stages[name] = StageStats(name)
+        return self.stages[name]
+
+    def _start_outer(self) -> bool:
+        """Called before each item of the pipeline. Returns whether to time it."""
+        self._num_outer += 1
+        if self._start is None:
+            self._start = self._last_hook = time.perf_counter()
+        if self.hook is not None and self._num_outer % self.sample_every == 0:
+            now = time.perf_counter()
+            if now - self._last_hook >= self.hook_every_secs:
+                self._last_hook = now
+                self.hook(self)
+        return self._num_outer % self.sample_every == 0
+
+    def wall_secs(self) -> float:
+        return 0.0 if self._start is None else time.perf_counter() - self._start
+
+    def to_dict(self) -> Dict[str, Any]:
+        wall_secs = self.wall_secs()
+        return {
+            "wall_secs": wall_secs,
+            "sample_every": self.sample_every,
+            "slowest_stage": self.slowest_stage(),
+            "stages": {name: stage.to_dict(wall_secs) for name, stage in self.stages.items()},
+        }
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def slowest_stage(self) -> Optional[str]:
+        """The stage that has spent the most time working (rather than waiting), or None if nothing's been timed"""
+        if not self.stages:
+            return None
+        name, stage = max(self.stages.items(), key=lambda kv: kv[1].inside_secs)
+        return name if stage.inside_secs > 0 else None
+
+
+class _Timing(threading.local):
+    def __init__(self):
+        # a frame per instrumented next() in progress: the time spent in the ones nested in it, or None if untimed
+        self.stack: List[Optional[List[float]]] = []
+        self.timing = False
+
+
+_TIMING = _Timing()
+
+
+class InstrumentedIterDataPipe(IterDataPipe[T_co]):
+    """
+    Passes the items of source_datapipe through, recording stats about them in stage. It's invisible to
+    checkpointing (see sprucfluo.checkpoint), and other attributes are looked up on the source.
+    """
+    is_passthrough = True
+
+    def __init__(self, source_datapipe: IterDataPipe[T_co], stage: StageStats, stats: PipelineStats) -> None:
+        self.source_datapipe = source_datapipe
+        self.stage = stage
+        self.stats = stats
+
+    def __iter__(self) -> Iterator[T_co]:
+        it = iter(self.source_datapipe)
+        stage, stats, local = self.stage, self.stats, _TIMING
+        count_bytes = isinstance(_unwrapped(self.source_datapipe), FancyFSSpecFileOpenerIterDataPipe)
+        while True:
+            timing = stats._start_outer() if not local.stack else local.timing
+            if not local.stack:
+                local.timing = timing
+            frame = [0.0] if timing else None
+            local.stack.append(frame)
+            start = time.perf_counter() if timing else 0.0
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                local.stack.pop()
+                if timing:
+                    elapsed = time.perf_counter() - start
+                    inside = elapsed - frame[0]
+                    stage.inside_secs += inside * stats.sample_every
+                    stage.waiting_secs += frame[0] * stats.sample_every
+                    stage.max_item_secs = max(stage.max_item_secs, inside)
+                    if local.stack and local.stack[-1] is not None:
+                        local.stack[-1][0] += elapsed
+
+            stage.items += 1
+            if isinstance(item, Mapping) and "input_ids" in item:
+                stage.tokens += num_tokens(item)
+            if count_bytes and isinstance(item, tuple) and len(item) == 2:
+                item = (item[0], _CountingStream(item[1], stage))
+            yield item
+
+    def skip(self, n: int):
+        from .checkpoint import fast_forward
+        return fast_forward(self.source_datapipe, n)
+
+    def __len__(self) -> int:
+        return len(self.source_datapipe)
+
+    def __getattr__(self, name: str):
+        if name.startswith("__") or name in ("source_datapipe", "stage", "stats"):
+            raise AttributeError(name)
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self.source_datapipe, name)
+
+
+class _CountingStream(StreamWrapper):
+    """Counts the bytes (or characters) read from a stream"""
+
+    def __init__(self, file_obj, stage: StageStats):
+        super().__init__(file_obj)
+        self.stage = stage
+
+    def _count(self, data):
+        if data:
+            self.stage.bytes += len(data)
+        return data
+
+    def read(self, *args):
+        return self._count(self.file_obj.read(*args))
+
+    def read1(self, *args):
+        return self._count(self.file_obj.read1(*args))
+
+    def readline(self, *args):
+        return self._count(self.file_obj.readline(*args))
+
+    def readinto(self, buffer):
+        n = self.file_obj.readinto(buffer)
+        if n:
+            self.stage.bytes += n
+        return n
+
+    def __iter__(self):
+        for line in self.file_obj:
+            yield self._count(line)
+
+    def __next__(self):
+        return self._count(next(self.file_obj))
+
+
+class _InstrumentedFn:
+    """Instruments the pipes that fn makes"""
+
+    def __init__(self, fn: Callable[..., IterDataPipe], stats: PipelineStats, prefix: str):
+        self.fn = fn
+        self.stats = stats
+        self.prefix = prefix
+
+    def __call__(self, *args, **kwargs) -> IterDataPipe:
+        return _instrument(self.fn(*args, **kwargs), self.stats, self.prefix)
+
+
+def _unwrapped(pipe: IterDataPipe) -> IterDataPipe:
+    while isinstance(pipe, InstrumentedIterDataPipe):
+        pipe = pipe.source_datapipe
+    return pipe
+
+
+def _stage_name(pipe: IterDataPipe) -> str:
+    name = type(pipe).__name__
+    for suffix in ("IterDataPipe", "DataPipe"):
+        if name.endswith(suffix) and name != suffix:
+            name = name[:-len(suffix)]
+            break
+    if isinstance(pipe, Mapper):
+        fn = pipe.fn
+        name += f"({getattr(fn, '__name__', type(fn).__name__)})"
+    return name
+
+
+def _instrument(pipe: IterDataPipe, stats: PipelineStats, prefix: str = "",
+                seen: Optional[Dict[int, IterDataPipe]] = None) -> IterDataPipe:
+    if isinstance(pipe, InstrumentedIterDataPipe):
+        return pipe
+    # a pipe that's used twice (e.g. forked) gets one wrapper
+    seen = {} if seen is None else seen
+    if id(pipe) in seen:
+        return seen[id(pipe)]
+    seen[id(pipe)] = wrapped = InstrumentedIterDataPipe(pipe, stats.stage(prefix + _stage_name(pipe)), stats)
+    for attr, value in list(vars(pipe).items()):
+        if attr.startswith("_"):
+            continue
+        if isinstance(value, IterDataPipe):
+            setattr(pipe, attr, _instrument(value, stats, prefix, seen))
+        elif isinstance(value, dict) and isinstance(pipe, TokenMixtureIterDataPipe):
+            setattr(pipe, attr, {k: _instrument(v, stats, f"{prefix}{k}/", seen) if isinstance(v, IterDataPipe) else v
+                                 for k, v in value.items()})
+    if isinstance(pipe, _PIPE_MAKERS) and not isinstance(pipe.fn, _InstrumentedFn):
+        pipe.fn = _InstrumentedFn(pipe.fn, stats, prefix)
+    return wrapped
+
+
+def instrument(pipe: IterDataPipe[T_co],
+               sample_every: int = 1,
+               hook: Optional[Callable[[PipelineStats], None]] = None,
+               hook_every_secs: float = 60.0) -> InstrumentedIterDataPipe[T_co]:
+    """
+    Instruments every stage of the pipeline that ends in pipe (in place), and returns the pipe to iterate over
+    instead. Its .stats is the PipelineStats, e.g. pipe.stats.to_dict() or pipe.stats.slowest_stage(). Stages of the
+    same type are counted together, except in the different sources of a TokenMixtureIterDataPipe.
+
+    Args:
+        pipe: The last pipe of the pipeline.
+        sample_every: Time every sample_every-th item of the pipeline, rather than every item.
+        hook: Called with the PipelineStats every hook_every_secs or so, e.g. log_hook() or tensorboard_hook(writer).
+        hook_every_secs: How often to call hook.
+    """
+    stats = PipelineStats(sample_every, hook, hook_every_secs)
+    return _instrument(pipe, stats)
+
+
+def log_hook(log: Optional[logging.Logger] = None, level: int = logging.INFO) -> Callable[[PipelineStats], None]:
+    """A hook for instrument that logs a line per stage"""
+    log = log or logger
+
+    def hook(stats: PipelineStats) -> None:
+        summary = stats.to_dict()
+        log.log(level, "Pipeline stats after %.1fs (slowest stage: %s)", summary["wall_secs"], summary["slowest_stage"])
+        for name, stage in summary["stages"].items():
+            log.log(level, "  %s: %.1f items/s, %.1f tokens/s, %.1f MB/s, %.3fs inside, %.3fs waiting", name,
+                    stage["items_per_sec"], stage["tokens_per_sec"], stage["bytes_per_sec"] / 1e6,
+                    stage["inside_secs"], stage["waiting_secs"])
+
+    return hook
+
+
+def tensorboard_hook(writer, tag: str = "sprucfluo") -> Callable[[PipelineStats], None]:
+    """A hook for instrument that adds the stats to a TensorBoard SummaryWriter (or anything with add_scalar)"""
+
+    def hook(stats: PipelineStats) -> None:
+        summary = stats.to_dict()
+        step = int(summary["wall_secs"])
+        for name, stage in summary["stages"].items():
+            for metric in ("items_per_sec", "tokens_per_sec", "bytes_per_sec", "inside_fraction", "mean_item_secs"):
+                writer.add_scalar(f"{tag}/{name}/{metric}", stage[metric], step)
+
+    return hook
+
+
+__all__ = ["instrument", "InstrumentedIterDataPipe", "PipelineStats", "StageStats", "log_hook", "tensorboard_hook"]
@@ -0,0 +1,331 @@
+# Copyright 2022 The Board of Trustees of the Leland Stanford Junior University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Mixing several tokenized corpora in given proportions of tokens"""
+from __future__ import annotations
+
+import random
+from typing import Dict, Iterator, Optional, Any, Union, List, Mapping, TYPE_CHECKING
+
+from torch.utils.data import IterDataPipe
+
+from .checkpoint import Checkpointable, iter_source, source_state_dict
+from .corpus import load_corpus
+from .shuffle import epoch_seed
+from .text import tokenize_and_group_texts
+
+if TYPE_CHECKING:
+    from transformers import BatchEncoding, PreTrainedTokenizerBase
+
+_STRATEGIES = ("stochastic", "deterministic")
+
+
+def num_tokens(item: Any) -> int:
+    """The number of tokens in a BatchEncoding (or dict) of one sequence, or of a stacked batch of them"""
+    ids = item["input_ids"] if isinstance(item, Mapping) else item
+    shape = getattr(ids, "shape", None)
+    if shape is not None:
+        size = 1
+        for dim in shape:
+            size *= dim
+        return size
+    if len(ids) > 0 and isinstance(ids[0], (list, tuple)):
+        return sum(len(seq) for seq in ids)
+    return len(ids)
+
+
+class _Source:
+    """A source of a mixture, and how far we've got in it"""
+
+    def __init__(self, pipe: IterDataPipe):
+        self.pipe = pipe
+        self.iterator: Optional[Iterator] = None
+        # where to pick up from when it's next opened, as per source_state_dict
+        self.state: Optional[Dict[str, Any]] = None
+        self.num_pulled = 0
+        self.num_items = 0
+        self.num_tokens = 0
+        self.exhausted = False
+
+    def open(self) -> None:
+        self.iterator = iter_source(self.pipe, self.state)
+        self.state = None
+
+    def close(self) -> None:
+        if self.iterator is None:
+            return
+        if not self.exhausted:
+            self.state = source_state_dict(self.pipe, self.num_pulled)
+        close = getattr(self.iterator, "close", None)
+        if callable(close):
+            close()
+        self.iterator = None
+
+    def current_state(self) -> Optional[Dict[str, Any]]:
+        if self.iterator is not None and not self.exhausted:
+            return source_state_dict(self.pipe, self.num_pulled)
+        return self.state
+
+
+class TokenMixtureIterDataPipe(Checkpointable, IterDataPipe["BatchEncoding"]):
+    r"""
+    Mixes several pipes of tokenized sequences (e.g. from tokenize_and_group_texts) so that each source's share of the
+    tokens emitted is its share of the weights. SampleMultiplexerDataPipe mixes by items instead, which is only the
+    same thing if every item has the same number of tokens.
+
+    There are two strategies for choosing the source of the next item:
+
+    * "stochastic": at random, with probability proportional to the source's weight divided by the average number of
+      tokens in its items so far. The proportions are right in expectation.
+    * "deterministic": the source that's furthest behind its share of the tokens, i.e. with the fewest tokens emitted
+      per unit of weight (ties go to the first). The proportions are exact to within an item, and the order doesn't
+      depend on the seed.
+
+    A source is only opened (iterated over) when it's first chosen, so sources with weight 0 are never opened. Until
+    a source has been read from, the stochastic strategy assumes its items are as long as the average so far.
+
+    With max_open, and more sources than that, the next item only comes from the max_open sources that were furthest
+    behind their share of the tokens when they were picked, for a run of run_tokens tokens. Then the ones furthest
+    behind are picked again, and sources that weren't are closed, after saving their position (see
+    sprucfluo.checkpoint), to pick up from there when they're picked again. So the proportions only hold over spans of
+    many runs, but sources are only reopened once per run, which is expensive: checkpointable sources like load_corpus
+    and tokenize_and_group_texts seek back to where they were (which means decompressing from the start of a shard
+    without an index), and non-checkpointable sources replay from the start.
+
+    When a source runs out, the mixture stops if stop_when_exhausted (so the proportions hold for everything emitted);
+    otherwise the source is dropped and the rest are mixed in proportion to their weights.
+
+    set_weights changes the weights from the next item on. Token counts for the schedule start again from zero then, so
+    the new proportions don't try to make up for the old ones. token_counts() is the number of tokens emitted from
+    each source in the current iteration. Both are per copy of the pipe, so with a DataLoader with workers, they have
+    to be called in each worker.
+
+    It's checkpointable: its state includes the weights, the token counts, and the state of each source.
+
+    Args:
+        sources: The pipes to mix, by name.
+        weights: The weight of each source, by name. They don't need to add up to 1.
+        seed: The seed for the stochastic strategy. See also set_epoch.
+        strategy: "stochastic" or "deterministic".
+        max_open: The maximum number of sources to have open at once. None means no limit.
+        run_tokens: With max_open, the number of tokens to read from the open sources before picking them again.
+        stop_when_exhausted: Whether to stop when any source runs out, or keep mixing the others.
+    """
+    _rng: Optional[random.Random] = None
+    _sources: Optional[Dict[str, _Source]] = None
+    _weights: Optional[Dict[str, float]] = None
+    _schedule_tokens: Optional[Dict[str, int]] = None
+    # with max_open, the sources the current run reads from, and the tokens read in it
+    _selected: Optional[List[str]] = None
+    _run_tokens: int = 0
+
+    def __init__(self,
+                 sources: Dict[str, IterDataPipe[BatchEncoding]],
+                 weights: Dict[str, float],
+                 seed: int = 0,
+                 strategy: str = "stochastic",
+                 max_open: Optional[int] = None,
+                 stop_when_exhausted: bool = True,
+                 epoch: int = 0,
+                 run_tokens: int = 1 << 20) -> None:
+        super().__init__()
+        if strategy not in _STRATEGIES:
+            raise ValueError(f"strategy should be one of {_STRATEGIES}, got {strategy!r}")
+        if max_open is not None and max_open < 1:
+            raise ValueError(f"max_open should be at least 1, got {max_open}")
+        if run_tokens < 1:
+            raise ValueError(f"run_tokens should be at least 1, got {run_tokens}")
+        _check_weights(weights, sources)
+        if set(weights.keys()) != set(sources.keys()):
+            raise ValueError(f"Every source needs a weight: missing {sorted(set(sources) - set(weights))}")
+        self.sources = sources
+        self.weights = dict(weights)
+        self.seed = seed
+        self.strategy = strategy
+        self.max_open = max_open
+        self.stop_when_exhausted = stop_when_exhausted
+        self.epoch = epoch
+        self.run_tokens = run_tokens
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def set_weights(self, weights: Dict[str, float]) -> None:
+        """Changes the weights of some or all of the sources, from the next item on"""
+        _check_weights(weights, self.sources)
+        self.weights.update(weights)
+        if self._weights is not None:
+            self._weights.update(weights)
+            self._schedule_tokens = {name: 0 for name in self.sources}
+
+    def token_counts(self) -> Dict[str, int]:
+        """The number of tokens emitted from each source so far in the current iteration"""
+        if self._sources is None:
+            return {name: 0 for name in self.sources}
+        return {name: source.num_tokens for name, source in self._sources.items()}
+
+    def __iter__(self) -> Iterator[BatchEncoding]:
+        resume = self._pop_resume_state()
+        self._rng = random.Random(epoch_seed(self.seed, self.epoch))
+        self._sources = sources = {name: _Source(pipe) for name, pipe in self.sources.items()}
+        self._selected = []
+        self._run_tokens = 0
+        self._weights = dict(self.weights)
+        self._schedule_tokens = {name: 0 for name in self.sources}
+        if resume is not None:
+            self._load_state(resume)
+
+        try:
+            while True:
+                name = self._choose()
+                if name is None:
+                    return
+                source = self._sources[name]
+                if source.iterator is None:
+                    source.open()
+                try:
+                    item = next(source.iterator)
+                except StopIteration:
+                    source.exhausted = True
+                    source.close()
+                    if self.stop_when_exhausted:
+                        return
+                    continue
+                source.num_pulled += 1
+                source.num_items += 1
+                n = num_tokens(item)
+                source.num_tokens += n
+                self._schedule_tokens[name] += n
+                self._run_tokens += n
+                yield item
+        finally:
+            # not self._sources, which might belong to a newer iteration by now
+            for source in sources.values():
+                source.close()
+
+    def _choose(self) -> Optional[str]:
+        active = [name for name, source in self._sources.items()
+                  if not source.exhausted and self._weights[name] > 0]
+        if not active:
+            return None
+        if self.max_open is not None and len(active) > self.max_open:
+            active = self._select(active)
+        if self.strategy == "deterministic":
+            return min(active, key=self._behind)
+        # until a source has been read from, assume its items are as long as everyone else's
+        measured = [source for source in self._sources.values() if source.num_items]
+        prior = sum(s.num_tokens for s in measured) / sum(s.num_items for s in measured) if measured else 1.0
+        rates = []
+        for name in active:
+            source = self._sources[name]
+            tokens_per_item = source.num_tokens / source.num_items if source.num_items else prior
+            rates.append(self._weights[name] / max(tokens_per_item, 1.0))
+        return self._rng.choices(active, weights=rates)[0]
+
+    def _behind(self, name: str) -> float:
+        """How far the source is into its share of the tokens: the lower, the further behind it is"""
+        return self._schedule_tokens[name] / self._weights[name]
+
+    def _select(self, active: List[str]) -> List[str]:
+        """The max_open of the active sources to read from in the current run, picking them again if it's over"""
+        selected = [name for name in self._selected if name in active]
+        if self._run_tokens >= self.run_tokens or not selected:
+            selected = []
+            self._run_tokens = 0
+        # ties go to the first
+        for name in sorted(active, key=self._behind):
+            if len(selected) >= self.max_open:
+                break
+            if name not in selected:
+                selected.append(name)
+        for name in self._selected:
+            if name not in selected:
+                self._sources[name].close()
+        self._selected = selected
+        return selected
+
+    def _current_state(self) -> Dict[str, Any]:
+        rng = self._rng or random.Random(epoch_seed(self.seed, self.epoch))
+        sources = self._sources or {name: _Source(pipe) for name, pipe in self.sources.items()}
+        return {
+            "rng": rng.getstate(),
+            "weights": dict(self._weights or self.weights),
+            "schedule_tokens": dict(self._schedule_tokens or {name: 0 for name in self.sources}),
+            "selected": list(self._selected or []),
+            "run_tokens": self._run_tokens,
+            "sources": {name: {"state": source.current_state(), "num_pulled": source.num_pulled,
+                               "num_items": source.num_items, "num_tokens": source.num_tokens,
+                               "exhausted": source.exhausted}
+                        for name, source in sources.items()},
+        }
+
+    def _load_state(self, state: Dict[str, Any]) -> None:
+        self._rng.setstate(state["rng"])
+        self._weights.update(state["weights"])
+        self._schedule_tokens.update(state["schedule_tokens"])
+        self._selected = list(state.get("selected", []))
+        self._run_tokens = state.get("run_tokens", 0)
+        for name, source_state in state["sources"].items():
+            source = self._sources[name]
+            source.state = source_state["state"]
+            source.num_pulled = source_state["num_pulled"]
+            source.num_items = source_state["num_items"]
+            source.num_tokens = source_state["num_tokens"]
+            source.exhausted = source_state["exhausted"]
+
+
+def _check_weights(weights: Dict[str, float], sources: Dict[str, Any]) -> None:
+    unknown = set(weights) - set(sources)
+    if unknown:
+        raise ValueError(f"Weights for unknown sources: {sorted(unknown)}")
+    negative = [name for name, weight in weights.items() if weight < 0]
+    if negative:
+        raise ValueError(f"Weights can't be negative: {sorted(negative)}")
+
+
+def mix_corpora(corpora: Dict[str, Union[str, List[str]]],
+                weights: Dict[str, float],
+                tokenizer: PreTrainedTokenizerBase,
+                seq_len: int,
+                seed: int = 0,
+                strategy: str = "stochastic",
+                max_open: Optional[int] = None,
+                stop_when_exhausted: bool = True,
+                run_tokens: int = 1 << 20,
+                batch_size: int = 1000,
+                **load_corpus_kwargs) -> TokenMixtureIterDataPipe:
+    """
+    Loads (see load_corpus) and tokenizes (see tokenize_and_group_texts) each corpus, and mixes them in proportion to
+    weights, by tokens. See TokenMixtureIterDataPipe.
+
+    Args:
+        corpora: The paths of each corpus, by name.
+        weights: The weight of each corpus, by name.
+        tokenizer: The tokenizer to use.
+        seq_len: The length of sequences to emit.
+        seed: The seed for the stochastic strategy.
+        strategy: "stochastic" or "deterministic".
+        max_open: The maximum number of corpora to read from at once.
+        run_tokens: With max_open, the number of tokens to read from the open corpora before picking them again.
+        stop_when_exhausted: Whether to stop when any corpus runs out, or keep mixing the others.
+        batch_size: The number of documents to tokenize at once.
+        load_corpus_kwargs: Passed to load_corpus, e.g. extra_fsspec_args or shuffle_seed.
+    """
+    sources = {name: tokenize_and_group_texts(load_corpus(paths, **load_corpus_kwargs), tokenizer=tokenizer,
+                                              seq_len=seq_len, batch_size=batch_size)
+               for name, paths in corpora.items()}
+    return TokenMixtureIterDataPipe(sources, weights, seed=seed, strategy=strategy, max_open=max_open,
+                                    stop_when_exhausted=stop_when_exhausted, run_tokens=run_tokens)
+
+
+__all__ = ["TokenMixtureIterDataPipe", "mix_corpora", "num_tokens"]
@@ -0,0 +1,204 @@
+# Copyright 2022 The Board of Trustees of the Leland Stanford Junior University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Packing whole documents into sequences, as an alternative to concatenating them and cutting every seq_len tokens"""
+from __future__ import annotations
+
+import bisect
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional, TYPE_CHECKING
+
+import numpy as np
+from torch.utils.data import functional_datapipe, IterDataPipe
+
+from .checkpoint import Checkpointable, iter_source, source_state_dict
+from .encoding import batch_encoding
+
+if TYPE_CHECKING:
+    from transformers import BatchEncoding
+
+# -100 is pytorch's label mask
+_IGNORE_INDEX = -100
+
+Document = Dict[str, List[int]]
+
+
+def best_fit_decreasing(lengths: List[int], capacity: int) -> List[List[int]]:
+    """
+    Packs items of the given lengths (each at most capacity) into bins of the given capacity: longest first, each into
+    the fullest bin it fits in, or a new one. Returns the indices of the items in each bin.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: (-lengths[i], i))
+    bins: List[List[int]] = []
+    # (space left, bin), in increasing order
+    space: List[tuple] = []
+    for i in order:
+        pos = bisect.bisect_left(space, (lengths[i], -1))
+        if pos == len(space):
+            bins.append([i])
+            left, b = capacity - lengths[i], len(bins) - 1
+        else:
+            left, b = space.pop(pos)
+            bins[b].append(i)
+            left -= lengths[i]
+        bisect.insort(space, (left, b))
+    return bins
+
+
+@functional_datapipe("pack_texts")
+class PackTextsIterDataPipe(Checkpointable, IterDataPipe["BatchEncoding"]):
+    r"""
+    An alternative to group_texts that packs whole documents into sequences of at most seq_len tokens, rather than
+    concatenating them and cutting every seq_len tokens, which splits most documents between two sequences.
+
+    Documents are collected into a window of window_size documents, which is packed with best-fit-decreasing (see
+    best_fit_decreasing). Only documents longer than seq_len are split: into seq_len-token pieces, which are sequences
+    by themselves, and the rest, which is packed like any other document. The emptiest sequence of each window is put
+    back into the next one, so that the sequences that are emitted are nearly full.
+
+    Each sequence is a BatchEncoding of lists, no longer than seq_len, of:
+
+    * the input's keys (usually input_ids and attention_mask), concatenated
+    * labels: the input's labels, or input_ids, with -100 on the first token of every document
+    * position_ids: the position of each token in its document, so they start from 0 at every document boundary. A
+      model can use them for block-diagonal attention, so that documents don't attend to each other.
+
+    The sequences aren't padded; tensor_batches pads them to seq_len. padding_fraction() is the fraction of the
+    tokens in the sequences so far that would be padding, and stats() has the rest of the counts.
+
+    It's checkpointable: its state is the documents in the window, the sequences not yet emitted, and the state of the
+    source.
+
+    Args:
+        source_datapipe: The pipe of tokenized batches, each a BatchEncoding (or dict) of per-document sequences.
+        seq_len: The maximum length of sequences to emit.
+        window_size: The number of documents to pack at once. Bigger windows pack better, and hold more tokens.
+    """
+    _window: Optional[List[Document]] = None
+    _ready: Optional[Deque[Dict[str, List[int]]]] = None
+    _num_pulled: int = 0
+    _stats: Optional[Dict[str, int]] = None
+
+    def __init__(self, source_datapipe: IterDataPipe[BatchEncoding], seq_len: int, window_size: int = 1000) -> None:
+        assert window_size > 0, "window_size should be larger than 0"
+        self.source_datapipe = source_datapipe
+        self.seq_len = seq_len
+        self.window_size = window_size
+
+    def __iter__(self) -> Iterator[BatchEncoding]:
+        resume = self._pop_resume_state()
+        self._window = []
+        self._ready = deque()
+        self._num_pulled = 0
+        self._stats = _new_stats()
+        source_state = None
+        if resume is not None:
+            self._window = resume["window"]
+            self._ready.extend(resume["ready"])
+            self._num_pulled = resume["num_pulled"]
+            self._stats = dict(resume["stats"])
+            source_state = resume["source"]
+
+        yield from self._emit_ready()
+        for encoding in iter_source(self.source_datapipe, source_state):
+            self._num_pulled += 1
+            for doc in _documents(encoding):
+                self._add(doc)
+            if len(self._window) >= self.window_size:
+                self._pack(final=False)
+            yield from self._emit_ready()
+
+        self._pack(final=True)
+        yield from self._emit_ready()
+
+    def _emit_ready(self) -> Iterator[BatchEncoding]:
+        while self._ready:
+            yield batch_encoding(self._ready.popleft())
+
+    def _add(self, doc: Document) -> None:
+        length = len(doc["input_ids"])
+        if length == 0:
+            return
+        self._stats["documents"] += 1
+        if length > self.seq_len:
+            self._stats["split_documents"] += 1
+        while length > self.seq_len:
+            self._ready.append(self._sequence([{k: v[:self.seq_len] for k, v in doc.items()}]))
+            doc = {k: v[self.seq_len:] for k, v in doc.items()}
+            length -= self.seq_len
+        if length > 0:
+            self._window.append(doc)
+
+    def _pack(self, final: bool) -> None:
+        window = self._window
+        bins = best_fit_decreasing([len(doc["input_ids"]) for doc in window], self.seq_len)
+        self._window = []
+        if not final and len(bins) > 1:
+            # best_fit_decreasing adds to the fullest bins first, so the emptiest is one of the last ones
+            emptiest = min(range(len(bins)), key=lambda b: (sum(len(window[i]["input_ids"]) for i in bins[b]), -b))
+            self._window = [window[i] for i in sorted(bins.pop(emptiest))]
+        for b in bins:
+            self._ready.append(self._sequence([window[i] for i in sorted(b)]))
+
+    def _sequence(self, docs: List[Document]) -> Dict[str, List[int]]:
+        sequence: Dict[str, List[int]] = {k: [] for k in docs[0]}
+        labels: List[int] = []
+        position_ids: List[int] = []
+        for doc in docs:
+            for k, v in doc.items():
+                sequence[k].extend(v)
+            doc_labels = list(doc.get("labels", doc["input_ids"]))
+            doc_labels[0] = _IGNORE_INDEX
+            labels.extend(doc_labels)
+            position_ids.extend(range(len(doc["input_ids"])))
+        sequence["labels"] = labels
+        sequence["position_ids"] = position_ids
+        self._stats["sequences"] += 1
+        self._stats["tokens"] += len(position_ids)
+        return sequence
+
+    def stats(self) -> Dict[str, Any]:
+        """Counts of the documents read and the sequences and tokens emitted (or about to be) so far"""
+        stats = dict(self._stats or _new_stats())
+        stats["padding_fraction"] = self.padding_fraction()
+        return stats
+
+    def padding_fraction(self) -> float:
+        """The fraction of the tokens in the sequences so far that are padding, when they're padded to seq_len"""
+        stats = self._stats or _new_stats()
+        if stats["sequences"] == 0:
+            return 0.0
+        return 1.0 - stats["tokens"] / (stats["sequences"] * self.seq_len)
+
+    def _current_state(self) -> Dict[str, Any]:
+        return {
+            "window": list(self._window or []),
+            "ready": list(self._ready or []),
+            "num_pulled": self._num_pulled,
+            "stats": dict(self._stats or _new_stats()),
+            "source": source_state_dict(self.source_datapipe, self._num_pulled),
+        }
+
+
+def _new_stats() -> Dict[str, int]:
+    return {"documents": 0, "split_documents": 0, "sequences": 0, "tokens": 0}
+
+
+def _documents(encoding) -> Iterator[Document]:
+    """The documents of a tokenized batch, each a dict of lists"""
+    columns = {k: [v.tolist() if isinstance(v, np.ndarray) else list(v) for v in seqs] for k, seqs in encoding.items()}
+    for i in range(len(columns["input_ids"])):
+        yield {k: seqs[i] for k, seqs in columns.items()}
+
+
+__all__ = ["PackTextsIterDataPipe", "best_fit_decreasing"]
@@ -0,0 +1,137 @@
+# Copyright 2022 The Board of Trustees of the Leland Stanford Junior University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import TypeVar, Iterator, Callable, Optional, Sized, Dict, Any
+
+from torch.utils.data import functional_datapipe, IterDataPipe
+
+from .checkpoint import Checkpointable, iter_source, source_state_dict
+
+T_co = TypeVar('T_co', covariant=True)
+U_contra = TypeVar('U_contra', contravariant=True)
+
+# the function a process pool worker applies. Set once per worker, so we don't pickle fn (e.g. a tokenizer) per item.
+_worker_fn: Optional[Callable] = None
+
+
+def _init_worker(fn: Callable) -> None:
+    global _worker_fn
+    _worker_fn = fn
+
+
+def _apply_worker_fn(x):
+    return _worker_fn(x)
+
+
+@functional_datapipe("parallel_map")
+class ParallelMapperIterDataPipe(Checkpointable, IterDataPipe[T_co]):
+    r"""
+    Like map, but applies fn in a pool of threads or processes, with a bounded number of items in flight
+    (functional name: ``parallel_map``).
+
+    Threads are the right choice for functions that release the GIL, like HuggingFace's fast tokenizers, and are the
+    only choice inside a DataLoader worker, since those are daemonic processes and can't have children. With
+    processes, fn is sent to each worker once, so it must be picklable.
+
+    Args:
+        source_datapipe: The pipe to map over.
+        fn: The function to apply to each item.
+        num_workers: The number of threads or processes to use.
+        executor: Either "thread" or "process".
+        ordered: If True, items are emitted in the same order as the source, so the output is deterministic.
+            If False, items are emitted as soon as they're done, which avoids waiting on stragglers.
+        max_in_flight: The maximum number of items that are submitted but not yet emitted. Defaults to 2*num_workers.
+
+    With ordered=True, it's checkpointable: items that were in flight are recomputed on resume.
+    """
+    _source_state: Optional[Dict[str, Any]] = None
+    _num_emitted: int = 0
+
+    def __init__(self,
+                 source_datapipe: IterDataPipe[U_contra],
+                 fn: Callable[[U_contra], T_co],
+                 num_workers: int,
+                 executor: str = "thread",
+                 ordered: bool = True,
+                 max_in_flight: Optional[int] = None) -> None:
+        assert num_workers > 0, "num_workers should be larger than 0"
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unsupported executor: {executor}. Expected 'thread' or 'process'.")
+        self.source_datapipe = source_datapipe
+        self.fn = fn
+        self.num_workers = num_workers
+        self.executor = executor
+        self.ordered = ordered
+        self.max_in_flight = max_in_flight or 2 * num_workers
+
+    def _make_executor(self):
+        if self.executor == "thread":
+            return ThreadPoolExecutor(max_workers=self.num_workers), self.fn
+        else:
+            pool = ProcessPoolExecutor(max_workers=self.num_workers, initializer=_init_worker, initargs=(self.fn,))
+            return pool, _apply_worker_fn
+
+    def __iter__(self) -> Iterator[T_co]:
+        resume = self._pop_resume_state()
+        self._source_state = None if resume is None else resume["source"]
+        self._num_emitted = 0 if resume is None else resume["num_emitted"]
+        num_pulled = self._num_emitted
+        # we've pulled items that haven't been emitted, so to checkpoint, we remember the source's state as of each one
+        track_state = self.ordered
+
+        pool, fn = self._make_executor()
+        pending: deque = deque()
+        try:
+            for x in iter_source(self.source_datapipe, self._source_state):
+                num_pulled += 1
+                state = source_state_dict(self.source_datapipe, num_pulled) if track_state else None
+                pending.append((pool.submit(fn, x), state))
+                if len(pending) >= self.max_in_flight:
+                    yield self._next_result(pending)
+            while pending:
+                yield self._next_result(pending)
+        finally:
+            for future, _ in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+
+    def _next_result(self, pending: deque) -> T_co:
+        if self.ordered:
+            future, state = pending.popleft()
+        else:
+            done, _ = wait([f for f, _ in pending], return_when=FIRST_COMPLETED)
+            # pick the earliest finished item, so that we're as close to ordered as we can be
+            future, state = next(p for p in pending if p[0] in done)
+            pending.remove((future, state))
+        result = future.result()
+        self._source_state = state
+        self._num_emitted += 1
+        return result
+
+    def _current_state(self) -> Dict[str, Any]:
+        if not self.ordered:
+            raise ValueError("parallel_map can only be checkpointed with ordered=True")
+        source_state = self._source_state
+        if source_state is None:
+            source_state = source_state_dict(self.source_datapipe, self._num_emitted)
+        return {"source": source_state, "num_emitted": self._num_emitted}
+
+    def __len__(self) -> int:
+        if isinstance(self.source_datapipe, Sized):
+            return len(self.source_datapipe)
+        raise TypeError("{} instance doesn't have valid length".format(type(self).__name__))
+
+
+__all__ = ['ParallelMapperIterDataPipe']
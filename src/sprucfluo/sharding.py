@@ -11,10 +11,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import heapq
 import itertools
-from typing import TypeVar, Iterator, Sized, Callable, List, Iterable, Optional
+from typing import TypeVar, Iterator, Sized, Callable, List, Iterable, Optional, Dict, Any, Sequence, Tuple
 
 from torch.utils.data import functional_datapipe, IterDataPipe
+from .checkpoint import Checkpointable, iter_source, source_state_dict
+from .shuffle import set_epoch
 from .utils import pytorch_worker_info
 
 T_co = TypeVar('T_co', covariant=True)
@@ -22,25 +25,75 @@ U_contra = TypeVar('U_contra', contravariant=True)
 T = TypeVar('T', covariant=True)
 
 
+def lpt_partition(weights: Sequence[float], num_parts: int) -> List[List[int]]:
+    """
+    Divides the indices of weights into num_parts parts of roughly equal total weight, by assigning the heaviest
+    remaining item to the lightest part (longest processing time first). Each part is in increasing order.
+    """
+    order = sorted(range(len(weights)), key=lambda i: (-weights[i], i))
+    loads = [(0, part) for part in range(num_parts)]
+    parts: List[List[int]] = [[] for _ in range(num_parts)]
+    for i in order:
+        load, part = heapq.heappop(loads)
+        parts[part].append(i)
+        heapq.heappush(loads, (load + weights[i], part))
+    return [sorted(part) for part in parts]
+
+
+def sharding_position(shard_by_worker: bool = False) -> Tuple[int, int]:
+    """
+    Returns (rank, world_size) to shard by. If shard_by_worker, the DataLoader workers of all the ranks are sharded
+    between as though they were ranks themselves: worker w of rank r is rank r * num_workers + w.
+    """
+    rank, world_size, worker, num_workers = pytorch_worker_info()
+    if shard_by_worker:
+        return rank * num_workers + worker, world_size * num_workers
+    return rank, world_size
+
+
+def _balanced_part(shards: List[T], weights: Sequence[float], rank: int, world_size: int) -> List[T]:
+    return [shards[i] for i in lpt_partition(weights, world_size)[rank]]
+
+
 @functional_datapipe("shard_by_rank")
 class ShardByRankDataPipe(IterDataPipe[T_co]):
     r"""
     A data pipe that shards the stream by node: each node will only see its fraction of the data. Typically used for
     sharding the data for distributed training. If you want workers, then use the built-in .sharding_filter()
+
+    Items are dealt out round-robin, unless shard_weights is given, in which case it's called with the list of all
+    the items (e.g. shard paths) and should return their weights (e.g. sizes, see sprucfluo.files.shard_sizes). Each
+    node then gets a set of items of roughly equal total weight. See lpt_partition.
+
+    If shard_by_worker, each DataLoader worker of each node gets its own fraction instead (see sharding_position),
+    so there's no need for .sharding_filter().
     """
 
-    def __init__(self, source_datapipe: IterDataPipe[T_co]) -> None:
+    def __init__(self, source_datapipe: IterDataPipe[T_co],
+                 shard_weights: Optional[Callable[[List[T_co]], Sequence[float]]] = None,
+                 shard_by_worker: bool = False) -> None:
         self.source_datapipe: IterDataPipe[str] = source_datapipe
+        self.shard_weights = shard_weights
+        self.shard_by_worker = shard_by_worker
 
     def __iter__(self) -> Iterator[T_co]:
-        rank, world_size, _, _ = pytorch_worker_info()
+        rank, world_size = sharding_position(self.shard_by_worker)
         if world_size == 1:
             return iter(self.source_datapipe)
+        elif self.shard_weights is not None:
+            shards = list(self.source_datapipe)
+            return iter(_balanced_part(shards, self.shard_weights(shards), rank, world_size))
         else:
             return itertools.islice(iter(self.source_datapipe), rank, None, world_size)
 
     def __len__(self):
-        rank, world_size, _, _ = pytorch_worker_info()
+        return self.length_at(*sharding_position(self.shard_by_worker))
+
+    def length_at(self, rank: int, world_size: int) -> int:
+        """The length of the stream of the given rank."""
+        if self.shard_weights is not None and world_size > 1:
+            shards = list(self.source_datapipe)
+            return len(_balanced_part(shards, self.shard_weights(shards), rank, world_size))
         if isinstance(self.source_datapipe, Sized):
             return len(self.source_datapipe) // world_size + \
                    (1 if (rank < len(self.source_datapipe) % world_size) else 0)
@@ -48,7 +101,7 @@ class ShardByRankDataPipe(IterDataPipe[T_co]):
 
 
 @functional_datapipe("flat_shard_by_rank")
-class FlatShardByRankDataPipe(IterDataPipe[T_co]):
+class FlatShardByRankDataPipe(Checkpointable, IterDataPipe[T_co]):
     r"""
         Similar to ShardByRankDataPipe, but instead of sharding by node, can iterate within a shard if necessary.
         This requires that the sharding is passed a function that can do the work within a shard.
@@ -74,33 +127,109 @@ class FlatShardByRankDataPipe(IterDataPipe[T_co]):
         Note that we don't enforce that each node sees the same number of examples, and
         this can in theory be highly imbalanced if This should be enforced
         at the dataloader level...
+
+        If shard_by_worker, the "ranks" are the DataLoader workers of all the nodes (see sharding_position), so each
+        worker only opens its own shards, and there's no need for .sharding_filter(). Don't use both!
+
+        With shard_weights, shards are instead divided into parts of roughly equal weight, like ShardByRankDataPipe
+        does, and there's only a remnant if there are fewer shards than ranks.
+
+        Iterating within the remnant shards means every rank reads all of them. If split_remnant is given, it's called
+        as split_remnant(remnant, rank, world_size) and should return this rank's part of the remnant (e.g. ranges of
+        the shards, see sprucfluo.index.split_shard_ranges), which is then read in full; or None if it can't split
+        them, in which case we iterate within the shards as above.
+
+        It's checkpointable, and resumes the pipe that fn returns through its own state if that's checkpointable.
+
+        The pipes fn returns are made during iteration, so set_epoch can't reach them. Instead, set_epoch(epoch) here
+        is passed on to each of them as it's made (see sprucfluo.set_epoch), e.g. to an interleave_shards in fn.
     """
-    # TODO: We could be fancier and subdivide the remainder, but that makes enforcing evenness a bit trickier.
+    _in_remnant: bool = False
+    _inner: Optional[Iterable] = None
+    _num_pulled: int = 0
+
     def __init__(self,
                  source_datapipe: IterDataPipe[U_contra],
-                 fn: Callable[[Iterable[U_contra]], Iterable[T_co]]) -> None:
+                 fn: Callable[[Iterable[U_contra]], Iterable[T_co]],
+                 split_remnant: Optional[Callable[[List[U_contra], int, int], Optional[List[U_contra]]]] = None,
+                 shard_weights: Optional[Callable[[List[U_contra]], Sequence[float]]] = None,
+                 shard_by_worker: bool = False) -> None:
         self.source_datapipe: IterDataPipe[U_contra] = source_datapipe
         self.fn = fn
+        self.split_remnant = split_remnant
+        self.shard_weights = shard_weights
+        self.shard_by_worker = shard_by_worker
+        self.epoch: Optional[int] = None
         self._chunk: Optional[List[U_contra]] = None
 
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _make_inner(self, shards: Iterable[U_contra]) -> Iterable[T_co]:
+        inner = self.fn(shards)
+        if self.epoch is not None and isinstance(inner, IterDataPipe):
+            set_epoch(inner, self.epoch)
+        return inner
+
     def __iter__(self) -> Iterator[T_co]:
-        rank, world_size, _, _ = pytorch_worker_info()
+        resume = self._pop_resume_state()
+        self._in_remnant = False
+        self._inner = None
+        self._num_pulled = 0
+        inner_state = None
+        if resume is not None:
+            self._in_remnant = resume["in_remnant"]
+            self._num_pulled = resume["num_pulled"]
+            inner_state = resume["inner"]
+
+        rank, world_size = sharding_position(self.shard_by_worker)
         if world_size == 1:
-            yield from self.fn(self.source_datapipe)
+            yield from self._iter_inner(self._make_inner(self.source_datapipe), inner_state)
         else:
-            it = iter(self.source_datapipe)
-
-            yield from self.fn(self._yield_while_chunks(it, rank, world_size))
+            if not self._in_remnant:
+                yield from self._iter_inner(self._make_inner(self._main_shards(rank, world_size)), inner_state)
+                inner_state = None
+            else:
+                # we only need to know what the remnant is
+                for _ in self._main_shards(rank, world_size):
+                    pass
 
             # we're in the remainder, so every rank will look at each shard
             if self._chunk:
-                yield from self._handle_remnant(self._chunk, rank, world_size)
+                yield from self._handle_remnant(self._chunk, rank, world_size, inner_state)
                 self._chunk = None
 
+    def _iter_inner(self, inner: Iterable[T_co], inner_state: Optional[Dict[str, Any]]) -> Iterator[T_co]:
+        self._inner = inner
+        for x in iter_source(inner, inner_state):
+            self._num_pulled += 1
+            yield x
+
+    def _current_state(self) -> Dict[str, Any]:
+        inner = None
+        if self._inner is not None:
+            inner = source_state_dict(self._inner, self._num_pulled)
+        return {"in_remnant": self._in_remnant, "num_pulled": self._num_pulled, "inner": inner}
+
     @staticmethod
     def _take(it: Iterator[T], n: int) -> List[T]:
         return list(itertools.islice(it, n))
 
+    def _main_shards(self, rank: int, world_size: int) -> Iterator[U_contra]:
+        """The shards this rank reads by itself. Once they've all been yielded, self._chunk is the remnant."""
+        if self.shard_weights is None:
+            yield from self._yield_while_chunks(iter(self.source_datapipe), rank, world_size)
+        else:
+            main, remnant = self._balanced_partition(list(self.source_datapipe), rank, world_size)
+            yield from main
+            self._chunk = remnant
+
+    def _balanced_partition(self, shards: List[U_contra], rank: int, world_size: int) \
+            -> Tuple[List[U_contra], List[U_contra]]:
+        if len(shards) < world_size:
+            return [], shards
+        return _balanced_part(shards, self.shard_weights(shards), rank, world_size), []
+
     def _yield_while_chunks(self, it: Iterator[T], rank: int, world_size: int) -> Iterator[T]:
         next_chunk = FlatShardByRankDataPipe._take(it, world_size)
 
@@ -112,27 +241,157 @@ class FlatShardByRankDataPipe(IterDataPipe[T_co]):
             # ugh state
             self._chunk = next_chunk
 
-    def _handle_remnant(self, shards: List[U_contra], rank, world_size):
-        all_remaining = iter(self.fn(shards))
+    def _handle_remnant(self, shards: List[U_contra], rank, world_size, inner_state=None):
+        if not self._in_remnant:
+            self._in_remnant = True
+            self._num_pulled = 0
+
+        part = self._split_remnant(shards, rank, world_size)
+        if part is not None:
+            yield from self._iter_inner(self._make_inner(part), inner_state)
+            return
+
+        self._inner = self._make_inner(shards)
+        all_remaining = iter_source(self._inner, inner_state)
 
         next_chunk = FlatShardByRankDataPipe._take(all_remaining, world_size)
+        self._num_pulled += len(next_chunk)
 
         while len(next_chunk) == world_size:
             yield next_chunk[rank]
             next_chunk = FlatShardByRankDataPipe._take(all_remaining, world_size)
+            self._num_pulled += len(next_chunk)
 
         if rank < len(next_chunk):
             yield next_chunk[rank]
 
+    def __len__(self) -> int:
+        return self.length_at(*sharding_position(self.shard_by_worker))
 
+    def length_at(self, rank: int, world_size: int) -> int:
+        """The length of the stream of the given rank, which any rank can compute. See EqualLengthIterDataPipe."""
+        # the paths are cheap to list, and fn's pipes have lengths if, e.g., all the shards have indexes
+        shards = list(self.source_datapipe)
+        if world_size == 1:
+            return len(self.fn(shards))
+        if self.shard_weights is not None:
+            main, remnant = self._balanced_partition(shards, rank, world_size)
+        else:
+            num_chunked = len(shards) - len(shards) % world_size
+            main, remnant = shards[rank:num_chunked:world_size], shards[num_chunked:]
+        length = len(self.fn(main)) if main else 0
+        part = self._split_remnant(remnant, rank, world_size) if remnant else None
+        if part is not None:
+            length += len(self.fn(part))
+        elif remnant:
+            remnant_length = len(self.fn(remnant))
+            length += remnant_length // world_size + (1 if rank < remnant_length % world_size else 0)
+        return length
+
+    def lengths(self, world_size: int) -> List[int]:
+        """The lengths of the streams of all the ranks, like length_at, but listing and weighing the shards once."""
+        shards = list(self.source_datapipe)
+        if world_size == 1:
+            return [len(self.fn(shards))]
+        if self.shard_weights is not None and len(shards) >= world_size:
+            mains = [[shards[i] for i in part] for part in lpt_partition(self.shard_weights(shards), world_size)]
+            remnant = []
+        elif self.shard_weights is not None:
+            mains, remnant = [[]] * world_size, shards
+        else:
+            num_chunked = len(shards) - len(shards) % world_size
+            mains = [shards[rank:num_chunked:world_size] for rank in range(world_size)]
+            remnant = shards[num_chunked:]
+        lengths = [len(self.fn(main)) if main else 0 for main in mains]
+        remnant_length = None
+        for rank in range(world_size):
+            part = self._split_remnant(remnant, rank, world_size) if remnant else None
+            if part is not None:
+                lengths[rank] += len(self.fn(part))
+            elif remnant:
+                # every rank reads all of the remnant, so we only need its length once
+                if remnant_length is None:
+                    remnant_length = len(self.fn(remnant))
+                lengths[rank] += remnant_length // world_size + (1 if rank < remnant_length % world_size else 0)
+        return lengths
+
+    def _split_remnant(self, shards: List[U_contra], rank: int, world_size: int) -> Optional[List[U_contra]]:
+        if self.split_remnant is None:
+            return None
+        return self.split_remnant(shards, rank, world_size)
+
+
+@functional_datapipe("equalize_length")
+class EqualLengthIterDataPipe(Checkpointable, IterDataPipe[T_co]):
+    r"""
+    Makes every rank's stream exactly the same length, so that no rank runs out of data while the others wait for it
+    in a collective op, which hangs DDP and FSDP at the end of an epoch (functional name: ``equalize_length``).
 
+    If length is given, every rank yields exactly length items: the source is truncated if it's longer, and cycled
+    (iterated again from the start) if it's shorter. Use this at the end of the pipeline, e.g. with the number of
+    steps in an epoch.
 
+    Otherwise, the source has to be able to tell how long every rank's stream is, with length_at(rank, world_size),
+    as flat_shard_by_rank and shard_by_rank can when their items have lengths (e.g. load_corpus over shards with
+    indexes, see sprucfluo.index). Every rank computes all the lengths by itself, so there's no communication, and
+    truncates its stream to the shortest. Note that this equalizes documents, so it has to come before anything that
+    changes the number of items differently on each rank, like grouping texts.
 
+    It's checkpointable: its state is the number of items yielded, the number of times the source has been cycled,
+    and the state of the source.
+    """
+    _num_emitted: int = 0
+    _num_cycles: int = 0
+    _num_pulled: int = 0
 
+    def __init__(self, source_datapipe: IterDataPipe[T_co], length: Optional[int] = None) -> None:
+        self.source_datapipe = source_datapipe
+        self.length = length
 
-
-
-
-
-
-
+    def __iter__(self) -> Iterator[T_co]:
+        resume = self._pop_resume_state()
+        length = len(self)
+        self._num_emitted, self._num_cycles, self._num_pulled = 0, 0, 0
+        source_state = None
+        if resume is not None:
+            self._num_emitted, self._num_cycles = resume["num_emitted"], resume["num_cycles"]
+            self._num_pulled = resume["num_pulled"]
+            source_state = resume["source"]
+
+        while self._num_emitted < length:
+            it = iter_source(self.source_datapipe, source_state)
+            source_state = None
+            while self._num_emitted < length:
+                try:
+                    x = next(it)
+                except StopIteration:
+                    break
+                self._num_pulled += 1
+                self._num_emitted += 1
+                yield x
+
+            if self._num_emitted < length:
+                if self._num_pulled == 0:
+                    raise ValueError(f"Can't make a stream of length {length} by cycling an empty source")
+                self._num_cycles += 1
+                self._num_pulled = 0
+
+    def _current_state(self) -> Dict[str, Any]:
+        return {"num_emitted": self._num_emitted, "num_cycles": self._num_cycles, "num_pulled": self._num_pulled,
+                "source": source_state_dict(self.source_datapipe, self._num_pulled)}
+
+    def __len__(self) -> int:
+        if self.length is not None:
+            return self.length
+        return min(self.rank_lengths())
+
+    def rank_lengths(self) -> List[int]:
+        """The lengths of the source's streams on every rank."""
+        length_at = getattr(self.source_datapipe, "length_at", None)
+        if length_at is None:
+            raise TypeError(f"{type(self).__name__} needs a length, or a source with length_at(rank, world_size)")
+        _, world_size = sharding_position(getattr(self.source_datapipe, "shard_by_worker", False))
+        lengths = getattr(self.source_datapipe, "lengths", None)
+        if lengths is not None:
+            return lengths(world_size)
+        return [length_at(rank, world_size) for rank in range(world_size)]
@@ -1,52 +1,531 @@
+import hashlib
+import itertools
 import random
-from typing import Tuple, Iterator, Union, List, TypeVar, Sized
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Tuple, Iterator, Union, List, TypeVar, Sized, Optional, Dict, Any, Callable
 
+import numpy as np
+import torch
 from torch.utils.data import functional_datapipe, IterDataPipe
 
+from .checkpoint import Checkpointable, iter_source, source_state_dict
+
 T_co = TypeVar('T_co', covariant=True)
+U = TypeVar('U')
+
+
+def epoch_seed(seed: int, epoch: int) -> int:
+    """The seed to use in the given epoch for a pipe seeded with seed. Epoch 0 uses seed itself."""
+    if epoch == 0:
+        return seed
+    digest = hashlib.sha256(f"{seed}/{epoch}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+def set_epoch(pipe: IterDataPipe, epoch: int) -> None:
+    """
+    Calls set_epoch(epoch) on pipe and on every pipe upstream of it that has it (shuffle_shards, interleave_shards and
+    seeded_shuffle), so that the next iteration is shuffled differently from the last. Like DistributedSampler, call it
+    at the start of every epoch, before iterating (or making a DataLoader iterator), on every rank. The epoch isn't
+    part of a pipeline's state, so call it before resuming too.
+    """
+    seen = set()
+    pending = [pipe]
+    while pending:
+        p = pending.pop()
+        if id(p) in seen:
+            continue
+        seen.add(id(p))
+        method = getattr(p, "set_epoch", None)
+        if callable(method):
+            method(epoch)
+        for value in vars(p).values():
+            if isinstance(value, dict):
+                value = list(value.keys()) + list(value.values())
+            elif not isinstance(value, (list, tuple)):
+                value = [value]
+            pending.extend(v for v in value if isinstance(v, IterDataPipe))
+
+
+@functional_datapipe('shuffle_shards')
+class ShardShufflerIterDataPipe(IterDataPipe[T_co]):
+    """
+    Shuffles a (short) list of shards, differently every epoch: the order is a function of seed and epoch only, so it's
+    the same on every rank, and it can come before sharding by rank. Use set_epoch to move to the next epoch.
+
+    The buffer in seeded_shuffle only mixes documents that are near each other in the stream, so if the shards are
+    sorted by source, a buffer shuffle alone mixes sources poorly. Shuffling the shards, reading several at once
+    (interleave_shards), and then shuffling a buffer gets close to a global shuffle with a much smaller buffer.
+    """
+
+    def __init__(self, source_datapipe: IterDataPipe[T_co], seed: int, epoch: int = 0) -> None:
+        super().__init__()
+        self.source_datapipe = source_datapipe
+        self.seed = seed
+        self.epoch = epoch
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[T_co]:
+        shards = list(self.source_datapipe)
+        random.Random(epoch_seed(self.seed, self.epoch)).shuffle(shards)
+        yield from shards
+
+    def __len__(self) -> int:
+        if isinstance(self.source_datapipe, Sized):
+            return len(self.source_datapipe)
+        raise TypeError("{} instance doesn't have valid length".format(type(self).__name__))
+
+
+_END = object()
+
+
+class _OpenShard:
+    def __init__(self, shard, pipe: IterDataPipe, state: Optional[Dict[str, Any]] = None):
+        self.shard = shard
+        self.pipe = pipe
+        self.iterator = iter_source(pipe, state)
+        self.num_pulled = 0
+        # the first item, if it's being pulled in the background
+        self.first: Optional[Future] = None
+
+    def next(self):
+        """The next item, or _END"""
+        if self.first is not None:
+            first, self.first = self.first, None
+            return first.result()
+        return next(self.iterator, _END)
+
+
+@functional_datapipe('interleave_shards')
+class ShardInterleaverIterDataPipe(Checkpointable, IterDataPipe[T_co]):
+    """
+    Reads num_open shards at a time, and yields the next item of a randomly chosen one of them each time. When a shard
+    runs out, the next one is opened in its place. fn(shard) makes the pipe that reads a shard, e.g. the documents in a
+    file. Shards are only opened when they're needed, so there are never more than num_open open at once.
+
+    If prefetch > 0, the next prefetch shards are opened ahead of time: their pipes are made, and their first items
+    pulled, in background threads, so that replacing a shard that runs out doesn't wait on opening the next one.
+
+    The choices are a function of seed and epoch (see set_epoch). It's checkpointable: its state is the generator state
+    and the state of each open shard's pipe. Prefetched shards are opened again from the start when resuming.
+    """
+    _rng: Optional[random.Random] = None
+    _streams: Optional[List[_OpenShard]] = None
+    _pending: Optional[deque] = None
+    _num_opened: int = 0
+
+    def __init__(self,
+                 source_datapipe: IterDataPipe[U],
+                 fn: Callable[[U], IterDataPipe[T_co]],
+                 num_open: int,
+                 seed: int,
+                 epoch: int = 0,
+                 prefetch: int = 0) -> None:
+        super().__init__()
+        assert num_open > 0, "num_open should be larger than 0"
+        self.source_datapipe = source_datapipe
+        self.fn = fn
+        self.num_open = num_open
+        self.seed = seed
+        self.epoch = epoch
+        self.prefetch = prefetch
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[T_co]:
+        resume = self._pop_resume_state()
+        self._rng = rng = random.Random(epoch_seed(self.seed, self.epoch))
+        self._streams = streams = []
+        self._pending = pending = deque()
+        self._num_opened = 0
+        # shards that had been taken from the source to prefetch, but weren't open yet
+        taken: List[U] = []
+        if resume is not None:
+            rng.setstate(resume["rng"])
+            self._num_opened = resume["num_opened"]
+            streams.extend(_OpenShard(shard, self.fn(shard), state) for shard, state in resume["open"])
+            taken = list(resume.get("pending", []))
+
+        shards = itertools.islice(iter(self.source_datapipe), self._num_opened, None)
+
+        def next_shard():
+            if taken:
+                return taken.pop(0)
+            shard = next(shards, _END)
+            if shard is not _END:
+                self._num_opened += 1
+            return shard
+
+        pool = ThreadPoolExecutor(max_workers=self.prefetch) if self.prefetch > 0 else None
+        try:
+            while True:
+                while len(streams) < self.num_open:
+                    if pending:
+                        streams.append(pending.popleft())
+                        continue
+                    shard = next_shard()
+                    if shard is _END:
+                        break
+                    streams.append(_OpenShard(shard, self.fn(shard)))
+                while pool is not None and len(pending) < self.prefetch:
+                    shard = next_shard()
+                    if shard is _END:
+                        break
+                    prefetched = _OpenShard(shard, self.fn(shard))
+                    prefetched.first = pool.submit(next, prefetched.iterator, _END)
+                    pending.append(prefetched)
+                if not streams:
+                    return
+                i = rng.randrange(len(streams))
+                x = streams[i].next()
+                if x is _END:
+                    del streams[i]
+                    continue
+                streams[i].num_pulled += 1
+                yield x
+        finally:
+            if pool is not None:
+                for prefetched in pending:
+                    prefetched.first.cancel()
+                pool.shutdown(wait=True)
+
+    def _current_state(self) -> Dict[str, Any]:
+        rng = self._rng or random.Random(epoch_seed(self.seed, self.epoch))
+        return {
+            "rng": rng.getstate(),
+            "num_opened": self._num_opened,
+            # a shard whose first item was prefetched but not yielded starts again from the beginning
+            "open": [(s.shard, None if s.first is not None else source_state_dict(s.pipe, s.num_pulled))
+                     for s in self._streams or []],
+            "pending": [s.shard for s in self._pending or []],
+        }
+
+    def __len__(self) -> int:
+        return sum(len(self.fn(shard)) for shard in self.source_datapipe)
+
 
 @functional_datapipe('seeded_shuffle')
-class SeededShufflerIterDataPipe(IterDataPipe[T_co]):
+class SeededShufflerIterDataPipe(Checkpointable, IterDataPipe[T_co]):
     """Very similar to ShufflerIterDataPipe, but with a seed, and it ignores the set_shuffle_settings stuff. If you don't
-    want to shuffle, then don't use the shuffle combinator..."""
+    want to shuffle, then don't use the shuffle combinator...
+
+    A big buffer of Python objects takes a lot of memory: 10k sequences of 2048 tokens as lists of ints are a couple
+    of GB. There are two more compact ways to keep the buffer, which don't change the order items come out in:
+
+    * dtype: for fixed-length token sequences (lists or arrays of ints, or dicts of them, like the BatchEncodings
+      from group_texts), the buffer is a preallocated [buffer_size, seq_len] array of dtype per key. Use a signed
+      dtype if there are -100 labels. Items come out as the type they went in as, values included: lists stay lists,
+      and arrays and tensors keep their dtype.
+    * serialize and deserialize: items are kept as serialize(item), e.g. with pickle.dumps and pickle.loads.
+
+    The order is the same every time, unless epoch is changed (see set_epoch). By default, the random indices come from
+    random.Random, one call per item. rng="numpy" draws them from a numpy Generator a block at a time instead, which is
+    much faster, but gives different orders (and checkpoints) than the default.
+
+    It's checkpointable: its state is the generator state and the buffer."""
     datapipe: IterDataPipe[T_co]
     buffer_size: int
+    _generator: Optional[Union["_PythonRng", "_NumpyRng"]] = None
+    _buffer: Optional[Union["_ObjectBuffer", "_ArrayBuffer"]] = None
+    _num_pulled: int = 0
+    _draining: bool = False
 
     def __init__(self,
                  datapipe: IterDataPipe[T_co],
                  seed: int,
                  *,
                  buffer_size: int = 10000,
+                 dtype: Optional[Union[str, np.dtype]] = None,
+                 serialize: Optional[Callable[[T_co], Any]] = None,
+                 deserialize: Optional[Callable[[Any], T_co]] = None,
+                 epoch: int = 0,
+                 rng: str = "python",
                  ) -> None:
         super().__init__()
         assert buffer_size > 0, "buffer_size should be larger than 0"
+        if (serialize is None) != (deserialize is None):
+            raise ValueError("serialize and deserialize have to be given together")
+        if dtype is not None and serialize is not None:
+            raise ValueError("dtype and serialize can't be used together")
+        if rng not in _RNGS:
+            raise ValueError(f"rng should be one of {list(_RNGS)}, got {rng!r}")
         self.datapipe = datapipe
         self.buffer_size = buffer_size
         self.seed = seed
+        self.dtype = dtype
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.epoch = epoch
+        self.rng = rng
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _make_generator(self) -> Union["_PythonRng", "_NumpyRng"]:
+        return _RNGS[self.rng](epoch_seed(self.seed, self.epoch))
+
+    def _make_buffer(self) -> Union["_ObjectBuffer", "_ArrayBuffer"]:
+        if self.dtype is not None:
+            return _ArrayBuffer(self.buffer_size, self.dtype)
+        return _ObjectBuffer(self.serialize, self.deserialize)
 
     @staticmethod
     def buffer_replace(generator, buffer, x):
-        idx = generator.randint(0, len(buffer) - 1)
+        idx = generator.index(len(buffer))
         val = buffer[idx]
         buffer[idx] = x
         return val
 
     def __iter__(self) -> Iterator[T_co]:
-        generator = random.Random(self.seed)
-        buffer = []
-        for x in self.datapipe:
-            if len(buffer) == self.buffer_size:
-                yield SeededShufflerIterDataPipe.buffer_replace(generator, buffer, x)
-            else:
-                buffer.append(x)
-        generator.shuffle(buffer)
+        resume = self._pop_resume_state()
+        self._generator = generator = self._make_generator()
+        self._buffer = buffer = self._make_buffer()
+        self._num_pulled = 0
+        self._draining = False
+        source_state = None
+        if resume is not None:
+            generator.load_state(resume["rng"])
+            buffer.load_state(resume["buffer"])
+            self._num_pulled = resume["num_pulled"]
+            self._draining = resume["draining"]
+            source_state = resume["source"]
+
+        if not self._draining:
+            for x in iter_source(self.datapipe, source_state):
+                self._num_pulled += 1
+                if len(buffer) == self.buffer_size:
+                    yield SeededShufflerIterDataPipe.buffer_replace(generator, buffer, x)
+                else:
+                    buffer.append(x)
+            buffer.shuffle(generator)
+            self._draining = True
         while buffer:
             yield buffer.pop()
 
+    def _current_state(self) -> Dict[str, Any]:
+        generator = self._generator or self._make_generator()
+        return {
+            "rng": generator.state(),
+            "buffer": (self._buffer or self._make_buffer()).state(),
+            "num_pulled": self._num_pulled,
+            "draining": self._draining,
+            "source": None if self._draining else source_state_dict(self.datapipe, self._num_pulled),
+        }
+
     def __len__(self) -> int:
         if isinstance(self.datapipe, Sized):
             return len(self.datapipe)
         raise TypeError("{} instance doesn't have valid length".format(type(self).__name__))
 
 
-__all__ = ['SeededShufflerIterDataPipe']
+class _PythonRng:
+    """Random indices from random.Random, one call per index."""
+
+    def __init__(self, seed: int):
+        self._generator = random.Random(seed)
+
+    def index(self, n: int) -> int:
+        return self._generator.randint(0, n - 1)
+
+    def shuffle(self, items: List[Any]) -> None:
+        self._generator.shuffle(items)
+
+    def state(self) -> Tuple:
+        return self._generator.getstate()
+
+    def load_state(self, state: Tuple) -> None:
+        if not isinstance(state, tuple):
+            raise ValueError("This state wasn't saved by a shuffler with rng='python'")
+        self._generator.setstate(state)
+
+
+class _NumpyRng:
+    """
+    Random indices from a numpy Generator (PCG64), drawn block_size at a time. The state is the generator state at the
+    start of the current block and the position in it, so resuming draws the same block again.
+    """
+
+    def __init__(self, seed: int, block_size: int = 4096):
+        self.seed = seed
+        self._block_size = block_size
+        self._generator = np.random.Generator(np.random.PCG64(seed))
+        self._block_state = self._generator.bit_generator.state
+        self._block: List[int] = []
+        self._bound = 0
+        self._pos = 0
+
+    def _draw_block(self, n: int) -> None:
+        self._block_state = self._generator.bit_generator.state
+        # tolist: indexing python ints is much faster than indexing an array
+        self._block = self._generator.integers(0, n, size=self._block_size).tolist()
+        self._bound = n
+        self._pos = 0
+
+    def index(self, n: int) -> int:
+        if self._pos == len(self._block) or n != self._bound:
+            self._draw_block(n)
+        idx = self._block[self._pos]
+        self._pos += 1
+        return idx
+
+    def shuffle(self, items: List[Any]) -> None:
+        self._block, self._pos = [], 0
+        self._generator.shuffle(items)
+
+    def state(self) -> Dict[str, Any]:
+        if self._pos == len(self._block):
+            # nothing left in the block, so we'd draw the next one from the current state
+            return {"seed": self.seed, "bit_generator": self._generator.bit_generator.state, "bound": 0, "pos": 0}
+        return {"seed": self.seed, "bit_generator": self._block_state, "bound": self._bound, "pos": self._pos}
+
+    def load_state(self, state: Dict[str, Any]) -> None:
+        if not isinstance(state, dict):
+            raise ValueError("This state wasn't saved by a shuffler with rng='numpy'")
+        self.seed = state["seed"]
+        self._generator.bit_generator.state = state["bit_generator"]
+        self._block, self._bound, self._pos = [], 0, 0
+        if state["pos"]:
+            self._draw_block(state["bound"])
+            self._pos = state["pos"]
+
+
+_RNGS = {"python": _PythonRng, "numpy": _NumpyRng}
+
+
+def _identity(x):
+    return x
+
+
+class _ObjectBuffer:
+    """A shuffle buffer of Python objects, optionally serialized."""
+
+    def __init__(self, serialize: Optional[Callable] = None, deserialize: Optional[Callable] = None):
+        self._items: List[Any] = []
+        self._serialize = serialize or _identity
+        self._deserialize = deserialize or _identity
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, i: int):
+        return self._deserialize(self._items[i])
+
+    def __setitem__(self, i: int, x) -> None:
+        self._items[i] = self._serialize(x)
+
+    def append(self, x) -> None:
+        self._items.append(self._serialize(x))
+
+    def shuffle(self, generator: Union[_PythonRng, _NumpyRng]) -> None:
+        generator.shuffle(self._items)
+
+    def pop(self):
+        return self._deserialize(self._items.pop())
+
+    def state(self) -> List[Any]:
+        return list(self._items)
+
+    def load_state(self, state: List[Any]) -> None:
+        self._items = list(state)
+
+
+class _ArrayBuffer:
+    """
+    A shuffle buffer of fixed-length sequences, or dicts of them, in a preallocated [capacity, seq_len] array per key.
+    The arrays are allocated when the first item comes in. Shuffling permutes an index rather than the rows.
+    """
+
+    def __init__(self, capacity: int, dtype: Union[str, np.dtype]):
+        self._capacity = capacity
+        self._dtype = np.dtype(dtype)
+        self._arrays: Optional[Dict[Any, np.ndarray]] = None
+        self._size = 0
+        # once shuffled, the rows in the order they're popped in, from the end
+        self._order: Optional[List[int]] = None
+        self._item_type: Optional[type] = None  # the mapping type of the items, or None if they're sequences
+        # per key, the type of the values and their dtype if they're arrays or tensors, to convert the rows back to
+        self._value_types: Dict[Any, Tuple[type, Any]] = {}
+
+    def __len__(self) -> int:
+        return self._size if self._order is None else len(self._order)
+
+    def _allocate(self, x) -> None:
+        self._item_type = type(x) if isinstance(x, Mapping) else None
+        values = self._values(x)
+        first = next(iter(values.values()))
+        self._value_types = {k: (type(v), getattr(v, "dtype", None)) for k, v in values.items()}
+        self._arrays = {k: np.empty((self._capacity, len(first)), dtype=self._dtype) for k in values}
+
+    def _values(self, x) -> Dict[Any, Any]:
+        return x if self._item_type is not None else {None: x}
+
+    def __getitem__(self, i: int):
+        rows = {k: self._restore(array[i], *self._value_types[k]) for k, array in self._arrays.items()}
+        return rows[None] if self._item_type is None else self._item_type(rows)
+
+    @staticmethod
+    def _restore(row: np.ndarray, value_type: type, dtype: Any):
+        # copies, since the row will be overwritten
+        if issubclass(value_type, np.ndarray):
+            return row.astype(dtype)
+        if issubclass(value_type, torch.Tensor):
+            return torch.tensor(row, dtype=dtype)
+        if value_type is list:
+            return row.tolist()
+        return value_type(row.tolist())
+
+    def __setitem__(self, i: int, x) -> None:
+        values = self._values(x)
+        if set(values.keys()) != set(self._arrays.keys()):
+            raise ValueError(f"Expected items with keys {list(self._arrays.keys())}, got {list(values.keys())}")
+        for k, array in self._arrays.items():
+            if len(values[k]) != array.shape[1]:
+                raise ValueError(f"Items have to be the same length to shuffle with a dtype: expected "
+                                 f"{array.shape[1]}, got {len(values[k])}")
+            array[i] = values[k]
+
+    def append(self, x) -> None:
+        if self._arrays is None:
+            self._allocate(x)
+        self[self._size] = x
+        self._size += 1
+
+    def shuffle(self, generator: Union[_PythonRng, _NumpyRng]) -> None:
+        # the same draws as shuffling a list of the items, so the order doesn't depend on how the buffer is stored
+        order = list(range(self._size))
+        generator.shuffle(order)
+        self._order = order
+
+    def pop(self):
+        if self._order is None:
+            self._size -= 1
+            return self[self._size]
+        return self[self._order.pop()]
+
+    def state(self) -> Optional[Dict[str, Any]]:
+        if self._arrays is None:
+            return None
+        order = list(range(self._size)) if self._order is None else self._order
+        return {"rows": {k: array[order] for k, array in self._arrays.items()}, "item_type": self._item_type,
+                "value_types": self._value_types}
+
+    def load_state(self, state: Optional[Dict[str, Any]]) -> None:
+        self._order = None
+        if state is None:
+            self._arrays, self._size = None, 0
+            return
+        self._item_type, self._value_types = state["item_type"], state["value_types"]
+        self._arrays = {}
+        for k, rows in state["rows"].items():
+            self._arrays[k] = np.empty((self._capacity, rows.shape[1]), dtype=self._dtype)
+            self._arrays[k][:len(rows)] = rows
+            self._size = len(rows)
+
+
+__all__ = ['SeededShufflerIterDataPipe', 'ShardShufflerIterDataPipe', 'ShardInterleaverIterDataPipe', 'set_epoch',
+           'epoch_seed']
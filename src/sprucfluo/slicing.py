@@ -13,54 +13,117 @@
 # limitations under the License.
 
 from itertools import islice
-from typing import Iterator, TypeVar, Sized, Optional
+from typing import Iterator, TypeVar, Sized, Optional, Dict, Any
 
 from torch.utils.data import functional_datapipe, IterDataPipe
 
+from .checkpoint import Checkpointable, fast_forward, iter_source, source_state_dict
+
 T_co = TypeVar('T_co', covariant=True)
 
+# distinguishes slice(n, None) (drop n) from slice(n) (take n)
+_NO_STOP: Any = object()
+
+
 @functional_datapipe('slice')
-class SliceIterDataPipe(IterDataPipe[T_co]):
-    def __init__(self, iterable: IterDataPipe[T_co], start_or_stop: int, stop: Optional[int] = None,
+class SliceIterDataPipe(Checkpointable, IterDataPipe[T_co]):
+    """
+    Like itertools.islice, for data pipes (functional name: ``slice``; ``take`` and ``drop`` are shorthands).
+
+    If the source can skip items without producing them (see fast_forward), the items before start are skipped that
+    way, so e.g. dropping the first ten million items of a cached, tokenized corpus doesn't tokenize or even read them.
+    Otherwise they're produced and thrown away.
+    """
+    _num_pulled: int = 0
+
+    def __init__(self, iterable: IterDataPipe[T_co], start_or_stop: Optional[int], stop: Optional[int] = _NO_STOP,
                  stride: Optional[int] = None) -> None:
         self.iterable = iterable
-        if stop is None and stride is None:
-            self.slice = slice(start_or_stop)
+        if stop is _NO_STOP and stride is None:
+            self._slice = slice(start_or_stop)
         else:
-            self.slice = slice(start_or_stop, stop, stride)
+            self._slice = slice(start_or_stop, None if stop is _NO_STOP else stop, stride)
 
     def __iter__(self) -> Iterator[T_co]:
-        if self.slice.stop is not None and self.slice.stop < 0:
-            stop = self._computed_base_len()
-        else:
-            stop = self.slice.stop
-        return islice(self.iterable, self.slice.start, stop, self.slice.step)
-
-    def _computed_base_len(self) -> Optional[int]:
-        base_len = self.slice.stop
+        resume = self._pop_resume_state()
+        if resume is None:
+            self._num_pulled = 0
+            start = self._start
+            it = fast_forward(self.iterable, start) if start > 0 else None
+            if it is None:
+                return self._iter_from(0, iter(self.iterable))
+            return self._iter_from(start, it)
+        self._num_pulled = resume["num_pulled"]
+        return self._iter_from(self._num_pulled, iter_source(self.iterable, resume["source"]))
+
+    @property
+    def _start(self) -> int:
+        return self._slice.start or 0
+
+    @property
+    def _step(self) -> int:
+        return self._slice.step or 1
+
+    def _stop(self) -> Optional[int]:
+        if self._slice.stop is not None and self._slice.stop < 0:
+            return self._computed_base_len()
+        return self._slice.stop
+
+    def _iter_from(self, pulled: int, it: Iterator[T_co]) -> Iterator[T_co]:
+        """Yields our items from it, which is the source with the first pulled items already taken."""
+        start, stop, step = self._start, self._stop(), self._step
+        # positions are relative to the items we've already pulled
+        first = max(start - pulled, 0) if pulled <= start else (start - pulled) % step
+        if stop is not None:
+            stop = max(stop - pulled, first)
+        for i, x in enumerate(islice(it, first, stop, step)):
+            self._num_pulled = pulled + first + i * step + 1
+            yield x
+
+    def skip(self, n: int) -> Optional[Iterator[T_co]]:
+        if n == 0:
+            return iter(self)
+        source_index = self._start + n * self._step
+        stop = self._stop()
+        if stop is not None:
+            source_index = min(source_index, stop)
+        it = fast_forward(self.iterable, source_index)
+        if it is None:
+            return None
+        self._num_pulled = source_index
+        return self._iter_from(source_index, it)
+
+    def _current_state(self) -> Dict[str, Any]:
+        return {"num_pulled": self._num_pulled, "source": source_state_dict(self.iterable, self._num_pulled)}
+
+    def _computed_base_len(self) -> int:
+        base_len = self._slice.stop
         if base_len is None or base_len < 0:
             if not isinstance(self.iterable, Sized):
-                raise None
+                if base_len is None:
+                    raise TypeError("{} instance doesn't have valid length".format(type(self).__name__))
+                raise TypeError(f"Can't slice with a negative stop ({base_len}): "
+                                f"{type(self.iterable).__name__} instance doesn't have valid length")
 
             base_len = len(self.iterable)
-            if self.slice.stop is not None:
-                base_len = base_len + self.slice.stop
+            if self._slice.stop is not None:
+                base_len = base_len + self._slice.stop
 
         return base_len
 
     def __len__(self) -> int:
         stop = self._computed_base_len()
-        step = self.slice.step or 1
-        start = self.slice.start or 0
-        return (stop - start + (step - 1)) // step
+        step = self._step
+        start = self._start
+        return max((stop - start + (step - 1)) // step, 0)
 
 
 def _take_data_pipe(data_pipe: IterDataPipe[T_co], num: int) -> IterDataPipe[T_co]:
-    return data_pipe.slice(num)
+    return SliceIterDataPipe(data_pipe, num)
 
 
 def _drop_data_pipe(data_pipe: IterDataPipe[T_co], num: int) -> IterDataPipe[T_co]:
-    return data_pipe.slice(num, None)
+    return SliceIterDataPipe(data_pipe, num, None)
 
 
 def _init_slicing():
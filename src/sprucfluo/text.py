@@ -12,31 +12,52 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Routines for dealing with text data, mostly for language modeling"""
+from __future__ import annotations
+
 import codecs
-import copy
 import json
 import os.path
 import re
 import tarfile
-from functools import partial
-from typing import Optional, Iterator
+from itertools import chain, islice
+from typing import Optional, Iterator, Dict, List, Tuple, Union, Callable, Any, TYPE_CHECKING
 
 import numpy as np
-from torch.utils.data import IterDataPipe
+import torch
+from numpy.lib.stride_tricks import sliding_window_view
+from torch.utils.data import functional_datapipe, IterDataPipe
 from torch.utils.data.datapipes.utils.common import StreamWrapper
-from transformers import BatchEncoding, PreTrainedTokenizerBase
-from itertools import chain
 
-try:
-    import magic
-except ImportError:
-    magic = None
+from .batching import TensorBatcherIterDataPipe
+from .checkpoint import Checkpointable, iter_source, source_state_dict
+from .encoding import batch_encoding
+from .index import DocumentRange
+from .packing import PackTextsIterDataPipe
+
+if TYPE_CHECKING:
+    from transformers import BatchEncoding, PreTrainedTokenizerBase
+
+# python-magic, imported the first time we need to sniff a file type (False until then)
+_magic: Any = False
+
+
+def _load_magic():
+    """python-magic, or None if it isn't installed"""
+    global _magic
+    if _magic is False:
+        try:
+            import magic
+            _magic = magic
+        except ImportError:
+            _magic = None
+    return _magic
 
 
 def concatenate_and_group_texts(encoding: BatchEncoding, seq_len: int,
                                 stride: Optional[int] = None,
                                 drop_remainder: bool = True,
-                                mask_stride_overlap=True) -> Iterator[BatchEncoding]:
+                                mask_stride_overlap=True,
+                                return_tensors: Optional[str] = None) -> Iterator[BatchEncoding]:
     """Groups texts in a batch together. Typically, you'll want to use this with a fairly large
     set of texts, e.g. 1000 docs.
 
@@ -48,43 +69,261 @@ def concatenate_and_group_texts(encoding: BatchEncoding, seq_len: int,
         stride: The stride to use when grouping texts. If None, then the stride is set to seq_len.
         mask_stride_overlap: Whether to mask out overlapping tokens if we're using a stride.
         drop_remainder: Whether to drop the last batch if it's not a multiple of the seq_len.
+        return_tensors: If None, each sequence is emitted as its own BatchEncoding of lists. If "np" or "pt",
+            all the sequences are instead emitted as a single BatchEncoding of stacked [num_seqs, seq_len] arrays
+            or tensors. (Any short sequences at the end are emitted as their own [1, len] batches.)
 
     Returns:
         An iterator of tokenized texts, one at a time.
     """
-    concatenated = BatchEncoding(data={k: list(chain(*v)) for k, v in encoding.items()})
-    total_length = len(concatenated.input_ids)
     stride = stride or seq_len
+    # Converting python ints to numpy and back costs more than it saves, so stick with lists unless we have to
+    concatenated = _concatenate_encoding(encoding, as_arrays=return_tensors is not None or _has_arrays(encoding))
+    begins = _window_begins(len(concatenated["input_ids"]), seq_len, stride, drop_remainder)
+    yield from _emit_windows(concatenated, begins, seq_len, stride, mask_stride_overlap, return_tensors)
+
+
+@functional_datapipe("group_texts")
+class GroupTextsIterDataPipe(Checkpointable, IterDataPipe["BatchEncoding"]):
+    r"""
+    A streaming version of concatenate_and_group_texts: takes a pipe of tokenized batches (e.g. the output of a
+    tokenizer), concatenates them all together, and splits them into sequences of length seq_len tokens each.
+
+    Unlike flatmapping concatenate_and_group_texts over the batches, the tokens left over at the end of each batch are
+    carried over to the next one, so only the remainder of the entire stream is dropped (or emitted short).
+
+    It's checkpointable: its state is the tokens that have been read but not yet emitted, and the state of the source.
+
+    Args:
+        source_datapipe: The pipe of tokenized batches, each a BatchEncoding (or dict) of per-document sequences.
+        seq_len: The max length of sequences to emit
+        stride: The stride to use when grouping texts. If None, then the stride is set to seq_len.
+        drop_remainder: Whether to drop the last sequence if it's not a multiple of the seq_len.
+        mask_stride_overlap: Whether to mask out overlapping tokens if we're using a stride.
+        return_tensors: See concatenate_and_group_texts.
+    """
+    _concatenated: Optional[Dict[str, Union[list, np.ndarray]]] = None
+    _num_emitted: int = 0
+    _emitted_any: bool = False
+    _num_pulled: int = 0
+
+    def __init__(self,
+                 source_datapipe: IterDataPipe[BatchEncoding],
+                 seq_len: int,
+                 stride: Optional[int] = None,
+                 drop_remainder: bool = True,
+                 mask_stride_overlap=True,
+                 return_tensors: Optional[str] = None) -> None:
+        if stride is not None and stride > seq_len:
+            raise ValueError(f"stride ({stride}) must be at most seq_len ({seq_len})")
+        self.source_datapipe = source_datapipe
+        self.seq_len = seq_len
+        self.stride = stride or seq_len
+        self.drop_remainder = drop_remainder
+        self.mask_stride_overlap = mask_stride_overlap
+        self.return_tensors = return_tensors
+
+    def __iter__(self) -> Iterator[BatchEncoding]:
+        resume = self._pop_resume_state()
+        # carry holds the tokens from the beginning of the next window on
+        carry: Optional[Dict[str, Union[list, np.ndarray]]] = None
+        emitted_any = False
+        self._num_pulled = 0
+        source_state = None
+        if resume is not None:
+            carry = resume["carry"]
+            emitted_any = resume["emitted_any"]
+            self._num_pulled = resume["num_pulled"]
+            source_state = resume["source"]
+        self._set_position(carry, 0, emitted_any)
+
+        for encoding in iter_source(self.source_datapipe, source_state):
+            self._num_pulled += 1
+            as_arrays = self.return_tensors is not None or _has_arrays(encoding)
+            concatenated = _concatenate_encoding(encoding, as_arrays, prefix=carry)
+            length = len(concatenated["input_ids"])
+
+            # only full windows: the rest might be completed by the next batch
+            begins = range(0, max(length - self.seq_len + 1, 0), self.stride)
+            yield from self._emit_tracked(concatenated, begins, emitted_any)
+            emitted_any = emitted_any or len(begins) > 0
+
+            next_begin = len(begins) * self.stride
+            carry = {k: v[next_begin:] for k, v in concatenated.items()}
+            self._set_position(carry, 0, emitted_any)
+
+        if carry is not None:
+            begins = _window_begins(len(carry["input_ids"]), self.seq_len, self.stride, self.drop_remainder)
+            yield from self._emit_tracked(carry, begins, emitted_any)
+            self._set_position(None, 0, True)
+
+    def _emit_tracked(self, concatenated, begins: range, emitted_any: bool) -> Iterator[BatchEncoding]:
+        """_emit_windows, keeping track of how far we've got for state_dict"""
+        self._set_position(concatenated, 0, emitted_any)
+        windows = _emit_windows(concatenated, begins, self.seq_len, self.stride, self.mask_stride_overlap,
+                                self.return_tensors, mask_first=emitted_any)
+        num_emitted = 0
+        for window in windows:
+            # with return_tensors, each item is a stack of windows
+            num_emitted += 1 if self.return_tensors is None else len(window["input_ids"])
+            self._num_emitted = num_emitted
+            yield window
+
+    def _set_position(self, concatenated, num_emitted: int, emitted_any: bool) -> None:
+        self._concatenated = concatenated
+        self._num_emitted = num_emitted
+        self._emitted_any = emitted_any
+
+    def _current_state(self) -> Dict[str, Any]:
+        carry = None
+        if self._concatenated is not None:
+            next_begin = self._num_emitted * self.stride
+            carry = {k: v[next_begin:] for k, v in self._concatenated.items()}
+        return {
+            "carry": carry,
+            "emitted_any": self._emitted_any or self._num_emitted > 0,
+            "num_pulled": self._num_pulled,
+            "source": source_state_dict(self.source_datapipe, self._num_pulled),
+        }
+
+
+def _concatenate_encoding(encoding: BatchEncoding, as_arrays: bool,
+                          prefix: Optional[Dict[str, Union[list, np.ndarray]]] = None) \
+        -> Dict[str, Union[list, np.ndarray]]:
+    concatenated = {}
+    for k, v in encoding.items():
+        seqs = list(v)
+        if prefix is not None:
+            carried = prefix[k]
+            if as_arrays and not isinstance(carried, np.ndarray):
+                carried = np.asarray(carried, dtype=np.int64)
+            elif not as_arrays and isinstance(carried, np.ndarray):
+                carried = carried.tolist()
+            seqs = [carried] + seqs
+        concatenated[k] = _concatenate(seqs) if as_arrays else list(chain.from_iterable(seqs))
+    return concatenated
+
+
+def _emit_windows(concatenated: Dict[str, Union[list, np.ndarray]], begins: range, seq_len: int, stride: int,
+                  mask_stride_overlap: bool, return_tensors: Optional[str],
+                  mask_first: bool = False) -> Iterator[BatchEncoding]:
+    if isinstance(concatenated["input_ids"], list):
+        yield from _emit_list_windows(concatenated, begins, seq_len, stride, mask_stride_overlap, mask_first)
+        return
+
+    full, short = _windows(concatenated, begins, seq_len)
+
+    if mask_stride_overlap and stride != seq_len:
+        full, short = _mask_overlap(full, short, seq_len, stride, mask_first)
+
+    if return_tensors is None:
+        num_full = len(full["input_ids"])
+        for i in range(num_full):
+            yield batch_encoding({k: v[i].tolist() for k, v in full.items()})
+        for window in short:
+            yield batch_encoding({k: v.tolist() for k, v in window.items()})
+    else:
+        if len(full["input_ids"]) > 0:
+            yield _stacked(full, return_tensors)
+        for window in short:
+            yield _stacked({k: v[None, :] for k, v in window.items()}, return_tensors)
+
 
+def _emit_list_windows(concatenated: Dict[str, list], begins: range, seq_len: int, stride: int,
+                       mask_stride_overlap: bool, mask_first: bool) -> Iterator[BatchEncoding]:
+    overlap = seq_len - stride
+
+    for begin in begins:
+        data = {k: v[begin:begin + seq_len] for k, v in concatenated.items()}
+
+        if mask_stride_overlap and stride != seq_len:
+            labels = data.get("labels", data["input_ids"])
+            if begin != 0 or mask_first:
+                labels = labels.copy()
+                labels[:overlap] = [-100] * min(overlap, len(labels))
+            data["labels"] = labels
+
+        yield batch_encoding(data)
+
+
+def _has_arrays(encoding: BatchEncoding) -> bool:
+    return any(isinstance(seq, np.ndarray) for seq in encoding["input_ids"])
+
+
+def _concatenate(seqs) -> np.ndarray:
+    if all(isinstance(s, np.ndarray) for s in seqs):
+        # empty arrays might have the wrong dtype, which would poison the dtype of the concatenation
+        arrays = [s for s in seqs if len(s) > 0]
+        return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64)
+    return np.fromiter(chain.from_iterable(seqs), dtype=np.int64, count=sum(len(s) for s in seqs))
+
+
+def _window_begins(total_length: int, seq_len: int, stride: int, drop_remainder: bool) -> range:
     # Drop the "very last" bit of the dataset that doesn't fit into block size...
     if total_length % stride != 0 and drop_remainder:
         total_length = ((total_length - seq_len + stride) // stride) * stride
 
-    # Split by Chunks of Maximum Length
     # we want to take chunks up until we've covered all "total_length" tokens with a sliding window of size "stride"
-    for begin in range(0, total_length - seq_len + stride, stride):
-        data = {k: v[begin:begin+seq_len] for k, v in concatenated.items()}
+    return range(0, max(total_length - seq_len + stride, 0), stride)
 
-        if mask_stride_overlap and stride != seq_len:
-            labels = data.get("labels", data["input_ids"])
-            if begin != 0:
-                labels = _mask_overlap(labels, seq_len, stride)
-            data["labels"] = labels
 
-        yield BatchEncoding(data=data)
+def _windows(concatenated: Dict[str, np.ndarray], begins: range, seq_len: int) \
+        -> Tuple[Dict[str, np.ndarray], List[Dict[str, np.ndarray]]]:
+    """Cuts the windows starting at begins out of the concatenated arrays. Returns a dict of 2-d (strided) views
+    for all the windows that are seq_len long, and a list of the (few) windows at the end that are shorter."""
+    length = len(concatenated["input_ids"])
+    num_full = len(range(begins.start, min(begins.stop, length - seq_len + 1), begins.step))
+
+    full = {}
+    for k, v in concatenated.items():
+        if len(v) != length:
+            # malformed (e.g. a mock tokenizer), but we might as well handle it the way slicing lists would
+            full[k] = [v[begin:begin + seq_len] for begin in begins[:num_full]]
+        elif num_full == 0:
+            full[k] = v[:0].reshape(0, seq_len)
+        elif begins.step == seq_len:
+            full[k] = v[begins.start:begins.start + num_full * seq_len].reshape(num_full, seq_len)
+        else:
+            full[k] = sliding_window_view(v, seq_len)[begins.start::begins.step][:num_full]
+
+    short = [{k: v[begin:begin + seq_len] for k, v in concatenated.items()} for begin in begins[num_full:]]
+    return full, short
 
 
 # -100 is pytorch's label mask
-def _mask_overlap(labels, target_len, stride, sentinel=-100):
-    labels = copy.deepcopy(labels)
-    if isinstance(labels, list):
-        for i in range(target_len - stride):
-            if i < len(labels):
-                labels[i] = sentinel
-    else:
-        labels[0:target_len - stride] = sentinel
+def _mask_overlap(full: Dict[str, np.ndarray], short: List[Dict[str, np.ndarray]], seq_len: int, stride: int,
+                  mask_first: bool = False, sentinel=-100):
+    """Adds labels to the windows, masking out the tokens that overlap with the previous window. The very first window
+    has no previous window, so it is only masked if mask_first is True."""
+    overlap = seq_len - stride
+
+    labels = np.array(full.get("labels", full["input_ids"]), dtype=np.int64)
+    labels[0 if mask_first else 1:, :overlap] = sentinel
+    full = dict(full, labels=labels)
+
+    masked_short = []
+    for window in short:
+        labels = np.array(window.get("labels", window["input_ids"]), dtype=np.int64)
+        if mask_first or len(full["labels"]) > 0 or len(masked_short) > 0:
+            labels[:overlap] = sentinel
+        masked_short.append(dict(window, labels=labels))
 
-    return labels
+    return full, masked_short
+
+
+def _torch_compatible_dtype(dtype: np.dtype) -> np.dtype:
+    return np.dtype(np.int64) if dtype.kind == "u" and dtype.itemsize > 1 else dtype
+
+
+def _stacked(arrays: Dict[str, np.ndarray], return_tensors: str) -> BatchEncoding:
+    if return_tensors == "np":
+        return batch_encoding({k: np.ascontiguousarray(v) for k, v in arrays.items()})
+    elif return_tensors == "pt":
+        # torch doesn't do unsigned types beyond uint8, and the token cache uses uint16/uint32
+        return batch_encoding({k: torch.from_numpy(np.ascontiguousarray(v, dtype=_torch_compatible_dtype(v.dtype)))
+                                   for k, v in arrays.items()})
+    else:
+        raise ValueError(f"Unsupported return_tensors: {return_tensors}. Expected None, 'np' or 'pt'.")
 
 
 # TODO: support truncation and padding
@@ -95,7 +334,15 @@ def tokenize_and_group_texts(pipe: IterDataPipe[str],
                              batch_size: int = 1000,
                              stride: Optional[int] = None,
                              drop_remainder: bool = True,
-                             mask_stride_overlap=True
+                             mask_stride_overlap=True,
+                             return_tensors: Optional[str] = None,
+                             num_tokenize_workers: int = 0,
+                             tokenize_executor: str = "thread",
+                             ordered: bool = True,
+                             tensor_batch_size: Optional[int] = None,
+                             pin_memory: bool = False,
+                             pack: bool = False,
+                             pack_window: int = 1000
                              ) -> IterDataPipe[BatchEncoding]:
     """Processes a set of texts for language modeling. Tokenizes, groups texts together, and splits them into sequences
     of length seq_len tokens each.
@@ -104,22 +351,71 @@ def tokenize_and_group_texts(pipe: IterDataPipe[str],
         pipe: The pipe to process.
         tokenizer: The tokenizer to use.
         seq_len: The length of sequences to emit.
-        batch_size: The batch size to use for tokenizing and grouping
+        batch_size: The number of documents to tokenize at once. Leftover tokens are carried over between batches,
+            so this doesn't affect the output.
         stride: The stride to use when grouping texts. If None, then the stride is set to seq_len.
-        drop_remainder: Whether to drop the last batch if it's not a multiple of the seq_len.
+        drop_remainder: Whether to drop the last sequence of the stream if it's not a multiple of the seq_len.
         mask_stride_overlap: Whether to mask out overlapping tokens if we're using a stride.
+        return_tensors: If "np" or "pt", emit stacked arrays/tensors instead of one sequence at a time.
+            See concatenate_and_group_texts.
+        num_tokenize_workers: If > 0, tokenize batches in a pool of this many workers, so that a single reader can
+            keep several cores busy. See ParallelMapperIterDataPipe.
+        tokenize_executor: "thread" or "process". Fast tokenizers release the GIL, so threads are usually enough.
+        ordered: Whether parallel tokenization should preserve the order of the documents. If False, the output is
+            no longer deterministic, but stragglers don't hold up the pipe.
+        tensor_batch_size: If not None, emit BatchEncodings of [tensor_batch_size, seq_len] tensors of input_ids,
+            attention_mask and labels instead, for a DataLoader with collate_fn=collate_tensor_batches. The last batch
+            is padded if drop_remainder is False. See TensorBatcherIterDataPipe.
+        pin_memory: With tensor_batch_size, whether to allocate the batches in pinned memory.
+        pack: If True, pack whole documents into sequences of at most seq_len tokens, with position_ids that start
+            again at each document, rather than concatenating them and cutting every seq_len tokens. Only documents
+            longer than seq_len are split. See PackTextsIterDataPipe.
+        pack_window: With pack, the number of documents to pack at once.
     """
-    return pipe.batch(batch_size=batch_size, wrapper_class=list)\
-        .map(tokenizer)\
-        .flatmap(partial(concatenate_and_group_texts, seq_len=seq_len, stride=stride,
-                         mask_stride_overlap=mask_stride_overlap, drop_remainder=drop_remainder))
+    if tensor_batch_size is not None and return_tensors is not None:
+        raise ValueError("return_tensors and tensor_batch_size can't be used together")
+    if pack and (stride is not None or return_tensors is not None):
+        raise ValueError("pack doesn't work with stride or return_tensors")
+
+    batches = pipe.batch(batch_size=batch_size, wrapper_class=list)
+    if num_tokenize_workers > 0:
+        tokenized = batches.parallel_map(tokenizer, num_workers=num_tokenize_workers, executor=tokenize_executor,
+                                         ordered=ordered)
+    else:
+        tokenized = batches.map(tokenizer)
+
+    if pack:
+        packed = PackTextsIterDataPipe(tokenized, seq_len=seq_len, window_size=pack_window)
+        if tensor_batch_size is None:
+            return packed
+        return TensorBatcherIterDataPipe(packed, tensor_batch_size, seq_len,
+                                         pad_token_id=getattr(tokenizer, "pad_token_id", None) or 0,
+                                         drop_last=drop_remainder,
+                                         pin_memory=pin_memory)
+
+    if tensor_batch_size is not None:
+        # stacked windows are views of the concatenated tokens, which is what the batcher copies from
+        grouped = tokenized.group_texts(seq_len=seq_len, stride=stride, drop_remainder=drop_remainder,
+                                        mask_stride_overlap=mask_stride_overlap, return_tensors="np")
+        return TensorBatcherIterDataPipe(grouped, tensor_batch_size, seq_len,
+                                         pad_token_id=getattr(tokenizer, "pad_token_id", None) or 0,
+                                         drop_last=drop_remainder,
+                                         pin_memory=pin_memory)
+
+    return tokenized\
+        .group_texts(seq_len=seq_len, stride=stride, drop_remainder=drop_remainder,
+                     mask_stride_overlap=mask_stride_overlap, return_tensors=return_tensors)
 
 
 def read_lm_text_file(file_path: str, stream: StreamWrapper, json_text_key: str = "text") -> Iterator[str]:
+    yield from _lm_text_file_handler(file_path, stream)(stream, json_text_key)
+
+
+def _lm_text_file_handler(file_path: str, stream: StreamWrapper) -> Callable[[StreamWrapper, str], Iterator[str]]:
     rest_path, file_type = os.path.splitext(file_path)
     file_type = file_type.lstrip('.')
 
-    if len(file_type) == 0 and stream.seekable() and magic is not None:
+    if len(file_type) == 0 and stream.seekable() and _load_magic() is not None:
         file_type = sniff_file_type(stream.read(1024))
         stream.seek(0)
 
@@ -127,14 +423,13 @@ def read_lm_text_file(file_path: str, stream: StreamWrapper, json_text_key: str
     # which contains a bunch of text files. We special case this to read the text files directly.
     # This matches https://github.com/leogao2/lm_dataformat
     if any(re.finditer(r'urlsf_subset', file_path)):
-        yield from read_owt_subset(stream)
-        return
+        return lambda stream, json_text_key: read_owt_subset(stream)
 
     if file_type in file_handlers:
-        yield from file_handlers[file_type](stream, json_text_key)
+        return file_handlers[file_type]
     else:
         msg = f"Unsupported file type: {file_type} for file {file_path}"
-        if magic is None:
+        if _load_magic() is None:
             msg += " (python-magic is not installed, so we can't sniff the file type from its contents)"
         raise ValueError(msg)
 
@@ -148,7 +443,7 @@ def sniff_file_type(data: bytes) -> Optional[str]:
     Returns:
         The file type.
     """
-    mime = magic.from_buffer(data, mime=True)
+    mime = _load_magic().from_buffer(data, mime=True)
     if mime == "application/json":
         return "jsonl"
     elif mime == "text/plain":
@@ -169,13 +464,104 @@ def read_owt_subset(stream):
         yield contents
 
 
-def read_jsonl(stream: StreamWrapper, json_text_key: str = "text") -> Iterator[dict]:
-    for line in stream:
-        yield json.loads(line)[json_text_key]
+# Read this much at a time when reading jsonl. Big blocks amortize the per-read overhead of decompressors and fsspec.
+_JSONL_BLOCK_SIZE = 1 << 20
+
+
+def _iter_lines(stream, block_size: int = _JSONL_BLOCK_SIZE) -> Iterator[Union[bytes, str]]:
+    """Reads stream in large blocks and splits them into lines (without the newline). Works on binary and text
+    streams alike."""
+    pending: list = []  # pieces of a line that spans blocks
+    newline = None
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        if newline is None:
+            newline = b"\n" if isinstance(block, bytes) else "\n"
+
+        lines = block.split(newline)
+        if pending:
+            pending.append(lines[0])
+            lines[0] = newline[:0].join(pending)
+            pending = []
+        last = lines.pop()
+        if last:
+            pending.append(last)
+        yield from lines
+
+    if pending:
+        yield newline[:0].join(pending)
+
+
+def _json_extractor(json_text_key: str) -> Callable[[Union[bytes, str]], str]:
+    def extract(line):
+        # json.loads is quite a bit faster on str than on bytes, even counting the decode
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        return json.loads(line)[json_text_key]
+
+    return extract
+
+
+def _orjson_extractor(json_text_key: str) -> Callable[[Union[bytes, str]], str]:
+    import orjson
+    return lambda line: orjson.loads(line)[json_text_key]
+
+
+def _simdjson_extractor(json_text_key: str) -> Callable[[Union[bytes, str]], str]:
+    import simdjson
+    parser = simdjson.Parser()
 
+    def extract(line):
+        # the parser reuses its buffers, so the document needs to be dropped before the next parse
+        doc = parser.parse(line)
+        text = doc[json_text_key]
+        del doc
+        return text
 
-def read_text(stream: StreamWrapper, json_text_key: str = "text") -> Iterator[dict]:
-    yield stream.read()
+    return extract
+
+
+# in order of preference
+JSON_BACKENDS = {
+    "simdjson": _simdjson_extractor,
+    "orjson": _orjson_extractor,
+    "json": _json_extractor,
+}
+
+
+def default_json_backend() -> str:
+    """The fastest available backend for read_jsonl: simdjson or orjson if they're installed, otherwise json."""
+    for backend, make_extractor in JSON_BACKENDS.items():
+        try:
+            make_extractor("text")
+            return backend
+        except ImportError:
+            pass
+    return "json"
+
+
+def read_jsonl(stream: StreamWrapper, json_text_key: str = "text", backend: Optional[str] = None) -> Iterator[str]:
+    """Reads json_text_key from each line of a jsonl stream. The stream is read in large blocks rather than line by
+    line, and binary streams are preferred, since simdjson and orjson parse bytes directly.
+
+    Args:
+        stream: The (binary or text) stream to read.
+        json_text_key: The key in the JSON file to use as the text. Defaults to "text".
+        backend: One of JSON_BACKENDS. "simdjson" and "orjson" need pysimdjson or orjson to be installed, "json" is
+            the standard library. Defaults to default_json_backend(). See benchmarks/jsonl_bench.py.
+    """
+    extract = JSON_BACKENDS[backend or default_json_backend()](json_text_key)
+    for line in _iter_lines(stream):
+        if not line or line.isspace():
+            continue
+        yield extract(line)
+
+
+def read_text(stream: StreamWrapper, json_text_key: str = "text") -> Iterator[str]:
+    data = stream.read()
+    yield data.decode("utf-8") if isinstance(data, bytes) else data
 
 
 file_handlers = {
@@ -183,3 +569,121 @@ file_handlers = {
     'txt': read_text,
     'jsonl': read_jsonl,
 }
+
+
+@functional_datapipe("read_lm_text_files")
+class LMTextFileReaderIterDataPipe(Checkpointable, IterDataPipe[str]):
+    r"""
+    Reads the documents from each (path, stream) pair of the source, e.g. the output of open_file_by_fsspec_fancy
+    (functional name: ``read_lm_text_files``). This is the same as flatmapping read_lm_text_file over the source,
+    except that it's checkpointable: its state is the index of the current file and how far into it we've read.
+    When resuming, files before the current one aren't read at all if the source is checkpointable (e.g. it's
+    open_file_by_fsspec_fancy), and for binary jsonl streams, the current one is seeked to the next document rather
+    than parsed up to it. Other formats skip the documents already read.
+
+    If a path is a DocumentRange, its stream is assumed to start at the range's first document (as it does with
+    open_file_by_fsspec_fancy), and reading stops at the end of the range.
+
+    It has a len() if its source has num_documents(), as open_file_by_fsspec_fancy does when all the shards have
+    indexes (see sprucfluo.index).
+
+    Args:
+        source_datapipe: The pipe of (path, stream) pairs.
+        json_text_key: The key in the JSON file to use as the text. Defaults to "text".
+    """
+    _source_state: Optional[Dict[str, Any]] = None
+    _num_files_read: int = 0
+    _num_docs: int = 0
+    _offset: Optional[int] = None
+
+    def __init__(self, source_datapipe: IterDataPipe[Tuple[str, StreamWrapper]], json_text_key: str = "text") -> None:
+        self.source_datapipe = source_datapipe
+        self.json_text_key = json_text_key
+
+    def __iter__(self) -> Iterator[str]:
+        resume = self._pop_resume_state()
+        self._num_files_read = 0
+        skip_docs, skip_bytes = 0, None
+        source_state = None
+        if resume is not None:
+            # the source is restored to just before the file we were in the middle of
+            self._num_files_read = resume["num_files_read"]
+            skip_docs, skip_bytes = resume["num_docs"], resume["offset"]
+            source_state = resume["source"]
+
+        files = iter_source(self.source_datapipe, source_state)
+        while True:
+            self._source_state = source_state_dict(self.source_datapipe, self._num_files_read)
+            self._num_docs = 0
+            self._offset = None
+            try:
+                path, stream = next(files)
+            except StopIteration:
+                return
+            limit = None
+            if isinstance(path, DocumentRange) and path.stop is not None:
+                limit = max(path.stop - path.start, 0)
+            try:
+                handler = _lm_text_file_handler(path, stream)
+                if handler is read_jsonl:
+                    docs = self._read_jsonl(stream, skip_docs, skip_bytes, limit)
+                else:
+                    docs = islice(handler(stream, self.json_text_key), skip_docs, limit)
+                    self._num_docs = skip_docs
+                for doc in docs:
+                    self._num_docs += 1
+                    yield doc
+            finally:
+                stream.close()
+            self._num_files_read += 1
+            skip_docs, skip_bytes = 0, None
+
+    def _read_jsonl(self, stream, skip_docs: int, skip_bytes: Optional[int], limit: Optional[int]) -> Iterator[str]:
+        extract = JSON_BACKENDS[default_json_backend()](self.json_text_key)
+        offset = 0
+        if skip_bytes is not None:
+            _skip_bytes(stream, skip_bytes)
+            offset = skip_bytes
+            self._num_docs = skip_docs
+            skip_docs = 0
+
+        for line in _iter_lines(stream):
+            if limit is not None and self._num_docs >= limit:
+                return
+            if not isinstance(line, bytes):
+                # character counts aren't byte offsets, so we count documents instead
+                offset = None
+            elif offset is not None:
+                offset += len(line) + 1
+            if not line or line.isspace():
+                continue
+            if skip_docs > 0:
+                skip_docs -= 1
+                self._num_docs += 1
+                continue
+            self._offset = offset
+            yield extract(line)
+
+    def _current_state(self) -> Dict[str, Any]:
+        source_state = self._source_state
+        if source_state is None:
+            source_state = source_state_dict(self.source_datapipe, 0)
+        return {"source": source_state, "num_files_read": self._num_files_read, "num_docs": self._num_docs,
+                "offset": self._offset}
+
+    def __len__(self) -> int:
+        num_documents = getattr(self.source_datapipe, "num_documents", None)
+        if num_documents is None:
+            raise TypeError("{} instance doesn't have valid length".format(type(self).__name__))
+        return num_documents()
+
+
+def _skip_bytes(stream, num_bytes: int) -> None:
+    if stream.seekable():
+        stream.seek(num_bytes)
+        return
+    while num_bytes > 0:
+        data = stream.read(min(num_bytes, _JSONL_BLOCK_SIZE))
+        if not data:
+            break
+        num_bytes -= len(data)
@@ -0,0 +1,273 @@
+# Copyright 2022 The Board of Trustees of the Leland Stanford Junior University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""An on-disk cache of tokenized shards, so that we only have to run the tokenizer over a corpus once."""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import uuid
+from itertools import islice
+from typing import Optional, Iterator, Dict, Any, List, TYPE_CHECKING
+
+import numpy as np
+from torch.utils.data import functional_datapipe, IterDataPipe
+from torch.utils.data.datapipes.iter import IterableWrapper
+
+from .files import FancyFSSpecFileOpenerIterDataPipe
+from .text import read_lm_text_file
+
+if TYPE_CHECKING:
+    from transformers import BatchEncoding, PreTrainedTokenizerBase
+
+_CACHE_FORMAT_VERSION = 1
+
+
+def tokenizer_fingerprint(tokenizer: PreTrainedTokenizerBase) -> str:
+    """Computes a stable fingerprint of a tokenizer, suitable for use as part of a cache key.
+
+    Fast tokenizers are fingerprinted by their full serialized form (which includes normalization, pre-tokenization
+    and post-processing, e.g. appending EOS). Slow tokenizers are fingerprinted by their vocab and special tokens.
+    Anything else (e.g. a plain function) can't be fingerprinted, and you'll need to pass an explicit fingerprint.
+    """
+    h = hashlib.sha256()
+    h.update(type(tokenizer).__name__.encode("utf-8"))
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        h.update(backend.to_str().encode("utf-8"))
+    elif hasattr(tokenizer, "get_vocab"):
+        h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+        h.update(json.dumps(getattr(tokenizer, "special_tokens_map", {}), sort_keys=True).encode("utf-8"))
+    else:
+        raise ValueError(f"Can't compute a fingerprint for tokenizer of type {type(tokenizer).__name__}. "
+                         f"Please pass an explicit fingerprint.")
+    return h.hexdigest()
+
+
+def _token_dtype(tokenizer) -> np.dtype:
+    try:
+        vocab_size = len(tokenizer)
+    except TypeError:
+        return np.dtype(np.uint32)
+    return np.dtype(np.uint16) if vocab_size <= np.iinfo(np.uint16).max + 1 else np.dtype(np.uint32)
+
+
+class _CacheEntry:
+    """The files making up a single cached shard. The metadata file is written last, so its existence means the entry
+    is complete."""
+    def __init__(self, cache_dir: str, uri: str, fingerprint: str, json_text_key: str):
+        key = hashlib.sha256("\0".join([uri, fingerprint, json_text_key]).encode("utf-8")).hexdigest()[:32]
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", os.path.basename(uri.rstrip("/")))[:64]
+        base = os.path.join(cache_dir, f"{name}-{key}")
+        self.uri = uri
+        self.tokens_path = base + ".tokens"
+        self.offsets_path = base + ".offsets.npy"
+        self.metadata_path = base + ".json"
+
+    def exists(self) -> bool:
+        return os.path.exists(self.metadata_path)
+
+    def read_metadata(self) -> Dict[str, Any]:
+        with open(self.metadata_path, "r") as f:
+            return json.load(f)
+
+
+@functional_datapipe("tokenize_with_cache")
+class TokenCacheIterDataPipe(IterDataPipe[np.ndarray]):
+    r"""
+    Takes a data pipe of shard paths and yields the token ids of each document in those shards, as numpy arrays.
+
+    The first time a shard is read, its documents are tokenized and the concatenated input_ids are written to
+    a flat token file in cache_dir, along with an index of document offsets. On subsequent passes (or in subsequent
+    runs), the shard is served from a memory-mapped view of that file without touching the tokenizer.
+
+    Entries are keyed by (shard uri, tokenizer fingerprint, json_text_key). They are written under temporary names
+    and atomically renamed into place when the shard has been fully read, so it's safe for multiple processes to
+    share a cache_dir. A shard that is only partially read is not cached.
+
+    Note that this assumes the tokenizer doesn't pad, i.e. that attention_mask is all ones.
+
+    Grouping documents one at a time costs more than reading them from the cache, so with docs_per_item > 1, each item
+    is instead the concatenated tokens of up to docs_per_item consecutive documents of a shard. For cached shards, that
+    is a view of the cache file, which can be cut into sequences without looking at the documents.
+
+    Args:
+        source_datapipe: Iterable DataPipe that provides the shard pathnames or URLs
+        tokenizer: The tokenizer to use.
+        cache_dir: The (local) directory to store tokenized shards in.
+        json_text_key: The key in the JSON file to use as the text. Defaults to "text".
+        batch_size: The number of documents to tokenize at once on a cache miss.
+        fingerprint: Identifies the tokenizer in the cache key. If None, computed via tokenizer_fingerprint.
+        extra_fsspec_args: Extra arguments to pass to fsspec when opening shards.
+        docs_per_item: The number of documents to concatenate into each item.
+    """
+
+    def __init__(self,
+                 source_datapipe: IterDataPipe[str],
+                 tokenizer: PreTrainedTokenizerBase,
+                 cache_dir: str,
+                 json_text_key: str = "text",
+                 batch_size: int = 1000,
+                 fingerprint: Optional[str] = None,
+                 extra_fsspec_args: Optional[Dict[str, Any]] = None,
+                 docs_per_item: int = 1) -> None:
+        assert docs_per_item > 0, "docs_per_item should be larger than 0"
+        self.source_datapipe: IterDataPipe[str] = source_datapipe
+        self.tokenizer = tokenizer
+        self.cache_dir = cache_dir
+        self.json_text_key = json_text_key
+        self.batch_size = batch_size
+        self.fingerprint = fingerprint or tokenizer_fingerprint(tokenizer)
+        self.extra_fsspec_args = extra_fsspec_args or {}
+        self.dtype = _token_dtype(tokenizer)
+        self.docs_per_item = docs_per_item
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        return self.skip(0)
+
+    def skip(self, n: int) -> Iterator[np.ndarray]:
+        """
+        Iterates over the items after the first n. Shards that are already cached are skipped using their document
+        counts, without reading them. Shards that aren't are tokenized (and cached) as usual.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for uri in self.source_datapipe:
+            entry = _CacheEntry(self.cache_dir, uri, self.fingerprint, self.json_text_key)
+            if entry.exists():
+                metadata = entry.read_metadata()
+                num_items = -(-metadata["num_docs"] // self.docs_per_item)
+                if n >= num_items:
+                    n -= num_items
+                    continue
+                yield from self._read_cached(entry, metadata, start=n * self.docs_per_item)
+                n = 0
+            else:
+                items = self._tokenize_and_cache(entry)
+                if self.docs_per_item > 1:
+                    items = _concatenated_chunks(items, self.docs_per_item)
+                for item in items:
+                    if n > 0:
+                        n -= 1
+                    else:
+                        yield item
+
+    def _read_cached(self, entry: _CacheEntry, metadata: Dict[str, Any], start: int = 0) -> Iterator[np.ndarray]:
+        if metadata["num_tokens"] == 0:
+            tokens = np.zeros(0, dtype=metadata["dtype"])
+        else:
+            # a plain view of the memmap, which is much cheaper to slice
+            tokens = np.asarray(np.memmap(entry.tokens_path, dtype=metadata["dtype"], mode="r",
+                                          shape=(metadata["num_tokens"],)))
+        offsets = np.load(entry.offsets_path)
+        for i in range(start, metadata["num_docs"], self.docs_per_item):
+            yield tokens[offsets[i]:offsets[min(i + self.docs_per_item, metadata["num_docs"])]]
+
+    def _tokenize_and_cache(self, entry: _CacheEntry) -> Iterator[np.ndarray]:
+        suffix = f".{uuid.uuid4().hex}.tmp"
+        tmp_tokens, tmp_offsets, tmp_metadata = (p + suffix for p in
+                                                 (entry.tokens_path, entry.offsets_path, entry.metadata_path))
+        lengths: List[int] = []
+        finished = False
+        try:
+            with open(tmp_tokens, "wb") as out:
+                docs = iter(self._read_documents(entry.uri))
+                batch = list(islice(docs, self.batch_size))
+                while batch:
+                    for ids in self.tokenizer(batch)["input_ids"]:
+                        ids = np.asarray(ids, dtype=self.dtype)
+                        out.write(ids.tobytes())
+                        lengths.append(len(ids))
+                        yield ids
+                    batch = list(islice(docs, self.batch_size))
+
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            with open(tmp_offsets, "wb") as f:
+                np.save(f, offsets)
+            with open(tmp_metadata, "w") as f:
+                json.dump({
+                    "version": _CACHE_FORMAT_VERSION,
+                    "uri": entry.uri,
+                    "tokenizer_fingerprint": self.fingerprint,
+                    "json_text_key": self.json_text_key,
+                    "dtype": self.dtype.name,
+                    "num_docs": len(lengths),
+                    "num_tokens": int(offsets[-1]),
+                }, f)
+
+            # metadata goes last: its presence marks the entry as complete
+            os.replace(tmp_tokens, entry.tokens_path)
+            os.replace(tmp_offsets, entry.offsets_path)
+            os.replace(tmp_metadata, entry.metadata_path)
+            finished = True
+        finally:
+            if not finished:
+                for p in (tmp_tokens, tmp_offsets, tmp_metadata):
+                    if os.path.exists(p):
+                        os.remove(p)
+
+    def _read_documents(self, uri: str) -> Iterator[str]:
+        opener = FancyFSSpecFileOpenerIterDataPipe(IterableWrapper([uri]), mode="rb", compression="infer",
+                                                   **self.extra_fsspec_args)
+        for path, stream in opener:
+            try:
+                yield from read_lm_text_file(path, stream, self.json_text_key)
+            finally:
+                stream.close()
+
+
+def _concatenated_chunks(docs: Iterator[np.ndarray], docs_per_item: int) -> Iterator[np.ndarray]:
+    docs = iter(docs)
+    chunk = list(islice(docs, docs_per_item))
+    while chunk:
+        yield np.concatenate(chunk)
+        chunk = list(islice(docs, docs_per_item))
+
+
+def _as_input_ids(docs: List[np.ndarray]) -> Dict[str, List[np.ndarray]]:
+    return {"input_ids": docs}
+
+
+def _with_attention_mask(encoding: BatchEncoding) -> BatchEncoding:
+    """The cache assumes the tokenizer doesn't pad, so every token of a sequence is attended to."""
+    input_ids = encoding["input_ids"]
+    if isinstance(input_ids, list):
+        encoding["attention_mask"] = [1] * len(input_ids)
+    elif isinstance(input_ids, np.ndarray):
+        encoding["attention_mask"] = np.ones(input_ids.shape, dtype=np.int64)
+    else:
+        encoding["attention_mask"] = input_ids.new_ones(input_ids.shape)
+    return encoding
+
+
+def group_cached_tokens(pipe: IterDataPipe[np.ndarray],
+                        seq_len: int,
+                        batch_size: int = 1000,
+                        stride: Optional[int] = None,
+                        drop_remainder: bool = True,
+                        mask_stride_overlap=True,
+                        return_tensors: Optional[str] = None) -> IterDataPipe[BatchEncoding]:
+    """The counterpart of tokenize_and_group_texts for a pipe of already-tokenized documents, e.g. from
+    TokenCacheIterDataPipe. Produces the same output tokenize_and_group_texts would on the original texts (with an
+    all-ones attention_mask). The documents can also be runs of concatenated documents, e.g. from
+    TokenCacheIterDataPipe with docs_per_item, in which case batch_size is the number of runs to group at once."""
+    return pipe.batch(batch_size=batch_size, wrapper_class=list)\
+        .map(_as_input_ids)\
+        .group_texts(seq_len=seq_len, stride=stride, drop_remainder=drop_remainder,
+                     mask_stride_overlap=mask_stride_overlap, return_tensors=return_tensors)\
+        .map(_with_attention_mask)
+
+
+__all__ = ["TokenCacheIterDataPipe", "tokenizer_fingerprint", "group_cached_tokens"]
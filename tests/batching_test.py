@@ -0,0 +1,80 @@
+import pickle
+import unittest
+
+import torch
+from torch.utils.data import DataLoader
+from torchdata.datapipes.iter import IterableWrapper
+
+import sprucfluo as sf
+
+
+def _tokenizer(texts):
+    # "texts" are already lists of token ids
+    return {"input_ids": texts, "attention_mask": [[1] * len(t) for t in texts]}
+
+
+def _docs():
+    return [list(range(100 * i, 100 * i + n)) for i, n in enumerate([5, 17, 3, 1, 9, 30, 2])]
+
+
+class TensorBatchTest(unittest.TestCase):
+    def sequences(self, **kwargs):
+        return list(sf.tokenize_and_group_texts(IterableWrapper(_docs()), _tokenizer, seq_len=4, batch_size=2,
+                                                **kwargs))
+
+    def test_batches_match_sequences(self):
+        for kwargs in [{}, dict(stride=3, drop_remainder=False)]:
+            sequences = self.sequences(**kwargs)
+            batches = list(sf.tokenize_and_group_texts(IterableWrapper(_docs()), _tokenizer, seq_len=4, batch_size=2,
+                                                       tensor_batch_size=5, **kwargs))
+            self.assertTrue(all(batch[k].shape == (5, 4) and batch[k].dtype == torch.long
+                                for batch in batches for k in ["input_ids", "attention_mask", "labels"]))
+            rows = [batch["input_ids"][i].tolist() for batch in batches for i in range(5)
+                    if batch["attention_mask"][i].any()]
+            self.assertEqual([row[:len(seq["input_ids"])] for row, seq in zip(rows, sequences)],
+                             [seq["input_ids"] for seq in sequences[:len(rows)]])
+            if kwargs.get("drop_remainder", True):
+                self.assertEqual(len(rows), len(sequences) - len(sequences) % 5)
+            else:
+                self.assertEqual(len(rows), len(sequences))
+                labels = [batch["labels"][i].tolist() for batch in batches for i in range(5)]
+                expected = [seq["labels"] + [-100] * (4 - len(seq["labels"])) for seq in sequences]
+                self.assertEqual(labels[:len(expected)], expected)
+                self.assertTrue(all(label == [-100] * 4 for label in labels[len(expected):]))
+
+    def test_short_sequences_are_padded_and_masked(self):
+        pipe = IterableWrapper([{"input_ids": [1, 2, 3]}, {"input_ids": [4, 5], "attention_mask": [1, 1]}])
+        batch, = list(pipe.tensor_batches(batch_size=3, seq_len=3, dtype=torch.int32, pad_token_id=9,
+                                          drop_last=False))
+        self.assertEqual(batch["input_ids"].tolist(), [[1, 2, 3], [4, 5, 9], [9, 9, 9]])
+        self.assertEqual(batch["attention_mask"].tolist(), [[1, 1, 1], [1, 1, 0], [0, 0, 0]])
+        self.assertEqual(batch["labels"].tolist(), [[1, 2, 3], [4, 5, -100], [-100, -100, -100]])
+        self.assertEqual(batch["input_ids"].dtype, torch.int32)
+
+    def test_dataloader_and_resume(self):
+        def make_pipe():
+            return sf.tokenize_and_group_texts(IterableWrapper(_docs()), _tokenizer, seq_len=4, batch_size=2,
+                                               tensor_batch_size=3)
+
+        expected = list(make_pipe())
+        loaded = list(DataLoader(make_pipe(), batch_size=None, collate_fn=sf.collate_tensor_batches))
+        self.assertEqual([b["input_ids"].tolist() for b in loaded], [b["input_ids"].tolist() for b in expected])
+
+        for n in [0, 1, 3]:
+            pipe = make_pipe()
+            it = iter(pipe)
+            for _ in range(n):
+                next(it)
+            state = pickle.loads(pickle.dumps(sf.pipeline_state_dict(pipe)))
+            resumed = make_pipe()
+            sf.load_pipeline_state_dict(resumed, state)
+            self.assertEqual([b["labels"].tolist() for b in resumed], [b["labels"].tolist() for b in expected[n:]])
+
+    @unittest.skipUnless(torch.cuda.is_available(), "pinned memory needs CUDA")
+    def test_pin_memory(self):
+        batch = next(iter(IterableWrapper([{"input_ids": [1, 2]}]).tensor_batches(1, 2, pin_memory=True)))
+        self.assertTrue(batch["input_ids"].is_pinned())
+
+
+if __name__ == '__main__':
+    unittest.main()
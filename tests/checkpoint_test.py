@@ -0,0 +1,104 @@
+import gzip
+import json
+import os
+import pickle
+import tempfile
+import unittest
+
+from torchdata.datapipes.iter import IterableWrapper
+
+import sprucfluo as sf
+from sprucfluo.text import tokenize_and_group_texts
+
+from sharding_test import with_env
+
+
+def tokenizer(texts):
+    ids = [[int(w) for w in t.split()] for t in texts]
+    return {"input_ids": ids, "attention_mask": [[1] * len(t) for t in ids]}
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = []
+        doc = 0
+        for i in range(5):
+            lines = []
+            for _ in range(3 + 2 * i):
+                lines.append(json.dumps({"text": " ".join(str(doc * 100 + j) for j in range(doc % 7 + 1))}) + "\n")
+                doc += 1
+            path = os.path.join(self.tmp.name, f"shard_{i}.jsonl")
+            if i % 2 == 1:
+                path += ".gz"
+                with gzip.open(path, "wt") as f:
+                    f.writelines(lines)
+            else:
+                with open(path, "w") as f:
+                    f.writelines(lines)
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assert_resumes(self, make_pipe):
+        expected = list(make_pipe())
+        self.assertGreater(len(expected), 10)
+        for n in range(len(expected) + 1):
+            pipe = make_pipe()
+            it = iter(pipe)
+            for _ in range(n):
+                next(it)
+            # states have to survive being saved
+            state = pickle.loads(pickle.dumps(sf.pipeline_state_dict(pipe)))
+
+            resumed = make_pipe()
+            sf.load_pipeline_state_dict(resumed, state)
+            self.assertEqual(list(resumed), expected[n:], f"resuming after {n}")
+
+    def test_corpus(self):
+        self.assert_resumes(lambda: sf.load_corpus(self.paths))
+        self.assert_resumes(lambda: sf.load_corpus(self.paths, prefetch=2))
+
+    def test_corpus_with_ranks(self):
+        for world_size in [2, 3]:
+            with with_env(RANK=1, WORLD_SIZE=world_size):
+                self.assert_resumes(lambda: sf.load_corpus(self.paths))
+
+    def test_grouped_and_shuffled(self):
+        def make_pipe(**kwargs):
+            return sf.load_corpus(self.paths) \
+                .then(tokenize_and_group_texts, tokenizer, seq_len=4, batch_size=3, **kwargs) \
+                .map(lambda x: x["input_ids"]) \
+                .seeded_shuffle(0, buffer_size=5)
+
+        self.assert_resumes(make_pipe)
+        self.assert_resumes(lambda: make_pipe(stride=2))
+        self.assert_resumes(lambda: make_pipe(num_tokenize_workers=2))
+
+    def test_unsized_sources_are_replayed(self):
+        self.assert_resumes(lambda: IterableWrapper(range(40)).slice(3, 30, 2).seeded_shuffle(1, buffer_size=4))
+
+    def test_resuming_seeks_into_the_file(self):
+        path = self.paths[0]
+        with open(path, "rb") as f:
+            data = f.read()
+
+        pipe = sf.load_corpus([path])
+        it = iter(pipe)
+        first = next(it)
+        state = sf.pipeline_state_dict(pipe)
+        rest = list(it)
+
+        # if resuming parsed the first line, this would fail
+        with open(path, "wb") as f:
+            first_line_length = data.index(b"\n")
+            f.write(b"x" * first_line_length + data[first_line_length:])
+        resumed = sf.load_corpus([path])
+        sf.load_pipeline_state_dict(resumed, state)
+        self.assertEqual(list(resumed), rest)
+        self.assertNotIn(first, rest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+import gzip
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import fsspec
+
+from torchdata.datapipes.iter import IterableWrapper
+
+import sprucfluo as sf
+
+
+class FancyOpenerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = []
+        for i in range(5):
+            data = "".join(f"file {i} line {j}\n" for j in range(100 * i + 1)).encode("utf-8")
+            path = os.path.join(self.tmp.name, f"file_{i}.txt")
+            if i % 2 == 1:
+                path += ".gz"
+                with gzip.open(path, "wb") as f:
+                    f.write(data)
+            else:
+                with open(path, "wb") as f:
+                    f.write(data)
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read_all(self, **kwargs):
+        pipe = IterableWrapper(self.paths).open_file_by_fsspec_fancy(compression="infer", **kwargs)
+        result = []
+        for path, stream in pipe:
+            result.append((path, stream.read()))
+            stream.close()
+        return result
+
+    def test_prefetch_matches_sequential(self):
+        for mode in ["rb", "r"]:
+            expected = self.read_all(mode=mode)
+            self.assertEqual([os.path.basename(p) for p, _ in expected], [f"file_{i}.txt" for i in range(5)])
+            for prefetch in [1, 2, 10]:
+                for prefetch_bytes in [1, 100, 1 << 20]:
+                    actual = self.read_all(mode=mode, prefetch=prefetch, prefetch_bytes=prefetch_bytes)
+                    self.assertEqual(actual, expected, f"failure for {mode}, {prefetch}, {prefetch_bytes}")
+
+    def test_prefetched_stream_seeks_back(self):
+        pipe = IterableWrapper(self.paths[:1]).open_file_by_fsspec_fancy(mode="rb", prefetch=1, prefetch_bytes=8)
+        for _, stream in pipe:
+            self.assertTrue(stream.seekable())
+            head = stream.read(1024)
+            stream.seek(0)
+            self.assertEqual(stream.read(1024), head)
+            stream.seek(4)
+            self.assertEqual(stream.read(4), head[4:8])
+
+    def test_early_exit_closes_prefetched_files(self):
+        pipe = IterableWrapper(self.paths).open_file_by_fsspec_fancy(mode="rb", prefetch=3)
+        it = iter(pipe)
+        _, stream = next(it)
+        it.close()
+        stream.close()
+
+
+class ShardCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, "cache")
+        self.fs = fsspec.filesystem("memory")
+        self.uris = []
+        for i in range(3):
+            data = "".join(f"shard {i} line {j}\n" for j in range(100)).encode("utf-8")
+            path = f"/shard_cache_test/shard_{i}.txt"
+            if i == 1:
+                path += ".gz"
+                data = gzip.compress(data)
+            with self.fs.open(path, "wb") as f:
+                f.write(data)
+            self.uris.append("memory://" + path)
+
+    def tearDown(self):
+        if self.fs.exists("/shard_cache_test"):
+            self.fs.rm("/shard_cache_test", recursive=True)
+        self.tmp.cleanup()
+
+    def read_all(self, uris, **kwargs):
+        pipe = IterableWrapper(uris).open_file_by_fsspec_fancy(mode="r", compression="infer",
+                                                               cache_dir=self.cache_dir, **kwargs)
+        result = []
+        for path, stream in pipe:
+            result.append((path, stream.read()))
+            stream.close()
+        return result
+
+    def cached_files(self):
+        return sorted(f for f in os.listdir(self.cache_dir) if not f.startswith("."))
+
+    def test_second_pass_reads_from_cache(self):
+        for prefetch in [0, 2]:
+            expected = self.read_all(self.uris, prefetch=prefetch)
+            self.assertEqual(len(self.cached_files()), 3)
+            # the remote copies are gone, so this can only succeed from the cache
+            self.fs.rm("/shard_cache_test", recursive=True)
+            self.assertEqual(self.read_all(self.uris, prefetch=prefetch), expected)
+            self.assertIn("shard 1 line 99\n", expected[1][1])
+            self.tearDown()
+            self.setUp()
+
+    def test_evicts_least_recently_used(self):
+        sizes = [self.fs.size(uri) for uri in self.uris]
+        budget = sizes[0] + sizes[2]
+        self.read_all(self.uris[:2], cache_max_bytes=budget)
+        # touch shard 0 so that shard 1 is the least recently used
+        time.sleep(0.01)
+        self.read_all(self.uris[:1], cache_max_bytes=budget)
+        time.sleep(0.01)
+        self.read_all(self.uris[2:], cache_max_bytes=budget)
+        cached = self.cached_files()
+        self.assertEqual(len(cached), 2)
+        self.assertTrue(any(f.endswith("shard_0.txt") for f in cached))
+        self.assertTrue(any(f.endswith("shard_2.txt") for f in cached))
+
+    def test_cached_file_evicted_while_opening(self):
+        expected = self.read_all(self.uris)
+        cache = sf.files._ShardCache(self.cache_dir)
+        file = fsspec.open(self.uris[0], mode="rb")
+
+        def open_then_evict(path, mode="r"):
+            stream = open(path, mode)
+            os.remove(path)
+            return stream
+
+        with mock.patch("sprucfluo.files.open", open_then_evict, create=True):
+            stream = cache.open(file)
+        with stream:
+            self.assertEqual(stream.read().decode("utf-8"), expected[0][1])
+
+    def test_partial_read_is_not_cached(self):
+        with self.fs.open("/shard_cache_test/big.txt", "wb") as f:
+            f.write(b"x" * (1 << 20))
+        pipe = IterableWrapper(["memory:///shard_cache_test/big.txt"]) \
+            .open_file_by_fsspec_fancy(mode="rb", cache_dir=self.cache_dir)
+        for _, stream in pipe:
+            stream.read(10)
+            stream.close()
+        self.assertEqual([f for f in os.listdir(self.cache_dir) if f != ".lock"], [])
+
+
+class GlobTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        for rel in ["a/x.jsonl", "a/y.jsonl", "a/y.txt", "a-b/z.jsonl", "a/sub/w.jsonl", "b/v.jsonl", "top.jsonl"]:
+            path = os.path.join(self.root, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(rel)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_matches_fsspec_glob(self):
+        fs = fsspec.filesystem("file")
+        for pattern in ["*/*.jsonl", "a/*", "a*/*.jsonl", "a/**", "?/y.*", "[ab]/*.jsonl", "*.jsonl"]:
+            full = os.path.join(self.root, pattern)
+            expected = sorted(p for p in fs.glob(full) if fs.isfile(p))
+            self.assertEqual(list(sf.iter_glob(full)), expected, pattern)
+
+        # like python's glob (and newer fsspecs), ** can match no directories at all
+        matches = [os.path.relpath(p, self.root) for p in sf.iter_glob(os.path.join(self.root, "**/*.jsonl"))]
+        self.assertEqual(matches, ["a-b/z.jsonl", "a/sub/w.jsonl", "a/x.jsonl", "a/y.jsonl", "b/v.jsonl", "top.jsonl"])
+
+    def test_keeps_protocol(self):
+        matches = list(sf.iter_glob("file://" + os.path.join(self.root, "a/*.jsonl")))
+        self.assertEqual(matches, ["file://" + os.path.join(self.root, f"a/{n}.jsonl") for n in "xy"])
+
+    def test_is_lazy(self):
+        fs = fsspec.filesystem("file")
+        listed = []
+        original_ls = fs.ls
+
+        def ls(path, *args, **kwargs):
+            listed.append(path)
+            return original_ls(path, *args, **kwargs)
+
+        fs.ls = ls
+        try:
+            it = sf.iter_glob(os.path.join(self.root, "*/*.jsonl"))
+            next(it)
+            # the root, and the first directory
+            self.assertEqual(len(listed), 2)
+        finally:
+            del fs.ls
+
+    def test_manifest(self):
+        manifest_dir = os.path.join(self.root, "manifests")
+        pattern = os.path.join(self.root, "a/*.jsonl")
+        pipe = sf.expand_paths([pattern, os.path.join(self.root, "top.jsonl")], expand_globs=True,
+                               glob_manifest_dir=manifest_dir)
+        with self.assertRaises(TypeError):
+            len(pipe)
+        expected = list(pipe)
+        self.assertEqual(len(expected), 3)
+        self.assertEqual(len(pipe), 3)
+        os.remove(os.path.join(self.root, "a/x.jsonl"))
+        self.assertEqual(list(pipe), expected)
+
+        opener = IterableWrapper([pattern]).open_file_by_fsspec_fancy(expand_globs=True, glob_manifest_dir=manifest_dir)
+        self.assertEqual(len(opener), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
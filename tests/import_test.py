@@ -0,0 +1,27 @@
+import subprocess
+import sys
+import unittest
+
+_SCRIPT = """
+import sys
+import sprucfluo
+from torch.utils.data.datapipes.iter import IterableWrapper
+
+pipe = IterableWrapper(range(10)).take(5).drop(1).then(lambda p: p.map(str))
+assert list(pipe) == ["1", "2", "3", "4"], list(pipe)
+print(",".join(m for m in ["transformers", "magic", "torchdata"] if m in sys.modules))
+"""
+
+
+class ImportTest(unittest.TestCase):
+    def test_heavy_imports_are_deferred(self):
+        # in a fresh interpreter, since the other tests import everything
+        out = subprocess.run([sys.executable, "-c", _SCRIPT], capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), "")
+
+    def test_batch_encodings(self):
+        from transformers import BatchEncoding
+        from sprucfluo.text import concatenate_and_group_texts
+
+        sequences = list(concatenate_and_group_texts({"input_ids": [[1, 2, 3, 4]]}, seq_len=2))
+        self.assertTrue(all(isinstance(seq, BatchEncoding) for seq in sequences))
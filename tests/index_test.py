@@ -0,0 +1,233 @@
+import gzip
+import json
+import os
+import pickle
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import fsspec
+import zstandard
+
+import sprucfluo as sf
+from sprucfluo.index import DocumentRange, ByteRange, build_index, write_index, load_index, open_at_document
+
+from sharding_test import with_env
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+from index_shards import rewrite_framed  # noqa: E402
+
+
+def _docs(shard, n):
+    return [f"shard {shard} doc {i} " + "x" * (i % 13) for i in range(n)]
+
+
+def _lines(docs):
+    # with a few blank lines, which aren't documents
+    lines = []
+    for i, doc in enumerate(docs):
+        lines.append(json.dumps({"text": doc}) + "\n")
+        if i % 7 == 3:
+            lines.append("\n")
+    return "".join(lines).encode("utf-8")
+
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.docs = {}
+        self.paths = {}
+        for name, compress in [("plain.jsonl", lambda d: d), ("single.jsonl.zst", self._zstd),
+                               ("framed.jsonl.zst", self._framed_zstd), ("framed.jsonl.gz", self._framed_gzip)]:
+            docs = _docs(len(self.paths), 200)
+            path = os.path.join(self.tmp.name, name)
+            with open(path, "wb") as f:
+                f.write(compress(_lines(docs)))
+            self.docs[name] = docs
+            self.paths[name] = path
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @staticmethod
+    def _zstd(data):
+        return zstandard.ZstdCompressor().compress(data)
+
+    @staticmethod
+    def _frames(data, n):
+        # frames that split lines, to make sure that seek points still land on documents
+        return [data[i:i + n] for i in range(0, len(data), n)]
+
+    def _framed_zstd(self, data):
+        return b"".join(self._zstd(chunk) for chunk in self._frames(data, 1000))
+
+    def _framed_gzip(self, data):
+        return b"".join(gzip.compress(chunk) for chunk in self._frames(data, 1000))
+
+    def read_docs(self, head, stream, raw):
+        try:
+            data = head + stream.read()
+        finally:
+            stream.close()
+            raw.close()
+        return [json.loads(line)["text"] for line in data.split(b"\n") if line.strip()]
+
+    def test_open_at_document(self):
+        fs = fsspec.filesystem("file")
+        for name, path in self.paths.items():
+            index = build_index(path, checkpoint_bytes=500)
+            self.assertEqual(index.num_docs, 200)
+            if name != "single.jsonl.zst":
+                self.assertGreater(len(index.checkpoints), 5, name)
+            compression = fsspec.utils.infer_compression(path)
+            for doc in [0, 1, 57, 199, 200]:
+                actual = self.read_docs(*open_at_document(fs, path, compression, doc, index))
+                self.assertEqual(actual, self.docs[name][doc:], f"{name} at {doc}")
+
+    def test_index_round_trips(self):
+        path = self.paths["framed.jsonl.gz"]
+        index = build_index(path, checkpoint_bytes=500)
+        self.assertIsNone(load_index(path))
+        write_index(path, index)
+        loaded = load_index(path)
+        self.assertEqual((loaded.num_docs, loaded.compression, loaded.checkpoints),
+                         (index.num_docs, index.compression, index.checkpoints))
+
+    def test_rewrite_framed(self):
+        path = self.paths["single.jsonl.zst"]
+        out = os.path.join(self.tmp.name, "rewritten.jsonl.zst")
+        rewrite_framed(path, out, 1000)
+        index = build_index(out, checkpoint_bytes=500)
+        self.assertGreater(len(index.checkpoints), 3)
+        # every seek point is at the start of a line
+        self.assertTrue(all(skip == 0 for _, skip, _ in index.checkpoints))
+        fs = fsspec.filesystem("file")
+        actual = self.read_docs(*open_at_document(fs, out, "zstd", 123, index))
+        self.assertEqual(actual, self.docs["single.jsonl.zst"][123:])
+
+    def test_corpus_len_and_ranges(self):
+        paths = [self.paths[name] for name in ["plain.jsonl", "framed.jsonl.zst", "framed.jsonl.gz"]]
+        with self.assertRaises(TypeError):
+            len(sf.load_corpus(paths))
+        for path in paths:
+            write_index(path, build_index(path, checkpoint_bytes=500))
+
+        self.assertEqual(len(sf.load_corpus(paths)), 600)
+        for world_size in [2, 4]:
+            lengths = []
+            for rank in range(world_size):
+                with with_env(RANK=rank, WORLD_SIZE=world_size):
+                    pipe = sf.load_corpus(paths)
+                    lengths.append(len(pipe))
+                    self.assertEqual(len(list(pipe)), lengths[-1])
+            self.assertGreaterEqual(sum(lengths), 600)
+
+        ranges = [DocumentRange(paths[1], 150), DocumentRange(paths[2], 10, 20), DocumentRange(paths[0], 0, 5)]
+        expected = self.docs["framed.jsonl.zst"][150:] + self.docs["framed.jsonl.gz"][10:20] + \
+            self.docs["plain.jsonl"][:5]
+        for prefetch in [0, 2]:
+            pipe = sf.load_corpus(ranges, prefetch=prefetch)
+            self.assertEqual(len(pipe), len(expected))
+            self.assertEqual(list(pipe), expected)
+
+        # resuming within a range
+        pipe = sf.load_corpus(ranges)
+        it = iter(pipe)
+        for _ in range(55):
+            next(it)
+        state = pickle.loads(pickle.dumps(sf.pipeline_state_dict(pipe)))
+        resumed = sf.load_corpus(ranges)
+        sf.load_pipeline_state_dict(resumed, state)
+        self.assertEqual(list(resumed), expected[55:])
+
+    def test_byte_ranges_partition_lines(self):
+        path = self.paths["plain.jsonl"]
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        # including cuts right before and after newlines
+        newline = data.index(b"\n")
+        for cuts in [[0, size], [0, 1, size], [0, newline, newline + 1, newline + 2, size],
+                     list(range(0, size, 97)) + [size]]:
+            ranges = [ByteRange(path, start, stop) for start, stop in zip(cuts, cuts[1:])] + [ByteRange(path, size)]
+            self.assertEqual(list(sf.load_corpus(ranges, shard_by_rank=False)), self.docs["plain.jsonl"], cuts)
+
+    def test_remnant_is_split_between_ranks(self):
+        names = ["plain.jsonl", "framed.jsonl.zst", "framed.jsonl.gz"]
+        paths = [self.paths[name] for name in names]
+        for path in paths[1:]:
+            write_index(path, build_index(path, checkpoint_bytes=500))
+        all_docs = sorted(doc for name in names for doc in self.docs[name])
+
+        for world_size in [2, 4, 5]:
+            results = []
+            for rank in range(world_size):
+                with with_env(RANK=rank, WORLD_SIZE=world_size):
+                    results.append(list(sf.load_corpus(paths)))
+                    if len(paths) < world_size:
+                        # a plain file doesn't have an index, so we don't know how many documents it has
+                        with self.assertRaises(TypeError):
+                            len(sf.load_corpus(paths))
+            # each document is read by exactly one rank
+            self.assertEqual(sorted(doc for docs in results for doc in docs), all_docs)
+            if world_size > len(paths):
+                sizes = [len(docs) for docs in results]
+                self.assertLess(max(sizes) - min(sizes), 100)
+
+        # with indexes everywhere, each rank knows its length
+        write_index(paths[0], build_index(paths[0], checkpoint_bytes=500))
+        for rank in range(4):
+            with with_env(RANK=rank, WORLD_SIZE=4):
+                pipe = sf.load_corpus(paths)
+                self.assertEqual(len(pipe), 150)
+                self.assertEqual(len(list(pipe)), 150)
+
+    def test_equalize_length(self):
+        paths = [self.paths[name] for name in ["plain.jsonl", "framed.jsonl.zst", "framed.jsonl.gz"]]
+        for path in paths:
+            write_index(path, build_index(path, checkpoint_bytes=500))
+        # rank 0 gets 2 shards, and rank 1 a shard and a third
+        paths.append(DocumentRange(paths[0], 0, 66))
+        for rank, unequal_length in enumerate([400, 266]):
+            with with_env(RANK=rank, WORLD_SIZE=2):
+                self.assertEqual(len(sf.load_corpus(paths)), unequal_length)
+                pipe = sf.load_corpus(paths, equalize_length=True)
+                self.assertEqual(len(pipe), 266)
+                self.assertEqual(len(list(pipe)), 266)
+
+    def test_lengths_read_each_index_once(self):
+        paths = [self.paths[name] for name in ["plain.jsonl", "framed.jsonl.zst", "framed.jsonl.gz"]]
+        for path in paths:
+            write_index(path, build_index(path, checkpoint_bytes=500))
+        sf.index._INDEX_CACHE.clear()
+        with mock.patch("sprucfluo.index.read_index", wraps=sf.index.read_index) as read_index:
+            for rank in range(2):
+                with with_env(RANK=rank, WORLD_SIZE=2):
+                    pipe = sf.load_corpus(paths, equalize_length=True)
+                    # the third shard is split between the ranks
+                    self.assertEqual(pipe.rank_lengths(), [300, 300])
+                    self.assertEqual(pipe.rank_lengths(), [pipe.source_datapipe.length_at(r, 2) for r in range(2)])
+                    for _ in range(2):
+                        self.assertEqual(len(list(pipe)), 300)
+            self.assertEqual(read_index.call_count, len(paths))
+
+    def test_balanced_shards(self):
+        paths = [self.paths[name] for name in ["plain.jsonl", "framed.jsonl.zst", "framed.jsonl.gz"]]
+        self.assertEqual(sf.shard_sizes(paths), [os.path.getsize(path) for path in paths])
+        for path in paths:
+            write_index(path, build_index(path, checkpoint_bytes=500))
+        sf.files._SHARD_INFO_CACHE.clear()
+        self.assertEqual(sf.shard_sizes(paths + [DocumentRange(paths[0], 50, 100)]), [200, 200, 200, 50])
+
+        results = []
+        for rank in range(2):
+            with with_env(RANK=rank, WORLD_SIZE=2):
+                results.append(list(sf.load_corpus(paths, balance_shards=True)))
+        self.assertEqual(sorted(len(docs) for docs in results), [200, 400])
+        expected = self.docs["plain.jsonl"] + self.docs["framed.jsonl.zst"] + self.docs["framed.jsonl.gz"]
+        self.assertEqual(sorted(doc for docs in results for doc in docs), sorted(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
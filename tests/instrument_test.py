@@ -0,0 +1,145 @@
+import gzip
+import json
+import os
+import pickle
+import tempfile
+import time
+import unittest
+
+from torchdata.datapipes.iter import IterableWrapper
+
+import sprucfluo as sf
+from sprucfluo.text import tokenize_and_group_texts
+
+
+def tokenizer(texts):
+    ids = [[int(w) for w in t.split()] for t in texts]
+    return {"input_ids": ids, "attention_mask": [[1] * len(t) for t in ids]}
+
+
+def slow(x):
+    time.sleep(0.002)
+    return x
+
+
+class InstrumentTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = []
+        self.sizes = []
+        doc = 0
+        for i in range(4):
+            lines = []
+            for _ in range(5):
+                lines.append(json.dumps({"text": " ".join(str(doc * 10 + j) for j in range(doc % 5 + 1))}) + "\n")
+                doc += 1
+            data = "".join(lines).encode("utf-8")
+            path = os.path.join(self.tmp.name, f"shard_{i}.jsonl")
+            if i % 2 == 1:
+                path += ".gz"
+                with gzip.open(path, "wb") as f:
+                    f.write(data)
+            else:
+                with open(path, "wb") as f:
+                    f.write(data)
+            self.paths.append(path)
+            self.sizes.append(len(data))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_counts_and_times(self):
+        pipe = IterableWrapper(range(20)).map(slow).map(lambda x: {"input_ids": [x] * 3})
+        instrumented = sf.instrument(pipe)
+        self.assertEqual([x["input_ids"] for x in instrumented], [[x] * 3 for x in range(20)])
+
+        stats = instrumented.stats.to_dict()
+        self.assertEqual(set(stats["stages"]), {"Mapper(<lambda>)", "Mapper(slow)", "IterableWrapper"})
+        for stage in stats["stages"].values():
+            self.assertEqual(stage["items"], 20)
+        self.assertEqual(stats["stages"]["Mapper(<lambda>)"]["tokens"], 60)
+        slow_stage = stats["stages"]["Mapper(slow)"]
+        self.assertGreaterEqual(slow_stage["inside_secs"], 0.04)
+        # the lambda's waiting is the slow map's inside (and the wrapper's)
+        self.assertGreaterEqual(stats["stages"]["Mapper(<lambda>)"]["waiting_secs"], slow_stage["inside_secs"])
+        self.assertLess(stats["stages"]["IterableWrapper"]["inside_secs"], slow_stage["inside_secs"])
+        self.assertEqual(stats["slowest_stage"], "Mapper(slow)")
+        json.loads(instrumented.stats.to_json())
+
+    def test_sampling(self):
+        pipe = IterableWrapper(range(100)).map(slow)
+        instrumented = sf.instrument(pipe, sample_every=10)
+        self.assertEqual(list(instrumented), list(range(100)))
+        stage = instrumented.stats.stages["Mapper(slow)"]
+        self.assertEqual(stage.items, 100)
+        # 10 items timed, scaled up by 10
+        self.assertGreaterEqual(stage.inside_secs, 0.2)
+        self.assertLess(stage.inside_secs, 2.0)
+
+    def test_bytes_and_tokens_of_a_corpus(self):
+        pipe = sf.load_corpus(self.paths).then(tokenize_and_group_texts, tokenizer, seq_len=4, batch_size=3)
+        expected = list(pipe)
+        instrumented = sf.instrument(sf.load_corpus(self.paths)
+                                     .then(tokenize_and_group_texts, tokenizer, seq_len=4, batch_size=3))
+        self.assertEqual(list(instrumented), expected)
+
+        stages = instrumented.stats.stages
+        opener = stages["FancyFSSpecFileOpener"]
+        self.assertEqual(opener.items, len(self.paths))
+        self.assertGreater(opener.max_item_secs, 0)
+        # the gzipped shards are counted decompressed
+        self.assertEqual(opener.bytes, sum(self.sizes))
+        self.assertEqual(stages["LMTextFileReader"].items, 20)
+        self.assertEqual(stages["GroupTexts"].tokens, 4 * len(expected))
+
+    def test_checkpointing_looks_through(self):
+        def make():
+            return sf.load_corpus(self.paths).then(tokenize_and_group_texts, tokenizer, seq_len=4, batch_size=3)
+
+        expected = [x["input_ids"] for x in make()]
+        pipe = sf.instrument(make())
+        it = iter(pipe)
+        first = [next(it)["input_ids"] for _ in range(5)]
+        state = pickle.loads(pickle.dumps(sf.pipeline_state_dict(pipe)))
+
+        resumed = sf.instrument(make())
+        sf.load_pipeline_state_dict(resumed, state)
+        self.assertEqual(first + [x["input_ids"] for x in resumed], expected)
+
+    def test_mixture_and_sharded_stages(self):
+        a = IterableWrapper([{"input_ids": [1, 2]}] * 10)
+        b = IterableWrapper([{"input_ids": [1, 2, 3, 4]}] * 10)
+        mixture = sf.TokenMixtureIterDataPipe({"a": a, "b": b}, {"a": 1, "b": 1}, strategy="deterministic")
+        instrumented = sf.instrument(mixture)
+        items = list(instrumented)
+        stages = instrumented.stats.stages
+        self.assertEqual(stages["a/IterableWrapper"].items + stages["b/IterableWrapper"].items, len(items))
+        self.assertEqual(stages["TokenMixture"].tokens, sum(len(x["input_ids"]) for x in items))
+
+        shards = IterableWrapper(["x", "y"]).interleave_shards(lambda s: IterableWrapper([s] * 3), num_open=2, seed=0)
+        instrumented = sf.instrument(shards)
+        # (not list(), which iterates over the shards to get the length too)
+        self.assertEqual(sorted(x for x in instrumented), ["x"] * 3 + ["y"] * 3)
+        self.assertEqual(instrumented.stats.stages["IterableWrapper"].items, 2 + 6)
+
+    def test_hooks(self):
+        calls = []
+        instrumented = sf.instrument(IterableWrapper(range(10)), hook=calls.append, hook_every_secs=0)
+        list(instrumented)
+        self.assertTrue(calls)
+        self.assertIs(calls[0], instrumented.stats)
+
+        class Writer:
+            def __init__(self):
+                self.scalars = {}
+
+            def add_scalar(self, tag, value, step):
+                self.scalars[tag] = value
+
+        writer = Writer()
+        sf.tensorboard_hook(writer)(instrumented.stats)
+        self.assertIn("sprucfluo/IterableWrapper/items_per_sec", writer.scalars)
+
+        with self.assertLogs("sprucfluo.instrument") as logs:
+            sf.log_hook()(instrumented.stats)
+        self.assertIn("IterableWrapper", "\n".join(logs.output))
@@ -1,9 +1,12 @@
 from itertools import *
+import pickle
 import unittest
 
 from torchdata.datapipes.iter import IterableWrapper
 from torchdata.datapipes.iter.util.samplemultiplexer import SampleMultiplexerDataPipe
 
+import sprucfluo as sf
+
 class SampleTest(unittest.TestCase):
     def test_sample_with_infinite_iter(self):
         a = IterableWrapper(repeat('a'))
@@ -35,5 +38,115 @@ class SampleTest(unittest.TestCase):
         self.assertTrue(650 <= result.count('b') <= 750)
 
 
+def _sequences(name, n, seq_len):
+    return IterableWrapper([{"input_ids": [name] * seq_len, "index": i} for i in range(n)])
+
+
+class _Unreadable(IterableWrapper):
+    def __init__(self):
+        super().__init__([])
+
+    def __iter__(self):
+        raise AssertionError("shouldn't be opened")
+
+
+class _Counted(IterableWrapper):
+    """Sequences like _sequences', counting the times it's opened"""
+    def __init__(self, name, n, seq_len):
+        super().__init__([{"input_ids": [name] * seq_len, "index": i} for i in range(n)], deepcopy=False)
+        self.opens = 0
+
+    def __iter__(self):
+        self.opens += 1
+        return super().__iter__()
+
+    def skip(self, n):
+        self.opens += 1
+        return iter(self.iterable[n:])
+
+
+class TokenMixtureTest(unittest.TestCase):
+    def sources(self, n=1000):
+        # b's sequences are three times as long as a's
+        return {"a": _sequences("a", n, 10), "b": _sequences("b", n, 30), "c": _Unreadable()}
+
+    def test_deterministic_proportions_are_by_token(self):
+        pipe = sf.TokenMixtureIterDataPipe(self.sources(), {"a": 1, "b": 1, "c": 0}, strategy="deterministic")
+        result = list(islice(pipe, 400))
+        a_tokens, b_tokens = 10 * sum(x["input_ids"][0] == "a" for x in result), \
+            30 * sum(x["input_ids"][0] == "b" for x in result)
+        self.assertLessEqual(abs(a_tokens - b_tokens), 30)
+        self.assertEqual(pipe.token_counts(), {"a": a_tokens, "b": b_tokens, "c": 0})
+
+    def test_stochastic_proportions_are_by_token(self):
+        pipe = sf.TokenMixtureIterDataPipe(self.sources(), {"a": 1, "b": 3, "c": 0}, seed=1)
+        list(islice(pipe, 1000))
+        counts = pipe.token_counts()
+        self.assertTrue(2.6 < counts["b"] / counts["a"] < 3.4, counts)
+        self.assertEqual(counts["c"], 0)
+
+    def test_stops_or_drops_exhausted_sources(self):
+        weights = {"a": 1, "b": 1, "c": 0}
+        pipe = sf.TokenMixtureIterDataPipe(self.sources(30), weights, strategy="deterministic")
+        result = list(pipe)
+        self.assertEqual(sum(x["input_ids"][0] == "b" for x in result), 10)
+
+        pipe = sf.TokenMixtureIterDataPipe(self.sources(30), weights, strategy="deterministic",
+                                           stop_when_exhausted=False)
+        self.assertEqual(len(list(pipe)), 60)
+
+    def test_set_weights(self):
+        pipe = sf.TokenMixtureIterDataPipe(self.sources(), {"a": 1, "b": 0, "c": 0}, strategy="deterministic")
+        it = iter(pipe)
+        self.assertEqual({next(it)["input_ids"][0] for _ in range(10)}, {"a"})
+        pipe.set_weights({"a": 0, "b": 1})
+        self.assertEqual({next(it)["input_ids"][0] for _ in range(10)}, {"b"})
+        self.assertEqual(pipe.token_counts(), {"a": 100, "b": 300, "c": 0})
+        with self.assertRaises(ValueError):
+            pipe.set_weights({"d": 1})
+
+    def test_max_open_and_resume(self):
+        weights = {"a": 2, "b": 1, "c": 0}
+
+        def make_pipe():
+            return sf.TokenMixtureIterDataPipe(self.sources(50), weights, seed=3, max_open=1, run_tokens=100)
+
+        expected = list(make_pipe())
+        # runs of at least 100 tokens from one source at a time
+        runs = [sum(len(x["input_ids"]) for x in group) for _, group in groupby(expected, lambda x: x["input_ids"][0])]
+        self.assertGreater(len(runs), 2)
+        self.assertTrue(all(tokens >= 100 for tokens in runs[:-1]), runs)
+        for n in [0, 7, 40]:
+            pipe = make_pipe()
+            it = iter(pipe)
+            for _ in range(n):
+                next(it)
+            state = pickle.loads(pickle.dumps(sf.pipeline_state_dict(pipe)))
+            resumed = make_pipe()
+            sf.load_pipeline_state_dict(resumed, state)
+            self.assertEqual(list(resumed), expected[n:], n)
+
+    def test_max_open_reopens_once_per_run(self):
+        for strategy in ["deterministic", "stochastic"]:
+            sources = {name: _Counted(name, 1000, 10) for name in "abcd"}
+            pipe = sf.TokenMixtureIterDataPipe(sources, {name: 1 for name in sources}, strategy=strategy,
+                                               max_open=2, run_tokens=200)
+            list(islice(pipe, 800))
+            # 40 runs of 20 items, each opening at most 2 sources
+            self.assertLessEqual(sum(source.opens for source in sources.values()), 2 * 40, strategy)
+            for name, count in pipe.token_counts().items():
+                self.assertLessEqual(abs(count - 2000), 300, (strategy, name, count))
+
+    def test_unread_sources_arent_opened_early(self):
+        sources = {"a": _Counted("a", 1000, 100), "b": _Counted("b", 1000, 100)}
+        pipe = sf.TokenMixtureIterDataPipe(sources, {"a": 1, "b": 0.001}, seed=0)
+        list(islice(pipe, 20))
+        self.assertEqual(sources["b"].opens, 0)
+
+        sources = {str(i): _Counted(str(i), 1000, 100) for i in range(20)}
+        pipe = sf.TokenMixtureIterDataPipe(sources, {name: 1 for name in sources}, seed=0, max_open=2)
+        list(islice(pipe, 20))
+        self.assertEqual(sum(source.opens for source in sources.values()), 2)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,73 @@
+import pickle
+import unittest
+
+from torchdata.datapipes.iter import IterableWrapper
+
+import sprucfluo as sf
+
+
+def _tokenizer(texts):
+    # "texts" are already lists of token ids
+    return {"input_ids": texts, "attention_mask": [[1] * len(t) for t in texts]}
+
+
+def _docs(lengths):
+    return [list(range(1000 * i, 1000 * i + n)) for i, n in enumerate(lengths)]
+
+
+class PackingTest(unittest.TestCase):
+    def test_best_fit_decreasing(self):
+        bins = sf.best_fit_decreasing([5, 4, 3, 3, 2, 2, 1], 10)
+        self.assertEqual(sorted(sorted(b) for b in bins), [[0, 1, 6], [2, 3, 4, 5]])
+        self.assertEqual(sf.best_fit_decreasing([], 10), [])
+
+    def test_packs_whole_documents(self):
+        lengths = [5, 17, 3, 1, 9, 30, 2, 8, 8, 4, 7, 6]
+        docs = _docs(lengths)
+        pipe = sf.tokenize_and_group_texts(IterableWrapper(docs), _tokenizer, seq_len=10, batch_size=4, pack=True,
+                                           pack_window=5)
+        sequences = list(pipe)
+        self.assertTrue(all(len(seq["input_ids"]) <= 10 for seq in sequences))
+
+        # every token is there once, and documents are only split if they're longer than seq_len
+        pieces = []
+        for seq in sequences:
+            self.assertEqual(len(seq["position_ids"]), len(seq["input_ids"]))
+            starts = [i for i, p in enumerate(seq["position_ids"]) if p == 0] + [len(seq["input_ids"])]
+            for begin, end in zip(starts, starts[1:]):
+                pieces.append(seq["input_ids"][begin:end])
+                self.assertEqual(seq["labels"][begin], -100)
+                self.assertEqual(seq["labels"][begin + 1:end], seq["input_ids"][begin + 1:end])
+        self.assertEqual(sorted(t for piece in pieces for t in piece), sorted(t for doc in docs for t in doc))
+        for piece in pieces:
+            doc = docs[piece[0] // 1000]
+            if len(doc) <= 10:
+                self.assertEqual(piece, doc)
+
+        stats = pipe.stats()
+        self.assertEqual((stats["documents"], stats["split_documents"]), (12, 2))
+        self.assertEqual(stats["tokens"], sum(lengths))
+        self.assertAlmostEqual(pipe.padding_fraction(), 1 - sum(lengths) / (10 * len(sequences)))
+
+    def test_tensor_batches_and_resume(self):
+        docs = _docs([5, 17, 3, 1, 9, 30, 2, 8, 8, 4, 7, 6] * 3)
+
+        def make_pipe():
+            return sf.tokenize_and_group_texts(IterableWrapper(docs), _tokenizer, seq_len=10, batch_size=4,
+                                               pack=True, pack_window=6, tensor_batch_size=2, drop_remainder=False)
+
+        expected = [{k: v.tolist() for k, v in batch.items()} for batch in make_pipe()]
+        self.assertEqual(set(expected[0].keys()), {"input_ids", "attention_mask", "labels", "position_ids"})
+        for n in [0, 3, 9, len(expected)]:
+            pipe = make_pipe()
+            it = iter(pipe)
+            for _ in range(n):
+                next(it)
+            state = pickle.loads(pickle.dumps(sf.pipeline_state_dict(pipe)))
+            resumed = make_pipe()
+            sf.load_pipeline_state_dict(resumed, state)
+            self.assertEqual([{k: v.tolist() for k, v in batch.items()} for batch in resumed], expected[n:], n)
+
+
+if __name__ == '__main__':
+    unittest.main()
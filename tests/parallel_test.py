@@ -0,0 +1,65 @@
+import threading
+import time
+import unittest
+
+from torchdata.datapipes.iter import IterableWrapper
+
+import sprucfluo as sf
+from sprucfluo.text import tokenize_and_group_texts
+
+
+def square(x):
+    return x * x
+
+
+def slow_if_even(x):
+    if x % 2 == 0:
+        time.sleep(0.01)
+    return x
+
+
+class ParallelMapTest(unittest.TestCase):
+    def test_ordered_matches_map(self):
+        for executor in ["thread", "process"]:
+            pipe = IterableWrapper(range(100)).parallel_map(square, num_workers=4, executor=executor)
+            self.assertEqual(list(pipe), [x * x for x in range(100)])
+
+    def test_unordered_emits_everything(self):
+        pipe = IterableWrapper(range(50)).parallel_map(slow_if_even, num_workers=4, ordered=False)
+        self.assertEqual(sorted(pipe), list(range(50)))
+
+    def test_bounded_in_flight(self):
+        pulled = []
+
+        def source():
+            for i in range(100):
+                pulled.append(i)
+                yield i
+
+        pipe = IterableWrapper(source(), deepcopy=False).parallel_map(square, num_workers=2, max_in_flight=3)
+        it = iter(pipe)
+        next(it)
+        self.assertLessEqual(len(pulled), 3)
+        self.assertEqual(list(it), [x * x for x in range(1, 100)])
+
+    def test_closing_shuts_down_workers(self):
+        before = threading.active_count()
+        it = iter(IterableWrapper(range(100)).parallel_map(square, num_workers=4))
+        next(it)
+        it.close()
+        self.assertEqual(threading.active_count(), before)
+
+    def test_parallel_tokenize_and_group_texts(self):
+        def tokenizer(texts):
+            ids = [[int(w) for w in t.split()] for t in texts]
+            return {"input_ids": ids, "attention_mask": [[1] * len(t) for t in ids]}
+
+        texts = [" ".join(str(i) for i in range(n, 2 * n)) for n in range(1, 40)]
+        expected = list(tokenize_and_group_texts(IterableWrapper(texts), tokenizer, seq_len=16, batch_size=3))
+        actual = list(tokenize_and_group_texts(IterableWrapper(texts), tokenizer, seq_len=16, batch_size=3,
+                                               num_tokenize_workers=4))
+        self.assertEqual([dict(a) for a in actual], [dict(e) for e in expected])
+
+
+if __name__ == '__main__':
+    unittest.main()
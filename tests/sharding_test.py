@@ -57,6 +57,124 @@ class FlatShardTest(unittest.TestCase):
                     [3, 3, 3, 7, 7, 7, 9, 10]]
         self.assertEqual(results, expected)
 
+    def test_split_remnant(self):
+        # the remnant [8, 9, 10] is split so that each rank reads its own part instead of every third item
+        def split(shards, rank, world_size):
+            return shards[rank::world_size]
+
+        results = []
+        for rank in range(4):
+            with with_env(RANK=rank, WORLD_SIZE=4):
+                pipe = self.ex.flat_shard_by_rank(lambda it: [y for x in it for y in [x] * 3], split_remnant=split)
+                results.append(list(pipe))
+                self.assertEqual(len(pipe), len(results[-1]))
+        self.assertEqual(results, [[0, 0, 0, 4, 4, 4, 8, 8, 8],
+                                   [1, 1, 1, 5, 5, 5, 9, 9, 9],
+                                   [2, 2, 2, 6, 6, 6, 10, 10, 10],
+                                   [3, 3, 3, 7, 7, 7]])
+
+
+
+class BalancedShardTest(unittest.TestCase):
+    def test_lpt_partition(self):
+        weights = [50, 2000, 70, 1200, 900, 1500, 60, 2500, 800, 1300]
+        parts = sf.lpt_partition(weights, 3)
+        self.assertEqual(sorted(i for part in parts for i in part), list(range(len(weights))))
+        loads = [sum(weights[i] for i in part) for part in parts]
+        # round-robin would give 2610, 5400 and 2370
+        self.assertLess(max(loads) - min(loads), 300)
+        self.assertEqual(parts, [sorted(part) for part in parts])
+
+    def test_balanced_flat_shard(self):
+        sizes = {"a": 10, "b": 1, "c": 1, "d": 1, "e": 8, "f": 1, "g": 1, "h": 1}
+        ex = IterableWrapper(list(sizes))
+
+        def read(shards):
+            return [f"{shard}{i}" for shard in shards for i in range(sizes[shard])]
+
+        def weights(shards):
+            return [sizes[shard] for shard in shards]
+
+        results = []
+        for rank in range(3):
+            with with_env(RANK=rank, WORLD_SIZE=3):
+                pipe = ex.flat_shard_by_rank(read, shard_weights=weights)
+                results.append(list(pipe))
+                self.assertEqual(len(pipe), len(results[-1]))
+                self.assertEqual(list(ex.shard_by_rank(shard_weights=weights)), sorted({x[0] for x in results[-1]}))
+        self.assertEqual(sorted(x for result in results for x in result), sorted(read(sizes)))
+        self.assertEqual(sorted(len(result) for result in results), [6, 8, 10])
+
+        # with fewer shards than ranks, it's all remnant
+        with with_env(RANK=1, WORLD_SIZE=10):
+            self.assertEqual(list(ex.flat_shard_by_rank(read, shard_weights=weights)), read(sizes)[1::10])
+
+
+
+def _triple(shards):
+    return [y for x in shards for y in [x] * 3]
+
+
+class WorkerShardTest(unittest.TestCase):
+    ex = IterableWrapper(list(range(11)))
+
+    def test_rank_and_worker_grid(self):
+        results = {}
+        for rank in range(2):
+            for worker in range(2):
+                with with_env(RANK=rank, WORLD_SIZE=2, WORKER=worker, NUM_WORKERS=2):
+                    results[rank, worker] = list(self.ex.flat_shard_by_rank(_triple, shard_by_worker=True))
+        self.assertEqual(results[0, 0][:6], [0, 0, 0, 4, 4, 4])
+        self.assertEqual(results[0, 1][:6], [1, 1, 1, 5, 5, 5])
+        self.assertEqual(results[1, 0][:6], [2, 2, 2, 6, 6, 6])
+        self.assertEqual(sorted(x for result in results.values() for x in result), _triple(range(11)))
+
+    def test_dataloader_workers(self):
+        from torch.utils.data import DataLoader
+        pipe = self.ex.flat_shard_by_rank(_triple, shard_by_worker=True)
+        loaded = [int(x) for x in DataLoader(pipe, batch_size=None, num_workers=3)]
+        self.assertEqual(sorted(loaded), _triple(range(11)))
+
+
+
+class EqualLengthTest(unittest.TestCase):
+    def test_fixed_length_cycles_and_truncates(self):
+        ex = IterableWrapper(list(range(5)))
+        self.assertEqual(list(ex.equalize_length(12)), [0, 1, 2, 3, 4] * 2 + [0, 1])
+        self.assertEqual(list(ex.equalize_length(3)), [0, 1, 2])
+        self.assertEqual(len(ex.equalize_length(12)), 12)
+        with self.assertRaises(ValueError):
+            list(IterableWrapper([]).equalize_length(1))
+
+    def test_truncates_to_shortest_rank(self):
+        ex = IterableWrapper(list(range(11)))
+        for world_size in [2, 3, 4]:
+            results = []
+            for rank in range(world_size):
+                with with_env(RANK=rank, WORLD_SIZE=world_size):
+                    pipe = ex.flat_shard_by_rank(_triple).equalize_length()
+                    results.append(list(pipe))
+            self.assertEqual(len({len(result) for result in results}), 1, results)
+            self.assertEqual(len(results[0]), 33 // world_size)
+
+    def test_lengths_match_length_at(self):
+        ex = IterableWrapper(list(range(11)))
+        for shard_weights in [None, lambda shards: [shard + 1 for shard in shards]]:
+            for world_size in [1, 2, 3, 4, 20]:
+                pipe = ex.flat_shard_by_rank(_triple, shard_weights=shard_weights)
+                self.assertEqual(pipe.lengths(world_size),
+                                 [pipe.length_at(rank, world_size) for rank in range(world_size)])
+
+    def test_resumes(self):
+        pipe = IterableWrapper(list(range(5))).equalize_length(12)
+        it = iter(pipe)
+        for _ in range(7):
+            next(it)
+        state = sf.pipeline_state_dict(pipe)
+        resumed = IterableWrapper(list(range(5))).equalize_length(12)
+        sf.load_pipeline_state_dict(resumed, state)
+        self.assertEqual(list(resumed), [2, 3, 4, 0, 1])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,233 @@
+import json
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from torchdata.datapipes.iter import IterableWrapper
+from transformers import BatchEncoding
+
+import sprucfluo as sf
+
+from sharding_test import with_env
+
+
+def _sequences(n, seq_len=8):
+    return [BatchEncoding(data={"input_ids": [i * 100 + j for j in range(seq_len)],
+                                "labels": [-100] + [i * 100 + j for j in range(1, seq_len)]})
+            for i in range(n)]
+
+
+class ShufflerTest(unittest.TestCase):
+    def test_storage_doesnt_change_the_order(self):
+        items = _sequences(50)
+        expected = list(IterableWrapper(items).seeded_shuffle(3, buffer_size=16))
+        self.assertNotEqual([x["input_ids"] for x in expected], [x["input_ids"] for x in items])
+
+        for kwargs in [dict(dtype=np.int32), dict(serialize=pickle.dumps, deserialize=pickle.loads)]:
+            actual = list(IterableWrapper(items).seeded_shuffle(3, buffer_size=16, **kwargs))
+            self.assertEqual([dict(x) for x in actual], [dict(x) for x in expected], kwargs)
+            self.assertTrue(all(isinstance(x, BatchEncoding) for x in actual))
+
+    def test_array_buffer_of_sequences(self):
+        items = [np.arange(i, i + 4, dtype=np.int64) for i in range(20)]
+        expected = list(IterableWrapper(items).seeded_shuffle(0, buffer_size=5))
+        actual = list(IterableWrapper(items).seeded_shuffle(0, buffer_size=5, dtype=np.uint16))
+        self.assertEqual([x.tolist() for x in actual], [x.tolist() for x in expected])
+        self.assertTrue(all(isinstance(x, np.ndarray) and x.dtype == np.int64 for x in actual))
+
+    def test_array_buffer_keeps_value_types(self):
+        items = [BatchEncoding(data={"input_ids": torch.arange(i, i + 4, dtype=torch.int32),
+                                     "labels": np.arange(i, i + 4, dtype=np.int32)}) for i in range(20)]
+        actual = list(IterableWrapper(items).seeded_shuffle(0, buffer_size=5, dtype=np.int64))
+        self.assertEqual(sorted(x["input_ids"].tolist() for x in actual), [x["input_ids"].tolist() for x in items])
+        self.assertTrue(all(isinstance(x, BatchEncoding) for x in actual))
+        self.assertTrue(all(isinstance(x["input_ids"], torch.Tensor) for x in actual))
+        self.assertEqual(actual[0]["input_ids"].dtype, torch.int32)
+        self.assertTrue(all(isinstance(x["labels"], np.ndarray) for x in actual))
+        self.assertEqual(actual[0]["labels"].dtype, np.int32)
+
+    def test_array_buffer_needs_fixed_lengths(self):
+        with self.assertRaises(ValueError):
+            list(IterableWrapper([[1, 2], [1, 2, 3]]).seeded_shuffle(0, buffer_size=4, dtype=np.int32))
+
+    def test_rngs(self):
+        items = list(range(10000))
+        orders = {}
+        for rng in ["python", "numpy"]:
+            orders[rng] = list(IterableWrapper(items).seeded_shuffle(5, buffer_size=100, rng=rng))
+            self.assertEqual(sorted(orders[rng]), items)
+            self.assertEqual(list(IterableWrapper(items).seeded_shuffle(5, buffer_size=100, rng=rng)), orders[rng])
+        self.assertNotEqual(orders["python"], orders["numpy"])
+        self.assertEqual(list(IterableWrapper(items).seeded_shuffle(5, buffer_size=100)), orders["python"])
+
+        # the numpy generator's state is saved with the block it's in the middle of
+        for rng in ["python", "numpy"]:
+            for n in [50, 150, 4096 + 100, 4096 + 101, 9990]:
+                pipe = IterableWrapper(items).seeded_shuffle(5, buffer_size=100, rng=rng)
+                it = iter(pipe)
+                for _ in range(n):
+                    next(it)
+                state = pickle.loads(pickle.dumps(sf.pipeline_state_dict(pipe)))
+                resumed = IterableWrapper(items).seeded_shuffle(5, buffer_size=100, rng=rng)
+                sf.load_pipeline_state_dict(resumed, state)
+                self.assertEqual(list(resumed), orders[rng][n:], (rng, n))
+
+        other = IterableWrapper(items).seeded_shuffle(5, buffer_size=100, rng="python")
+        sf.load_pipeline_state_dict(other, state)
+        with self.assertRaises(ValueError):
+            list(other)
+
+    def test_array_buffer_resumes(self):
+        items = _sequences(30)
+
+        def make_pipe():
+            return IterableWrapper(items).seeded_shuffle(1, buffer_size=8, dtype=np.int32)
+
+        expected = [dict(x) for x in make_pipe()]
+        for n in [0, 5, 25, 30]:
+            pipe = make_pipe()
+            it = iter(pipe)
+            for _ in range(n):
+                next(it)
+            state = pickle.loads(pickle.dumps(sf.pipeline_state_dict(pipe)))
+            resumed = make_pipe()
+            sf.load_pipeline_state_dict(resumed, state)
+            self.assertEqual([dict(x) for x in resumed], expected[n:], n)
+
+
+def _shard(shard):
+    return IterableWrapper([f"{shard}-{i}" for i in range(shard)])
+
+
+class EpochShuffleTest(unittest.TestCase):
+    def test_shard_order_changes_with_the_epoch(self):
+        pipe = IterableWrapper(list(range(20))).shuffle_shards(0)
+        first = list(pipe)
+        self.assertEqual(list(pipe), first)
+        self.assertEqual(sorted(first), list(range(20)))
+        sf.set_epoch(pipe.map(lambda x: x), 1)
+        second = list(pipe)
+        self.assertNotEqual(second, first)
+        self.assertEqual(sorted(second), list(range(20)))
+        self.assertEqual(list(IterableWrapper(list(range(20))).shuffle_shards(0, epoch=1)), second)
+
+    def test_set_epoch_reaches_seeded_shuffle(self):
+        pipe = IterableWrapper(list(range(50))).seeded_shuffle(0, buffer_size=10)
+        first = list(pipe)
+        sf.set_epoch(pipe, 1)
+        self.assertNotEqual(list(pipe), first)
+        sf.set_epoch(pipe, 0)
+        self.assertEqual(list(pipe), first)
+
+    def test_interleave_reads_everything(self):
+        shards = IterableWrapper([3, 10, 1, 7, 5])
+        pipe = shards.interleave_shards(_shard, num_open=2, seed=0)
+        result = list(pipe)
+        self.assertEqual(len(pipe), 26)
+        self.assertEqual(sorted(result), sorted(x for shard in shards for x in _shard(shard)))
+        # documents from each shard are in order
+        for shard in shards:
+            self.assertEqual([x for x in result if x.startswith(f"{shard}-")], list(_shard(shard)))
+        self.assertNotEqual(result, [x for shard in shards for x in _shard(shard)])
+        self.assertEqual(list(pipe), result)
+
+    def test_interleave_resumes(self):
+        def make_pipe():
+            return IterableWrapper([3, 10, 1, 7, 5]).interleave_shards(_shard, num_open=3, seed=1)
+
+        expected = list(make_pipe())
+        for n in [0, 1, 9, 25, 26]:
+            pipe = make_pipe()
+            it = iter(pipe)
+            for _ in range(n):
+                next(it)
+            state = pickle.loads(pickle.dumps(sf.pipeline_state_dict(pipe)))
+            resumed = make_pipe()
+            sf.load_pipeline_state_dict(resumed, state)
+            self.assertEqual(list(resumed), expected[n:], n)
+
+    def test_interleave_prefetches(self):
+        opened = []
+
+        def read_shard(shard):
+            opened.append(shard)
+            return _shard(shard)
+
+        shards = [3, 10, 1, 7, 5, 0, 4]
+        expected = list(IterableWrapper(shards).interleave_shards(_shard, num_open=2, seed=1))
+
+        def make_pipe():
+            return IterableWrapper(shards).interleave_shards(read_shard, num_open=2, seed=1, prefetch=2)
+
+        it = iter(make_pipe())
+        first = next(it)
+        # the two open shards and the next two
+        self.assertEqual(opened, shards[:4])
+        self.assertEqual([first] + list(it), expected)
+
+        for n in [0, 1, 4, 13, 20, 29, 30]:
+            pipe = make_pipe()
+            it = iter(pipe)
+            for _ in range(n):
+                next(it)
+            state = pickle.loads(pickle.dumps(sf.pipeline_state_dict(pipe)))
+            it.close()
+            resumed = make_pipe()
+            sf.load_pipeline_state_dict(resumed, state)
+            self.assertEqual(list(resumed), expected[n:], n)
+
+    def test_corpus_shuffles_shards_consistently_across_ranks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for shard in range(7):
+                paths.append(os.path.join(tmp, f"shard{shard}.jsonl"))
+                with open(paths[-1], "w") as f:
+                    f.writelines(json.dumps({"text": f"{shard}-{i}"}) + "\n" for i in range(shard + 1))
+            all_docs = sorted(f"{shard}-{i}" for shard in range(7) for i in range(shard + 1))
+
+            orders = []
+            for epoch in range(2):
+                results = []
+                for rank in range(3):
+                    with with_env(RANK=rank, WORLD_SIZE=3):
+                        pipe = sf.load_corpus(paths, shuffle_seed=0, num_open_shards=2)
+                        sf.set_epoch(pipe, epoch)
+                        results.append(list(pipe))
+                # each document is read by exactly one rank
+                self.assertEqual(sorted(doc for docs in results for doc in docs), all_docs)
+                orders.append(results)
+            self.assertNotEqual(orders[0], orders[1])
+
+            pipe = sf.load_corpus(paths, shard_by_rank=False, shuffle_seed=0, num_open_shards=3)
+            self.assertEqual(sorted(pipe), all_docs)
+            prefetched = sf.load_corpus(paths, shard_by_rank=False, shuffle_seed=0, num_open_shards=3, prefetch=2)
+            self.assertEqual(list(prefetched), list(pipe))
+
+    def test_set_epoch_reaches_the_interleaver_inside_flat_shard_by_rank(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for shard in range(4):
+                paths.append(os.path.join(tmp, f"shard{shard}.jsonl"))
+                with open(paths[-1], "w") as f:
+                    f.writelines(json.dumps({"text": f"{shard}-{i}"}) + "\n" for i in range(10))
+
+            # the same shards in the same order, so only the interleaving can differ
+            pipe = sf.load_corpus(paths, shard_by_rank=True, shuffle_seed=1, num_open_shards=4)
+            unsharded = sf.load_corpus(paths, shard_by_rank=False, shuffle_seed=1, num_open_shards=4)
+            orders = []
+            for epoch in range(3):
+                sf.set_epoch(pipe, epoch)
+                sf.set_epoch(unsharded, epoch)
+                orders.append(list(pipe))
+                self.assertEqual(orders[-1], list(unsharded))
+            self.assertEqual(len({tuple(order) for order in orders}), 3)
+            sf.set_epoch(pipe, 0)
+            self.assertEqual(list(pipe), orders[0])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
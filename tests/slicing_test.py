@@ -1,6 +1,7 @@
 import unittest
 
 import sprucfluo as sf
+from torch.utils.data import IterDataPipe
 from torchdata.datapipes.iter import IterableWrapper
 
 
@@ -15,6 +16,40 @@ class SlicingTests(unittest.TestCase):
         assert list(base_iter.slice(10, -20)) == list(base[10:-20])
         assert list(base_iter.slice(10, -20, 3)) == list(base[10:-20:3])
 
+    def test_take_and_drop(self):
+        base = list(range(0, 40))
+        base_iter = IterableWrapper(base)
+        assert list(base_iter.take(10)) == base[:10]
+        assert list(base_iter.drop(10)) == base[10:]
+        assert list(base_iter.drop(50)) == []
+        assert list(base_iter.slice(5, 30, 2).drop(3).take(4)) == base[5:30:2][3:][:4]
+
+    def test_negative_stop_needs_len(self):
+        with self.assertRaises(TypeError):
+            list(IterableWrapper(iter(range(10))).slice(2, -2))
+        with self.assertRaises(TypeError):
+            len(IterableWrapper(iter(range(10))).drop(2))
+
+    def test_fast_forward(self):
+        produced = []
+
+        def record(x):
+            produced.append(x)
+            return x
+
+        pipe = IterableWrapper(list(range(100))).map(record).batch(3).map(sum)
+        assert list(pipe.drop(10).take(2)) == [sum(range(30, 33)), sum(range(33, 36))]
+        assert produced == list(range(30, 36))
+
+        class Skippable(IterDataPipe):
+            def __iter__(self):
+                raise AssertionError("should have skipped")
+
+            def skip(self, n):
+                return iter(range(n, 10))
+
+        assert list(Skippable().slice(3, 8, 2)) == [3, 5, 7]
+
     def test_len(self):
         base = list(range(0, 1000))
         base_iter = IterableWrapper(base)
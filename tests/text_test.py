@@ -1,8 +1,14 @@
+import copy
+import io
+import json
 import unittest
+from itertools import chain
 
+import numpy as np
 from torchdata.datapipes.iter import IterableWrapper
 
 from sprucfluo.text import *
+from sprucfluo.text import _iter_lines
 
 
 class MockTokenizer(object):
@@ -18,6 +24,31 @@ class MockTokenizer(object):
         return {"input_ids": text, "attention_mask": [[1] * len(t) for t in text]}
 
 
+def reference_concatenate_and_group_texts(encoding, seq_len, stride=None, drop_remainder=True,
+                                          mask_stride_overlap=True):
+    """The original list-based implementation of concatenate_and_group_texts"""
+    concatenated = {k: list(chain(*v)) for k, v in encoding.items()}
+    total_length = len(concatenated["input_ids"])
+    stride = stride or seq_len
+
+    if total_length % stride != 0 and drop_remainder:
+        total_length = ((total_length - seq_len + stride) // stride) * stride
+
+    for begin in range(0, total_length - seq_len + stride, stride):
+        data = {k: v[begin:begin+seq_len] for k, v in concatenated.items()}
+
+        if mask_stride_overlap and stride != seq_len:
+            labels = data.get("labels", data["input_ids"])
+            if begin != 0:
+                labels = copy.deepcopy(labels)
+                for i in range(seq_len - stride):
+                    if i < len(labels):
+                        labels[i] = -100
+            data["labels"] = labels
+
+        yield data
+
+
 class TokenizeTests(unittest.TestCase):
     def test_tokenize_and_group_texts_short_texts(self):
         tokenizer = MockTokenizer(append_special_tokens=False)
@@ -87,6 +118,93 @@ class TokenizeTests(unittest.TestCase):
                 self.assertEqual(samples_len, total_len, "failure for seq_len={} and stride={}".format(seq_len, stride))
 
 
+    def test_concatenate_and_group_texts_matches_reference(self):
+        docs = [list(range(100 * i, 100 * i + n)) for i, n in enumerate([5, 0, 17, 3, 1, 9])]
+        encoding = {"input_ids": docs, "attention_mask": [[1] * len(d) for d in docs]}
+
+        array_encoding = {k: [np.asarray(d, dtype=np.int32) for d in v] for k, v in encoding.items()}
+
+        for seq_len in [1, 2, 3, 7, 8, 50, 60]:
+            for stride in [None] + list(range(1, seq_len)):
+                for drop_remainder in [True, False]:
+                    kwargs = dict(seq_len=seq_len, stride=stride, drop_remainder=drop_remainder)
+                    expected = list(reference_concatenate_and_group_texts(encoding, **kwargs))
+                    for enc in [encoding, array_encoding]:
+                        actual = list(concatenate_and_group_texts(enc, **kwargs))
+                        self.assertEqual([dict(a) for a in actual], expected, f"failure for {kwargs}")
+
+    def test_concatenate_and_group_texts_stacked(self):
+        docs = [list(range(10)), list(range(10, 24))]
+        encoding = {"input_ids": docs, "attention_mask": [[1] * len(d) for d in docs]}
+
+        for return_tensors in ["np", "pt"]:
+            batches = list(concatenate_and_group_texts(encoding, seq_len=5, stride=3, drop_remainder=False,
+                                                       return_tensors=return_tensors))
+            expected = list(reference_concatenate_and_group_texts(encoding, seq_len=5, stride=3,
+                                                                  drop_remainder=False))
+            rows = [{k: list(row) for k, row in zip(b.keys(), rows)}
+                    for b in batches for rows in zip(*[np.asarray(v) for v in b.values()])]
+            self.assertEqual(tuple(batches[0]["input_ids"].shape), (7, 5))
+            self.assertEqual(rows, expected)
+
+
+    def test_group_texts_carries_over_between_batches(self):
+        docs = [list(range(100 * i, 100 * i + n)) for i, n in enumerate([5, 0, 17, 3, 1, 9, 4, 11])]
+        encoding = {"input_ids": docs, "attention_mask": [[1] * len(d) for d in docs]}
+
+        for seq_len in [1, 3, 7, 8, 60]:
+            for stride in [None] + sorted({1, 2, seq_len - 1} & set(range(1, seq_len))):
+                for drop_remainder in [True, False]:
+                    kwargs = dict(seq_len=seq_len, stride=stride or None, drop_remainder=drop_remainder)
+                    expected = list(reference_concatenate_and_group_texts(encoding, **kwargs))
+                    for batch_size in [1, 2, 3, len(docs)]:
+                        for as_arrays in [False, True]:
+                            batches = [{k: [np.asarray(d) if as_arrays else d for d in v[i:i + batch_size]]
+                                        for k, v in encoding.items()}
+                                       for i in range(0, len(docs), batch_size)]
+                            actual = list(IterableWrapper(batches).group_texts(**kwargs))
+                            self.assertEqual([dict(a) for a in actual], expected,
+                                             f"failure for {kwargs}, batch_size={batch_size}, arrays={as_arrays}")
+
+
+
+class ReadJsonlTests(unittest.TestCase):
+    docs = [
+        {"text": "plain", "meta": {"pile_set_name": "Pile-CC"}},
+        {"text": "with \"quotes\" and \\ backslashes \\", "meta": {}},
+        {"text": "trailing backslash \\"},
+        {"text": "newlines\nand\ttabs and unicode: \u00e9\u4e2d\U0001F600"},
+        {"meta": {"text": "decoy"}, "text": "key not first"},
+        {"text": ""},
+    ]
+
+    def _jsonl(self, ensure_ascii=True, newline="\n"):
+        lines = [json.dumps(d, ensure_ascii=ensure_ascii) for d in self.docs]
+        return (newline.join(lines[:3]) + newline + newline + newline.join(lines[3:])).encode("utf-8")
+
+    def test_backends(self):
+        expected = [d["text"] for d in self.docs]
+        backends = ["json"]
+        for optional in ["orjson", "simdjson"]:
+            try:
+                __import__(optional)
+                backends.append(optional)
+            except ImportError:
+                pass
+
+        for backend in backends:
+            for ensure_ascii in [True, False]:
+                for newline in ["\n", "\r\n"]:
+                    data = self._jsonl(ensure_ascii, newline)
+                    for stream in [io.BytesIO(data), io.StringIO(data.decode("utf-8"))]:
+                        self.assertEqual(list(read_jsonl(stream, backend=backend)), expected,
+                                         f"failure for {backend}, {type(stream).__name__}")
+
+    def test_iter_lines_small_blocks(self):
+        data = b"a\nbb\n\nccccccc\nd"
+        for block_size in range(1, 10):
+            self.assertEqual(list(_iter_lines(io.BytesIO(data), block_size)), [b"a", b"bb", b"", b"ccccccc", b"d"])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,127 @@
+import json
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+
+import sprucfluo as sf
+
+
+class IntTokenizer(object):
+    """Tokenizes whitespace-separated integers, and counts how many times it's been called."""
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, text):
+        self.calls += 1
+        ids = [[int(w) for w in t.split()] for t in text]
+        return {"input_ids": ids, "attention_mask": [[1] * len(t) for t in ids]}
+
+
+class TokenCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = []
+        for shard in range(3):
+            path = os.path.join(self.tmp.name, f"shard_{shard}.jsonl")
+            with open(path, "w") as f:
+                for doc in range(5):
+                    text = " ".join(str(100 * shard + 10 * doc + i) for i in range(doc + 1))
+                    f.write(json.dumps({"text": text}) + "\n")
+            self.paths.append(path)
+        self.cache_dir = os.path.join(self.tmp.name, "cache")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cached_matches_uncached(self):
+        tokenizer = IntTokenizer()
+        expected = list(sf.load_corpus(self.paths, shard_by_rank=False)
+                        .then(sf.tokenize_and_group_texts, tokenizer=tokenizer, seq_len=4, batch_size=2))
+
+        tokenizer = IntTokenizer()
+        cached = sf.load_tokenized_corpus(self.paths, tokenizer, seq_len=4, cache_dir=self.cache_dir,
+                                          shard_by_rank=False, batch_size=2, fingerprint="ints")
+
+        first = list(cached)
+        calls = tokenizer.calls
+        self.assertGreater(calls, 0)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3 * len(self.paths))
+
+        second = list(cached)
+        self.assertEqual(tokenizer.calls, calls)
+
+        for samples in (first, second):
+            self.assertEqual([s["input_ids"] for s in samples], [e["input_ids"] for e in expected])
+            self.assertEqual([s["attention_mask"] for s in samples], [e["attention_mask"] for e in expected])
+
+    def test_return_tensors_and_resuming(self):
+        expected = list(sf.load_corpus(self.paths, shard_by_rank=False)
+                        .then(sf.tokenize_and_group_texts, tokenizer=IntTokenizer(), seq_len=4, stride=3,
+                              drop_remainder=False, return_tensors="np"))
+
+        def make():
+            return sf.load_tokenized_corpus(self.paths, IntTokenizer(), seq_len=4, cache_dir=self.cache_dir, stride=3,
+                                            drop_remainder=False, shard_by_rank=False, batch_size=2,
+                                            fingerprint="ints", return_tensors="np")
+
+        # the stacks are cut differently, but they're the same sequences
+        for _ in range(2):
+            result = list(make())
+            self.assertEqual(set(result[0].keys()), set(expected[0].keys()))
+            for k in expected[0].keys():
+                self.assertIsInstance(result[0][k], np.ndarray)
+                self.assertEqual([s.tolist() for batch in result for s in batch[k]],
+                                 [s.tolist() for batch in expected for s in batch[k]])
+
+        sequences = [s.tolist() for batch in result for s in batch["input_ids"]]
+        for n in [1, 3, len(result) - 1]:
+            pipe = make()
+            it = iter(pipe)
+            first = [s.tolist() for _ in range(n) for s in next(it)["input_ids"]]
+            state = pickle.loads(pickle.dumps(sf.pipeline_state_dict(pipe)))
+            resumed = make()
+            sf.load_pipeline_state_dict(resumed, state)
+            self.assertEqual(first + [s.tolist() for batch in resumed for s in batch["input_ids"]], sequences)
+
+    def test_docs_per_item(self):
+        pipe = sf.TokenCacheIterDataPipe(sf.expand_paths(self.paths), IntTokenizer(), self.cache_dir,
+                                         fingerprint="ints")
+        docs = [d.tolist() for d in pipe]
+        chunked = sf.TokenCacheIterDataPipe(sf.expand_paths(self.paths), IntTokenizer(), self.cache_dir,
+                                            fingerprint="ints", docs_per_item=2)
+        # 5 documents per shard, so 3 items per shard
+        expected = [sum(docs[shard * 5 + i:min(shard * 5 + i + 2, shard * 5 + 5)], [])
+                    for shard in range(3) for i in range(0, 5, 2)]
+        self.assertEqual([d.tolist() for d in chunked], expected)
+        for n in [0, 2, 3, 7, 9]:
+            self.assertEqual([d.tolist() for d in chunked.drop(n)], expected[n:])
+
+    def test_partial_read_is_not_cached(self):
+        pipe = sf.TokenCacheIterDataPipe(sf.expand_paths(self.paths), IntTokenizer(), self.cache_dir,
+                                         fingerprint="ints")
+        it = iter(pipe)
+        next(it)
+        del it
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_drop_skips_cached_shards(self):
+        pipe = sf.TokenCacheIterDataPipe(sf.expand_paths(self.paths), IntTokenizer(), self.cache_dir,
+                                         fingerprint="ints")
+        expected = [d.tolist() for d in pipe]
+
+        # the first shard can't be tokenized again, so it has to be skipped from the cache
+        with open(self.paths[0], "w") as f:
+            f.write("not json\n")
+        for n in [0, 3, 5, 12, 15, 20]:
+            self.assertEqual([d.tolist() for d in pipe.drop(n)], expected[n:])
+
+    def test_fingerprint_requires_vocab(self):
+        with self.assertRaises(ValueError):
+            sf.tokenizer_fingerprint(IntTokenizer())
+
+
+if __name__ == '__main__':
+    unittest.main()